@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+"""
+End to end benchmark of BingWallpaperDownloader with sqlite storage against a local bing stand-in server, prints
+one json object.
+
+The stand-in runs in a child process and serves /HPImageArchive.aspx and /th?id=..., with configurable image size,
+latency, 503 error rate and connections dropped in the middle of the body (resumed with Range requests).
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from async_engine import AsyncBingWallpaperEngine  # noqa: E402
+from bing_downloader import BingWallpaperDownloader  # noqa: E402
+from bing_storage import SqliteBingWallpaperManager  # noqa: E402
+from http_session import HttpSessionPool  # noqa: E402
+from metrics import RETRIES  # noqa: E402
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # set by serve()
+    config = {}
+    body = b""
+    generation = None
+    rand = random.Random()
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send(self, status: int, body: bytes = b"", headers: dict = None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.config["latency_ms"] / 1000)
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == "/bench/generation":
+            # start a new round of wallpapers, so every round downloads all of them
+            self.generation.value += 1
+            self._send(200, str(self.generation.value).encode())
+        elif url.path == "/HPImageArchive.aspx":
+            self._archive(query)
+        elif url.path == "/th":
+            self._image(query.get("id", [""])[0])
+        else:
+            self._send(404)
+
+    def _archive(self, query: dict):
+        num = int(query.get("n", ["8"])[0])
+        market = query.get("mkt", ["zh-CN"])[0]
+        gen = self.generation.value
+        images = []
+        for i in range(num):
+            name = "Bench{}x{}".format(gen, i)
+            images.append({
+                "startdate": "{:08d}".format(20000101 + i),
+                "fullstartdate": "{:08d}1600".format(20000101 + i),
+                "enddate": "{:08d}".format(20000102 + i),
+                "url": "/th?id=OHR.{}_{}_UHD.jpg&rf=LaDigue_UHD.jpg&pid=hp&w=3840&h=2160".format(name, market),
+                "urlbase": "/th?id=OHR.{}_{}".format(name, market),
+                "copyright": "Bench wallpaper {} of round {}".format(i, gen),
+                "title": name,
+                "hsh": "{:016x}{:016x}".format(gen, i),
+            })
+        self._send(200, json.dumps({"images": images}).encode(), {"Content-Type": "application/json"})
+
+    def _image(self, image_id: str):
+        config = self.config
+        if self.rand.random() < config["error_rate"]:
+            self._send(503)
+            return
+        etag = '"{}"'.format(image_id)
+        offset = 0
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range", etag) == etag:
+            offset = int(range_header.split("=")[1].split("-")[0])
+        if offset >= len(self.body):
+            self._send(416, headers={"Content-Range": "bytes */{}".format(len(self.body))})
+            return
+
+        body = self.body[offset:]
+        self.send_response(206 if offset else 200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        if offset:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(offset, len(self.body) - 1, len(self.body)))
+        self.end_headers()
+        if self.rand.random() < config["drop_rate"]:
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+def serve(config: dict, port_queue: multiprocessing.Queue):
+    StandInHandler.config = config
+    StandInHandler.body = os.urandom(config["image_size"])
+    StandInHandler.generation = multiprocessing.Value("i", 0)
+    StandInHandler.rand = random.Random(config["seed"])
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def timed(func, samples: list[float], lock: threading.Lock):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with lock:
+                samples.append(elapsed)
+    return wrapper
+
+
+def bench(args) -> dict:
+    config = {"image_size": args.image_size, "latency_ms": args.latency_ms, "error_rate": args.error_rate,
+              "drop_rate": args.drop_rate, "seed": args.seed}
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(config, port_queue), daemon=True)
+    server.start()
+    base_url = "http://127.0.0.1:{}".format(port_queue.get(timeout=10))
+
+    markets = ["m{}".format(i) for i in range(args.markets)] if args.markets > 1 else None
+    result = {"config": dict(config, images=args.images, markets=args.markets, rounds=args.rounds,
+                             concurrency=args.concurrency, engine=args.engine)}
+    image_latency, db_latency = [], []
+    lock = threading.Lock()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            mgr = SqliteBingWallpaperManager(os.path.join(tmp, "bing.db"), hsh_index=True)
+            mgr.init_db()
+            session = HttpSessionPool(pool_size=args.concurrency, max_retries=args.max_retries,
+                                      retry_backoff_ms=args.retry_backoff)
+            downloader = BingWallpaperDownloader(download_cnt=args.images,
+                                                 download_path=os.path.join(tmp, "download"),
+                                                 max_retries=args.max_retries,
+                                                 retry_backoff_ms=args.retry_backoff,
+                                                 download_concurrency=args.concurrency,
+                                                 wallpaper_mgr=mgr,
+                                                 session=session,
+                                                 markets=markets,
+                                                 bing_base_url=base_url)
+            downloader.download_one_img = timed(downloader.download_one_img, image_latency, lock)
+            # all the database work of a round happens in these two
+            downloader.plan_downloads = timed(downloader.plan_downloads, db_latency, lock)
+            downloader.save_downloads = timed(downloader.save_downloads, db_latency, lock)
+            engine = None
+            if args.engine == "ASYNCIO":
+                engine = AsyncBingWallpaperEngine([downloader], per_host_limit=args.concurrency,
+                                                  io_workers=args.concurrency)
+
+            failed = 0
+            retries = RETRIES.get(operation="http") + RETRIES.get(operation="download")
+            start = time.perf_counter()
+            for _ in range(args.rounds):
+                session.get(base_url + "/bench/generation")
+                rounds = engine.run() if engine else [downloader.download()]
+                failed += sum(r.failed for r in rounds)
+            elapsed = time.perf_counter() - start
+            if engine:
+                engine.close()
+    finally:
+        server.terminate()
+
+    images = args.images * args.rounds
+    result.update({
+        "images": images,
+        "failed": failed,
+        "elapsed_sec": round(elapsed, 3),
+        "images_per_sec": round(images / elapsed, 2),
+        "mb_per_sec": round(images * args.image_size / elapsed / 1024 / 1024, 2),
+        "image_p50_ms": round(percentile(image_latency, 50) * 1000, 2),
+        "image_p99_ms": round(percentile(image_latency, 99) * 1000, 2),
+        "db_sec": round(sum(db_latency), 4),
+        "retries": RETRIES.get(operation="http") + RETRIES.get(operation="download") - retries,
+        # kilobytes on linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    })
+    return result
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the download pipeline against a local bing stand-in.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--images', default=64, type=int, help='Wallpapers of each market in one round')
+    parser.add_argument('--markets', default=1, type=int,
+                        help='Markets to fetch in one round, all of them return the same wallpapers')
+    parser.add_argument('--rounds', default=3, type=int, help='Rounds to run, every round has new wallpapers')
+    parser.add_argument('--image-size', default=1024 * 1024, type=int, help='Bytes of one image')
+    parser.add_argument('--latency-ms', default=20, type=float, help='Delay before every response')
+    parser.add_argument('--error-rate', default=0.0, type=float, help='Ratio of image requests answered with 503')
+    parser.add_argument('--drop-rate', default=0.0, type=float,
+                        help='Ratio of image responses cut in the middle of the body')
+    parser.add_argument('--concurrency', default=4, type=int, help='Download concurrency')
+    parser.add_argument('--engine', default='THREAD', choices=['THREAD', 'ASYNCIO'], help='Download engine')
+    parser.add_argument('--max-retries', default=3, type=int, help='Retries of failed requests')
+    parser.add_argument('--retry-backoff', default=10, type=int, help='Retry backoff millisecond')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the error and drop decisions')
+    parser.add_argument('--log-level', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=args.log_level)
+    print(json.dumps(bench(args)))
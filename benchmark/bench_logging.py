@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+"""
+Cost of one log call in the thread logging it, prints one json object: the synchronous handler against the queue
+backed one, for the text and json formats, writing to a file while several threads log at once. The async numbers
+also report the time the listener needs to drain the queue at the end.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from log import SAMPLED, LogFormat, init_logging, log_context, new_correlation_id  # noqa: E402
+from metrics import LOG_DROPPED  # noqa: E402
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def reset_logging():
+    logger = logging.getLogger()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def worker(lines: int, sampled: bool, latency: list[float]):
+    with log_context(cycle_id=new_correlation_id()):
+        for i in range(lines):
+            with log_context(image_id="{:032x}:UHD_1609".format(i)):
+                start = time.perf_counter()
+                if sampled:
+                    logging.info("[BingDownloader] wallpaper exist: %s", i, extra=SAMPLED)
+                else:
+                    logging.info("[BingDownloader] success download wallpaper, %d, size: %d", i, 1024,
+                                 extra={"duration_ms": 1.5, "bytes": 1024})
+                latency.append(time.perf_counter() - start)
+
+
+def bench_case(log_format: LogFormat, async_queue: bool, sample: int, threads: int, lines: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        listener = init_logging(tmp_dir, "INFO", log_format=log_format, async_queue=async_queue,
+                                queue_size=threads * lines, sample=sample)
+        dropped = LOG_DROPPED.get()
+        latencies = [[] for _ in range(threads)]
+        workers = [threading.Thread(target=worker, args=(lines, sample > 1, latencies[i])) for i in range(threads)]
+        start = time.perf_counter()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.perf_counter() - start
+        # stopping the listener waits until the queue is drained
+        drain_start = time.perf_counter()
+        if listener is not None:
+            listener.stop()
+        drain = time.perf_counter() - drain_start
+        reset_logging()
+        size = sum(os.path.getsize(os.path.join(tmp_dir, f)) for f in os.listdir(tmp_dir))
+
+    latency = [v for values in latencies for v in values]
+    return {
+        "format": str(log_format),
+        "async": async_queue,
+        "sample": sample,
+        "calls_per_sec": round(len(latency) / elapsed, 1),
+        "call_p50_us": round(percentile(latency, 50) * 1e6, 2),
+        "call_p99_us": round(percentile(latency, 99) * 1e6, 2),
+        "drain_sec": round(drain, 3),
+        "dropped": LOG_DROPPED.get() - dropped,
+        "bytes_written": size,
+    }
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the sync and async log handlers.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--threads', default=8, type=int, help='Threads logging at once')
+    parser.add_argument('--lines', default=20000, type=int, help='Lines logged by each thread')
+    parser.add_argument('--sample', default=10, type=int, help='Sample rate of the sampled case')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    cases = [(log_format, async_queue, 1) for log_format in LogFormat for async_queue in (False, True)]
+    cases.append((LogFormat.JSON, True, args.sample))
+    print(json.dumps({"threads": args.threads, "lines": args.lines,
+                      "cases": [bench_case(f, a, s, args.threads, args.lines) for f, a, s in cases]}))
@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+"""
+Micro benchmark of the near duplicate detection, prints one json object: the lookups of HammingIndex against a
+linear scan of the same hashes, and the DCT hashing of images when numpy or Pillow are installed.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import phash  # noqa: E402
+from phash import HASH_BITS, IMG_SIZE, HammingIndex, dct_hash, hamming  # noqa: E402
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def flip_bits(rand: random.Random, h: int, bits: int) -> int:
+    for b in rand.sample(range(HASH_BITS), bits):
+        h ^= 1 << b
+    return h
+
+
+def bench_index(hashes: int, queries: int, distance: int, seed: int) -> dict:
+    rand = random.Random(seed)
+    stored = [rand.getrandbits(HASH_BITS) for _ in range(hashes)]
+    index = HammingIndex()
+    start = time.perf_counter()
+    for i, h in enumerate(stored):
+        index.add(i, h)
+    build = time.perf_counter() - start
+
+    # half of the queries are near duplicates of a stored hash, the others are new images
+    probes = [flip_bits(rand, rand.choice(stored), rand.randint(0, distance)) if i % 2 == 0
+              else rand.getrandbits(HASH_BITS) for i in range(queries)]
+    latency = []
+    found = []
+    for h in probes:
+        start = time.perf_counter()
+        found.append(index.search(h, distance))
+        latency.append(time.perf_counter() - start)
+
+    # the linear scan is slow, only a part of the queries
+    scan_queries = min(queries, 50)
+    scan_latency = []
+    mismatch = 0
+    for h, matches in zip(probes[:scan_queries], found):
+        start = time.perf_counter()
+        expected = sorted((hamming(s, h), i) for i, s in enumerate(stored) if hamming(s, h) <= distance)
+        scan_latency.append(time.perf_counter() - start)
+        if sorted(matches) != expected:
+            mismatch += 1
+
+    return {
+        "hashes": hashes,
+        "queries": queries,
+        "distance": distance,
+        "build_sec": round(build, 3),
+        "query_p50_ms": round(percentile(latency, 50) * 1000, 4),
+        "query_p99_ms": round(percentile(latency, 99) * 1000, 4),
+        "matched_queries": sum(1 for m in found if m),
+        "scan_p50_ms": round(percentile(scan_latency, 50) * 1000, 4),
+        "scan_queries": scan_queries,
+        # queries whose result differs from the linear scan, must be 0
+        "mismatch": mismatch,
+    }
+
+
+def bench_hash(images: int, seed: int) -> dict:
+    rand = random.Random(seed)
+    result = {"images": images}
+    pixels = [[[rand.random() * 255 for _ in range(IMG_SIZE)] for _ in range(IMG_SIZE)] for _ in range(images)]
+
+    start = time.perf_counter()
+    for p in pixels:
+        dct_hash(p)
+    result["dct_per_sec"] = round(images / (time.perf_counter() - start), 1)
+
+    if phash.numpy is None:
+        result["vectorized"] = "skipped, numpy is not installed"
+    else:
+        stack = phash.numpy.asarray(pixels, dtype=phash.numpy.float64)
+        start = time.perf_counter()
+        phash.dct_hashes(stack)
+        result["vectorized_per_sec"] = round(images / (time.perf_counter() - start), 1)
+
+    if not phash.available():
+        result["decode"] = "skipped, Pillow is not installed"
+        return result
+    # a wallpaper sized JPEG, the draft mode decodes it at 1/8 scale
+    img = phash.Image.new("RGB", (1920, 1080))
+    img.putdata([(x % 256, y % 256, (x * y) % 256) for y in range(1080) for x in range(1920)])
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=90)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, "bench.jpg")
+        with open(file_name, "wb") as file:
+            file.write(buf.getvalue())
+        count = max(1, images // 10)
+        start = time.perf_counter()
+        for _ in range(count):
+            phash.image_hash(file_name)
+        result["decode_hash_ms"] = round((time.perf_counter() - start) / count * 1000, 2)
+    return result
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the perceptual hash index and hashing.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--hashes', default=100000, type=int, help='Stored hashes in the index')
+    parser.add_argument('--queries', default=1000, type=int, help='Lookups, half of them are near duplicates')
+    parser.add_argument('--distance', default=8, type=int, help='Max hamming distance of a lookup')
+    parser.add_argument('--images', default=200, type=int, help='Images to hash')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the hashes and images')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    print(json.dumps({"index": bench_index(args.hashes, args.queries, args.distance, args.seed),
+                      "hash": bench_hash(args.images, args.seed)}))
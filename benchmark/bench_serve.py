@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+"""
+Throughput of the serve mode, prints one json object. The server runs in a child process pinned to one core, the
+clients in other processes, each of them sends requests on one keep-alive connection for a fixed duration.
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from bing_client import BingWallpaperInfo  # noqa: E402
+from bing_storage import SqliteBingWallpaperManager  # noqa: E402
+from serve import WallpaperServer  # noqa: E402
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def populate(storage_path: str, download_path: str, wallpapers: int, image_size: int) -> list[str]:
+    wallpaper_mgr = SqliteBingWallpaperManager(os.path.join(storage_path, "bing.db"))
+    wallpaper_mgr.init_db()
+    body = os.urandom(image_size)
+    hshs = []
+    with wallpaper_mgr.batch():
+        for i in range(wallpapers):
+            date = "{:08d}".format(20200101 + i)
+            hsh = "{:032x}".format(i)
+            w = BingWallpaperInfo.fromdict({
+                "startdate": date,
+                "url": "https://www.bing.com/th?id=OHR.Bench{}_UHD.jpg&rf=LaDigue_UHD.jpg".format(i),
+                "copyright": "Bench wallpaper {}".format(i),
+                "title": "Bench {}".format(i),
+                "hsh": hsh,
+                "zone": ["CN", "EN"][i % 2],
+            })
+            path = os.path.join(date[:6], "{}_OHR.Bench{}_UHD.jpg".format(date, i))
+            os.makedirs(os.path.join(download_path, date[:6]), exist_ok=True)
+            with open(os.path.join(download_path, path), "wb") as file:
+                file.write(body)
+            wallpaper_mgr.save_wallpaper_info(w, size=image_size, digest="")
+            wallpaper_mgr.save_wallpaper_variant(hsh, "UHD_1609", path, size=image_size)
+            hshs.append(hsh)
+    return hshs
+
+
+def serve(storage_path: str, download_path: str, port: int, cache_size: int, ready, stop):
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {sorted(os.sched_getaffinity(0))[0]})
+    wallpaper_mgr = SqliteBingWallpaperManager(os.path.join(storage_path, "bing.db"))
+    wallpaper_mgr.init_db()
+    server = WallpaperServer(wallpaper_mgr, download_path, "127.0.0.1", port, cache_size=cache_size, cache_ttl=60)
+    server.start()
+    ready.put(server.address[1])
+    stop.wait()
+    server.close()
+
+
+def client(port: int, paths: list[str], duration: float, seed: int, results):
+    rand = random.Random(seed)
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    latency = {}
+    errors = 0
+    received = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        kind, path, headers = rand.choice(paths)
+        start = time.perf_counter()
+        conn.request("GET", path, headers=headers)
+        r = conn.getresponse()
+        received += len(r.read())
+        latency.setdefault(kind, []).append(time.perf_counter() - start)
+        if r.status >= 400:
+            errors += 1
+    conn.close()
+    results.put((latency, errors, received))
+
+
+def bench(args) -> dict:
+    result = {"wallpapers": args.wallpapers, "image_size": args.image_size, "clients": args.clients,
+              "duration_sec": args.duration, "cache_size": args.cache_size}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        storage_path = os.path.join(tmp_dir, "db")
+        download_path = os.path.join(tmp_dir, "download")
+        os.makedirs(storage_path)
+        hshs = populate(storage_path, download_path, args.wallpapers, args.image_size)
+
+        # a skewed mix: most requests are for today, the rest spread over the archive
+        hot = hshs[-8:]
+        paths = [("latest", "/api/latest", {})] * 4 + \
+                [("range", "/api/wallpapers?start={}&limit=8".format(20200101 + args.wallpapers - 8), {})] * 2 + \
+                [("lookup", "/api/wallpapers/{}".format(h), {}) for h in hot] + \
+                [("image", "/images/{}".format(h), {}) for h in hot] + \
+                [("image_range", "/images/{}".format(h), {"Range": "bytes=0-65535"}) for h in hot] + \
+                [("image_cold", "/images/{}".format(h), {}) for h in hshs[::max(1, len(hshs) // 16)]]
+
+        ctx = multiprocessing.get_context("spawn")
+        ready, stop, results = ctx.Queue(), ctx.Event(), ctx.Queue()
+        server = ctx.Process(target=serve, args=(storage_path, download_path, 0, args.cache_size, ready, stop))
+        server.start()
+        try:
+            port = ready.get(timeout=30)
+            clients = [ctx.Process(target=client, args=(port, paths, args.duration, args.seed + i, results))
+                       for i in range(args.clients)]
+            for c in clients:
+                c.start()
+            latency = {}
+            errors = 0
+            received = 0
+            for _ in clients:
+                client_latency, client_errors, client_received = results.get(timeout=args.duration + 60)
+                for kind, values in client_latency.items():
+                    latency.setdefault(kind, []).extend(values)
+                errors += client_errors
+                received += client_received
+            for c in clients:
+                c.join()
+        finally:
+            stop.set()
+            server.join(10)
+
+    requests = sum(len(v) for v in latency.values())
+    result.update({
+        "requests": requests,
+        "errors": errors,
+        "requests_per_sec": round(requests / args.duration, 1),
+        "mb_per_sec": round(received / args.duration / 1024 / 1024, 2),
+        "latency_ms": {kind: {"count": len(values),
+                              "p50": round(percentile(values, 50) * 1000, 3),
+                              "p99": round(percentile(values, 99) * 1000, 3)} for kind, values in latency.items()},
+    })
+    return result
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the serve mode on one core.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--wallpapers', default=2000, type=int, help='Stored wallpapers')
+    parser.add_argument('--image-size', default=256 * 1024, type=int, help='Bytes of one image')
+    parser.add_argument('--clients', default=4, type=int, help='Client processes, one connection each')
+    parser.add_argument('--duration', default=5.0, type=float, help='Seconds each client sends requests')
+    parser.add_argument('--cache-size', default=1024, type=int, help='Cache size of the server, 0 disables it')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the request mix')
+    parser.add_argument('--log-level', default='WARNING', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    logging.basicConfig(level=args.log_level)
+    print(json.dumps(bench(args)))
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+"""Micro benchmark of SqliteBingWallpaperManager insert, lookup and search throughput, prints one json object."""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from bing_client import BingWallpaperInfo  # noqa: E402
+from bing_storage import SqliteBingWallpaperManager  # noqa: E402
+
+
+# like real descriptions every word is in a small part of the rows
+_rand = random.Random(0)
+WORDS = ["".join(_rand.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(_rand.randint(4, 10))) for _ in range(5000)]
+
+
+def make_wallpaper(i: int) -> BingWallpaperInfo:
+    rand = random.Random(i)
+    return BingWallpaperInfo.fromdict({
+        "startdate": "{:08d}".format(20000101 + i % 100000),
+        "url": "https://www.bing.com/th?id=OHR.Bench{}_UHD.jpg&rf=LaDigue_UHD.jpg".format(i),
+        "copyright": "Bench wallpaper {}".format(i),
+        "title": "Bench {} {}".format(rand.choice(WORDS), i),
+        "desc": " ".join(rand.choice(WORDS) for _ in range(30)),
+        "hsh": "{:032x}".format(i),
+        "zone": "CN" if i % 2 else "EN",
+    })
+
+
+def bench(rows: int, batch_size: int, lookups: int, single_commit_rows: int, searches: int) -> dict:
+    result = {"rows": rows, "batch_size": batch_size, "lookups": lookups, "searches": searches}
+    wallpapers = [make_wallpaper(i) for i in range(rows)]
+    with tempfile.TemporaryDirectory() as tmp:
+        mgr = SqliteBingWallpaperManager(os.path.join(tmp, "bench.db"))
+        mgr.init_db()
+
+        start = time.perf_counter()
+        for i in range(0, rows, batch_size):
+            with mgr.batch():
+                for w in wallpapers[i:i + batch_size]:
+                    mgr.save_wallpaper_info(w, size=1024, digest=w.hsh)
+        elapsed = time.perf_counter() - start
+        result["batch_insert_rows_per_sec"] = round(rows / elapsed)
+
+        start = time.perf_counter()
+        for i in range(single_commit_rows):
+            mgr.save_wallpaper_info(make_wallpaper(rows + i))
+        elapsed = time.perf_counter() - start
+        result["single_commit_insert_rows_per_sec"] = round(single_commit_rows / elapsed)
+
+        keys = ["{:032x}".format(random.randrange(rows * 2)) for _ in range(lookups)]
+        start = time.perf_counter()
+        for key in keys:
+            mgr.wallpaper_exist(key)
+        result["point_lookup_per_sec"] = round(lookups / (time.perf_counter() - start))
+
+        start = time.perf_counter()
+        for i in range(0, lookups, 8):
+            mgr.wallpapers_exist(keys[i:i + 8])
+        result["bulk_lookup_8_per_sec"] = round(lookups / (time.perf_counter() - start))
+
+        start = time.perf_counter()
+        for i in range(searches):
+            list(mgr.search_wallpapers(text=WORDS[i % len(WORDS)], limit=20))
+        result["search_top20_ms"] = round((time.perf_counter() - start) / searches * 1000, 3)
+
+        indexed = SqliteBingWallpaperManager(os.path.join(tmp, "bench.db"), hsh_index=True)
+        start = time.perf_counter()
+        indexed.init_db()
+        result["index_load_sec"] = round(time.perf_counter() - start, 4)
+        start = time.perf_counter()
+        for i in range(0, lookups, 8):
+            indexed.wallpapers_exist(keys[i:i + 8])
+        result["indexed_bulk_lookup_8_per_sec"] = round(lookups / (time.perf_counter() - start))
+    return result
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark sqlite wallpaper storage.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--rows', default=100000, type=int, help='Rows to insert')
+    parser.add_argument('--batch-size', default=1000, type=int, help='Rows of one transaction')
+    parser.add_argument('--lookups', default=100000, type=int, help='Hsh to look up, half of them not exist')
+    parser.add_argument('--single-commit-rows', default=2000, type=int,
+                        help='Rows inserted with one transaction each, for comparison')
+    parser.add_argument('--searches', default=200, type=int, help='Full text searches of one word')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    print(json.dumps(bench(args.rows, args.batch_size, args.lookups, args.single_commit_rows,
+                           args.searches)))
@@ -2,14 +2,35 @@
 # -*- coding: utf8 -*-
 
 import argparse
+import dataclasses
+import json
 import logging
 import os
+import signal
+import sys
+import threading
 import time
+from contextlib import ExitStack
 
-from log import init_logging
-from bing_downloader import BingWallpaperDownloader, SqliteBingWallpaperManager, NoBingWallpaperManager, StorageType
-from notify import Notification
+from log import LogFormat, init_logging, log_context, new_correlation_id
+from async_engine import AsyncBingWallpaperEngine
+from backfill import BingWallpaperBackfill
+from bing_client import MetadataCache, WallpaperQuality
+from bing_downloader import BingWallpaperDownloader
+from derivative import DerivativeGenerator, DerivativeSpec
+from blob_store import BlobLinkMode, BlobStore
+from bing_storage import SqliteBingWallpaperManager, NoBingWallpaperManager, StorageType
+from export import BingWallpaperExporter, ExportFormat
+from notify import Notification, QueuedNotification
+from phash import PHashMode, available as phash_available
+from replica import ReplicaCoordinator
+from scheduler import PublicationScheduler
+from serve import WallpaperServer
+from verify import BingWallpaperVerifier
 from env import env_default
+from http_session import HttpSessionPool
+from manifest import Manifest
+from metrics import MetricsServer, NEXT_ROUND, ROUND_DURATION, ROUNDS
 
 
 def get_args():
@@ -18,34 +39,123 @@ def get_args():
         description='A tool to download bing daily wallpaper.',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
+    parser.add_argument('command', nargs='?', default='download',
+                        choices=['download', 'backfill', 'verify', 'query', 'export', 'dedup', 'derive', 'serve'],
+                        help='download: download the latest wallpapers, periodically in service mode; '
+                             'backfill: walk the archive back for backfill-days and exit; '
+                             'verify: check the downloaded files against the database, download the missing and '
+                             'corrupt ones again, save the files not in the database, and exit; '
+                             'query: search the stored wallpapers and print them as json lines; '
+                             'export: write all the stored wallpapers to a file; '
+                             'dedup: move the download path into the blob store of blob-store; '
+                             'derive: generate the derivatives of all the stored wallpapers and exit; '
+                             'serve: only serve the stored wallpapers at serve-port until stopped')
+
     gen_group = parser.add_argument_group('General Options')
     gen_group.add_argument('--service-mode', action='store_true',
                            help='Run as service and periodically scan new wallpaper, otherwise only run once')
     gen_group.add_argument('--scan-interval', default=3600, type=int, action=env_default('BING_SCAN_INTERVAL'),
-                           help='Check new wallpaper every scan-interval millisecond if run in server mode, '
+                           help='Check new wallpaper at least every scan-interval second if run in server mode, '
                                 'env: BING_SCAN_INTERVAL')
+    gen_group.add_argument('--schedule', default='PUBLICATION', choices=['PUBLICATION', 'FIXED'],
+                           action=env_default('BING_SCHEDULE'),
+                           help='FIXED runs every scan-interval, PUBLICATION also polls every poll-interval around '
+                                'the expected publication time of the next wallpaper, env: BING_SCHEDULE')
+    gen_group.add_argument('--poll-interval', default=60, type=int, action=env_default('BING_POLL_INTERVAL'),
+                           help='Second between two rounds around the expected publication time, also the first '
+                                'backoff after a failed round, env: BING_POLL_INTERVAL')
+    gen_group.add_argument('--poll-window', default=1800, type=int, action=env_default('BING_POLL_WINDOW'),
+                           help='Second to poll before and after the expected publication time, '
+                                'env: BING_POLL_WINDOW')
     gen_group.add_argument('--log-path', action=env_default('BING_LOG_PATH'),
                            help='Location for log file, default is stdout, env: BING_LOG_PATH')
     gen_group.add_argument('--log-level', default="INFO", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
                            action=env_default('BING_LOG_LEVEL'), help='Log level, env: BING_LOG_LEVEL')
+    gen_group.add_argument('--log-format', default='TEXT', choices=list(LogFormat), type=LogFormat,
+                           action=env_default('BING_LOG_FORMAT'),
+                           help='JSON writes one object per line with the cycle_id of the round, the image_id of '
+                                'the download and timing fields, env: BING_LOG_FORMAT')
+    gen_group.add_argument('--log-async', default='OFF', choices=['ON', 'OFF'], action=env_default('BING_LOG_ASYNC'),
+                           help='Format and write the log, including the file rollover, from a background thread, '
+                                'the lines are dropped if it falls behind, env: BING_LOG_ASYNC')
+    gen_group.add_argument('--log-sample', default=1, type=int, action=env_default('BING_LOG_SAMPLE'),
+                           help='Only log 1 in log-sample of the lines repeated for every stored wallpaper of every '
+                                'round, env: BING_LOG_SAMPLE')
     gen_group.add_argument('--storage-type', default='SQLITE', choices=list(StorageType),
                            type=StorageType, action=env_default('BING_STORAGE_TYPE'),
                            help='The way to store wallpaper info and check exist, NONE means not store and not check, '
                                 'env: BING_STORAGE_TYPE')
     gen_group.add_argument('--storage-path', default='storage', action=env_default('BING_STORAGE_PATH'),
                            help='Location for database files if storage-type is not NONE, env: BING_STORAGE_PATH')
+    gen_group.add_argument('--hsh-index', default='ON', choices=['ON', 'OFF'], action=env_default('BING_HSH_INDEX'),
+                           help='Load all the stored wallpaper hsh into memory at startup to check exist without '
+                                'querying the database, env: BING_HSH_INDEX')
+    gen_group.add_argument('--meta-cache', default='ON', choices=['ON', 'OFF'], action=env_default('BING_META_CACHE'),
+                           help='Cache the last wallpaper info response in storage-path and skip the round if it is '
+                                'not changed, only works if storage-type is not NONE, env: BING_META_CACHE')
     gen_group.add_argument('--download-path', default="download", action=env_default('BING_DOWNLOAD_PATH'),
                            help='Location for downloaded wallpaper files, env: BING_DOWNLOAD_PATH')
+    gen_group.add_argument('--blob-store', default='OFF', choices=list(BlobLinkMode), type=BlobLinkMode,
+                           action=env_default('BING_BLOB_STORE'),
+                           help='Store every distinct image once under download-path/.blobs, the file names are '
+                                'hard or symbolic links to them, run the dedup command once to move the files '
+                                'already downloaded, env: BING_BLOB_STORE')
+    gen_group.add_argument('--phash', default='OFF', choices=list(PHashMode), type=PHashMode,
+                           action=env_default('BING_PHASH'),
+                           help='Detect the images perceptually close to a stored one by their DCT hash, FLAG records '
+                                'the wallpaper they duplicate, SKIP also removes the file and points the variant at '
+                                'the stored one, requires Pillow, env: BING_PHASH')
+    gen_group.add_argument('--phash-distance', default=8, type=int, action=env_default('BING_PHASH_DISTANCE'),
+                           help='Max bits out of 64 the hashes of two near duplicates differ, env: BING_PHASH_DISTANCE')
     gen_group.add_argument('--download-timeout', default=5000, type=int, action=env_default('BING_DOWNLOAD_TIMEOUT'),
                            help='Download timeout millisecond, env: BING_DOWNLOAD_TIMEOUT')
+    gen_group.add_argument('--download-concurrency', default=4, type=int,
+                           action=env_default('BING_DOWNLOAD_CONCURRENCY'),
+                           help='Max number of wallpapers to download at the same time, env: BING_DOWNLOAD_CONCURRENCY')
     gen_group.add_argument('--max-retries', default=3, type=int, action=env_default('BING_MAX_RETRIES'),
                            help='Times to retry when failed to download, env: BING_MAX_RETRIES')
     gen_group.add_argument('--retry-backoff', default=1000, type=int, action=env_default('BING_RETRY_BACKOFF'),
                            help='Backoff time millisecond to retry if failed, env: BING_RETRY_BACKOFF')
+    gen_group.add_argument('--engine', default='THREAD', choices=['THREAD', 'ASYNCIO'],
+                           action=env_default('BING_ENGINE'),
+                           help='Run the download pipeline on a thread pool or on an asyncio event loop, '
+                                'download-concurrency is the per host limit of the asyncio engine, its http requests '
+                                'still block on http-pool-size threads, env: BING_ENGINE')
+    gen_group.add_argument('--retry-status', default='429,500,502,503,504', action=env_default('BING_RETRY_STATUS'),
+                           help='Comma separated http status codes to retry on, env: BING_RETRY_STATUS')
+    gen_group.add_argument('--http-pool-size', default=10, type=int, action=env_default('BING_HTTP_POOL_SIZE'),
+                           help='Max keep-alive connections kept for each host, env: BING_HTTP_POOL_SIZE')
+    gen_group.add_argument('--http-rate', default=0, type=float, action=env_default('BING_HTTP_RATE'),
+                           help='Max http requests per second of all the requests, 0 means unlimited, '
+                                'env: BING_HTTP_RATE')
+    gen_group.add_argument('--circuit-failures', default=5, type=int, action=env_default('BING_CIRCUIT_FAILURES'),
+                           help='Consecutive failed requests to an endpoint to skip it for circuit-cooldown seconds, '
+                                'or as long as its Retry-After asks, 0 means never, env: BING_CIRCUIT_FAILURES')
+    gen_group.add_argument('--circuit-cooldown', default=30, type=float, action=env_default('BING_CIRCUIT_COOLDOWN'),
+                           help='Seconds to skip a failing endpoint, doubled while it keeps failing, '
+                                'env: BING_CIRCUIT_COOLDOWN')
+    gen_group.add_argument('--adaptive-concurrency', default='ON', choices=['ON', 'OFF'],
+                           action=env_default('BING_ADAPTIVE_CONCURRENCY'),
+                           help='Lower the concurrent requests to an endpoint when its errors or latency grow, '
+                                'and raise them back up to http-pool-size, env: BING_ADAPTIVE_CONCURRENCY')
+    gen_group.add_argument('--metrics-port', default=0, type=int, action=env_default('BING_METRICS_PORT'),
+                           help='Serve prometheus metrics at http://metrics-host:metrics-port/metrics in service mode, '
+                                '0 means disabled, env: BING_METRICS_PORT')
+    gen_group.add_argument('--metrics-host', default='0.0.0.0', action=env_default('BING_METRICS_HOST'),
+                           help='Address to bind the metrics endpoint, env: BING_METRICS_HOST')
 
     bing_group = parser.add_argument_group('Bing Options')
     bing_group.add_argument('--search-zone', default='CN', choices=['CN', 'EN'], action=env_default('BING_SEARCH_ZONE'),
                             help='Search in bing china or international web site, env: BING_SEARCH_ZONE')
+    bing_group.add_argument('--bing-base-url', default='https://www.bing.com', action=env_default('BING_BASE_URL'),
+                            help='Bing web site to get wallpapers from, e.g. a mirror, env: BING_BASE_URL')
+    bing_group.add_argument('--markets', action=env_default('BING_MARKETS'),
+                            help='Comma separated bing markets to download in one round, e.g. zh-CN,en-US,ja-JP, '
+                                 'the market is used as zone and search-zone is ignored if specified, '
+                                 'env: BING_MARKETS')
+    bing_group.add_argument('--qualities', default='UHD_1609', action=env_default('BING_QUALITIES'),
+                            help='Comma separated wallpaper qualities to download, choices: {}, '
+                                 'env: BING_QUALITIES'.format(','.join(q.name for q in WallpaperQuality)))
     bing_group.add_argument('--day-offset', default=0, type=int, choices=range(0, 8),
                             action=env_default('BING_DAY_OFFSET'),
                             help='The num days before today start to get, env: BING_DAY_OFFSET')
@@ -53,6 +163,93 @@ def get_args():
                             action=env_default('BING_DAY_COUNT'),
                             help='The bing API can get up to 8 days of wallpaper before today, env: BING_DAY_COUNT')
 
+    backfill_group = parser.add_argument_group('Backfill Options')
+    backfill_group.add_argument('--backfill-days', default=16, type=int, action=env_default('BING_BACKFILL_DAYS'),
+                                help='Days before today to backfill, resumed from the checkpoint in the database, '
+                                     'env: BING_BACKFILL_DAYS')
+    backfill_group.add_argument('--backfill-window', default=8, type=int, choices=range(1, 9),
+                                action=env_default('BING_BACKFILL_WINDOW'),
+                                help='Days to get in one request, env: BING_BACKFILL_WINDOW')
+    backfill_group.add_argument('--backfill-rate', default=2.0, type=float, action=env_default('BING_BACKFILL_RATE'),
+                                help='Max requests per second to bing of the whole backfill, 0 means unlimited, '
+                                     'env: BING_BACKFILL_RATE')
+    backfill_group.add_argument('--backfill-restart', action='store_true',
+                                help='Ignore the checkpoints and backfill from today again')
+
+    replica_group = parser.add_argument_group('Replica Options')
+    replica_group.add_argument('--replica-claim', default='OFF', choices=['ON', 'OFF'],
+                               action=env_default('BING_REPLICA_CLAIM'),
+                               help='Claim every image in the database before downloading it, so several instances '
+                                    'sharing the storage and download path split the work, the storage must be on '
+                                    'a volume shared by the instances on one host, hsh-index is turned off, '
+                                    'env: BING_REPLICA_CLAIM')
+    replica_group.add_argument('--replica-id', action=env_default('BING_REPLICA_ID'),
+                               help='Unique id of this instance, default is hostname-pid-random, a stable id keeps the '
+                                    'metadata cache of the instance across restarts, env: BING_REPLICA_ID')
+    replica_group.add_argument('--replica-claim-ttl', default=300, type=float,
+                               action=env_default('BING_REPLICA_CLAIM_TTL'),
+                               help='Seconds before the claims of a dead instance are taken over by the others, '
+                                    'env: BING_REPLICA_CLAIM_TTL')
+
+    serve_group = parser.add_argument_group('Serve Options')
+    serve_group.add_argument('--serve-port', default=0, type=int, action=env_default('BING_SERVE_PORT'),
+                             help='Serve the stored wallpapers and a json api at http://serve-host:serve-port in '
+                                  'service mode and with the serve command, 0 means disabled, only works if '
+                                  'storage-type is not NONE, env: BING_SERVE_PORT')
+    serve_group.add_argument('--serve-host', default='0.0.0.0', action=env_default('BING_SERVE_HOST'),
+                             help='Address to bind the server, env: BING_SERVE_HOST')
+    serve_group.add_argument('--serve-cache-size', default=1024, type=int, action=env_default('BING_SERVE_CACHE_SIZE'),
+                             help='Max number of json responses and file lookups cached, env: BING_SERVE_CACHE_SIZE')
+    serve_group.add_argument('--serve-cache-ttl', default=10, type=float, action=env_default('BING_SERVE_CACHE_TTL'),
+                             help='Seconds a cached response may be served, the cache is also dropped after every '
+                                  'download round, env: BING_SERVE_CACHE_TTL')
+
+    derivative_group = parser.add_argument_group('Derivative Options')
+    derivative_group.add_argument('--derivatives', default='', action=env_default('BING_DERIVATIVES'),
+                                  help='Comma separated renditions to generate from every new wallpaper under '
+                                       'download-path/.derivatives, name=WIDTHxHEIGHT[:JPEG|WEBP|AVIF[:QUALITY]] '
+                                       'or a quality name, e.g. thumb=320x180:WEBP:80,FHD_1609, requires Pillow, '
+                                       'only works if storage-type is not NONE, env: BING_DERIVATIVES')
+    derivative_group.add_argument('--derivative-workers', default=0, type=int,
+                                  action=env_default('BING_DERIVATIVE_WORKERS'),
+                                  help='Processes to generate the derivatives, 0 means the number of cores, '
+                                       'env: BING_DERIVATIVE_WORKERS')
+    derivative_group.add_argument('--derive-restart', action='store_true',
+                                  help='Ignore the checkpoint of the derive command and check all the wallpapers')
+
+    verify_group = parser.add_argument_group('Verify Options')
+    verify_group.add_argument('--verify-on-start', default='OFF', choices=['ON', 'OFF'],
+                              action=env_default('BING_VERIFY_ON_START'),
+                              help='Run verify before the first download round, env: BING_VERIFY_ON_START')
+    verify_group.add_argument('--verify-digest', default='ON', choices=['ON', 'OFF'],
+                              action=env_default('BING_VERIFY_DIGEST'),
+                              help='Compare the sha256 of the files with the database, only the new and changed '
+                                   'files since the last verify are hashed, otherwise only compare the sizes, '
+                                   'env: BING_VERIFY_DIGEST')
+
+    query_group = parser.add_argument_group('Query Options')
+    query_group.add_argument('--query-text',
+                             help='Words to search in title, caption, desc and copyright, all of them must match')
+    query_group.add_argument('--query-start-date', help='Only the wallpapers since the date, e.g. 20200229')
+    query_group.add_argument('--query-end-date', help='Only the wallpapers until the date, inclusive')
+    query_group.add_argument('--query-zone', help='Only the wallpapers of the zone, e.g. CN, EN or a market')
+    query_group.add_argument('--query-limit', default=100, type=int, help='Max number of wallpapers to print')
+
+    export_group = parser.add_argument_group('Export Options')
+    export_group.add_argument('--export-format', default='JSONL', choices=list(ExportFormat), type=ExportFormat,
+                              help='PARQUET requires pyarrow')
+    export_group.add_argument('--export-output', default='-',
+                              help='File to export to, replaced when the export finished, - means stdout')
+    export_group.add_argument('--export-since',
+                              help='Only export the wallpapers saved after the time, e.g. "2024-01-01 00:00:00" UTC')
+    export_group.add_argument('--export-watermark',
+                              help='Name of an incremental export, only the wallpapers saved since the last export '
+                                   'of the same name are exported')
+    export_group.add_argument('--export-checksum', default='OFF', choices=['ON', 'OFF'],
+                              help='Add the size and sha256 of the image file of every wallpaper')
+    export_group.add_argument('--export-batch-size', default=1000, type=int,
+                              help='Wallpapers read and written at a time, bounds the memory')
+
     notify_group = parser.add_argument_group('Notify Options')
     notify_group.add_argument('--notify-mail', action=env_default('BING_NOTIFY_MAIL'),
                               help='send email to this address after download, env: BING_NOTIFY_MAIL')
@@ -64,15 +261,65 @@ def get_args():
                               help='notify user name to send email, env: BING_NOTIFY_USER_NAME')
     notify_group.add_argument('--server-chan-key', action=env_default('BING_SERVER_CHAN_KEY'),
                               help='server-chan token to notify, env: BING_SERVER_CHAN_KEY')
+    notify_group.add_argument('--notify-mode', default='QUEUE', choices=['QUEUE', 'SYNC'],
+                              action=env_default('BING_NOTIFY_MODE'),
+                              help='QUEUE sends one digest of each round from a background thread, SYNC sends every '
+                                   'notification at once in the download path, env: BING_NOTIFY_MODE')
 
     args = parser.parse_args()
     return args
 
 
+def query(args, wallpaper_mgr: SqliteBingWallpaperManager):
+    hits = wallpaper_mgr.search_wallpapers(text=args.query_text,
+                                           start_date=args.query_start_date,
+                                           end_date=args.query_end_date,
+                                           zone=args.query_zone,
+                                           limit=args.query_limit)
+    for hit in hits:
+        sys.stdout.write(json.dumps(dict(hit.wallpaper.asdict(), rank=hit.rank), ensure_ascii=False) + "\n")
+    sys.stdout.flush()
+
+
+def start_server(args) -> WallpaperServer:
+    if args.storage_type == StorageType.NONE or args.serve_port <= 0:
+        logging.error("args error, must specify serve_port and a storage_type other than NONE to serve")
+        return None
+    # a connection of its own, the requests are not serialized with the writes of the downloader
+    reader = SqliteBingWallpaperManager(os.path.join(args.storage_path, "bing.db"))
+    reader.init_db()
+    server = WallpaperServer(reader, args.download_path, args.serve_host, args.serve_port,
+                             cache_size=args.serve_cache_size, cache_ttl=args.serve_cache_ttl)
+    server.start()
+    return server
+
+
 def run():
     args = get_args()
 
-    init_logging(args.log_path, args.log_level)
+    # stdout is for the results of query and export
+    to_stdout = args.command == 'query' or (args.command == 'export' and args.export_output == '-')
+    init_logging(args.log_path, args.log_level, sys.stderr if to_stdout else None, log_format=args.log_format,
+                 async_queue=args.log_async == 'ON', sample=args.log_sample)
+    with ExitStack() as resources:
+        run_command(args, resources)
+
+
+def run_command(args, resources: ExitStack):
+    """
+
+    :param resources: closes what is opened, in reverse order, however the command returns
+    """
+    retry_status = tuple(int(code) for code in args.retry_status.split(',') if code.strip())
+    session = HttpSessionPool(pool_size=max(args.http_pool_size, args.download_concurrency),
+                              max_retries=args.max_retries,
+                              retry_backoff_ms=args.retry_backoff,
+                              retry_status=retry_status,
+                              rate=args.http_rate,
+                              circuit_failures=args.circuit_failures,
+                              circuit_cooldown=args.circuit_cooldown,
+                              adaptive_concurrency=args.adaptive_concurrency == 'ON')
+    resources.callback(session.close)
 
     notify = None
     if args.notify_mail:
@@ -81,18 +328,83 @@ def run():
             return
         notify = Notification(my_mail=args.notify_user_mail, my_password=args.notify_user_pass,
                               my_name=args.notify_user_name, to_mail=args.notify_mail,
-                              server_chan_key=args.server_chan_key)
+                              server_chan_key=args.server_chan_key,
+                              session=session)
+        if args.notify_mode == 'QUEUE':
+            notify = QueuedNotification(notify, max_retries=args.max_retries, retry_backoff=args.retry_backoff / 1000)
+        resources.callback(notify.close)
 
     if args.storage_type == StorageType.SQLITE:
         if not os.path.exists(args.storage_path):
             os.makedirs(args.storage_path)
         db_file = os.path.join(args.storage_path, "bing.db")
-        wallpaper_mgr = SqliteBingWallpaperManager(db_file)
+        # the index would miss the wallpapers saved by the other replicas
+        wallpaper_mgr = SqliteBingWallpaperManager(db_file, hsh_index=args.hsh_index == 'ON' and
+                                                   args.replica_claim == 'OFF')
         wallpaper_mgr.init_db()
     else:
         wallpaper_mgr = NoBingWallpaperManager()
 
+    if args.command == 'query':
+        if args.storage_type == StorageType.NONE:
+            logging.error("args error, can not query if storage_type is NONE")
+            return
+        query(args, wallpaper_mgr)
+        return
+
+    if args.command == 'serve':
+        server = start_server(args)
+        if server is None:
+            return
+        resources.callback(server.close)
+        stopped = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+        signal.signal(signal.SIGINT, lambda *_: stopped.set())
+        stopped.wait()
+        logging.info("stopped, exit")
+        return
+
+    coordinator = None
+    if args.replica_claim == 'ON':
+        if args.storage_type == StorageType.NONE:
+            logging.error("args error, can not claim images if storage_type is NONE")
+            return
+        coordinator = ReplicaCoordinator(wallpaper_mgr, replica_id=args.replica_id, ttl=args.replica_claim_ttl)
+        resources.callback(coordinator.close)
+        logging.info("replica id: %s", coordinator.replica_id)
+
+    meta_cache = None
+    if args.storage_type != StorageType.NONE and args.meta_cache == 'ON':
+        # every replica handles the responses by itself, and keeps its own cache instead of rewriting a shared one
+        cache_name = "meta_cache.{}.json".format(coordinator.replica_id) if coordinator else "meta_cache.json"
+        meta_cache = MetadataCache(os.path.join(args.storage_path, cache_name))
+
     en_search = False if args.search_zone == 'CN' else True
+    markets = [m.strip() for m in args.markets.split(',') if m.strip()] if args.markets else None
+    try:
+        qualities = [WallpaperQuality[q.strip()] for q in args.qualities.split(',') if q.strip()]
+    except KeyError as e:
+        logging.error("args error, unknown quality %s", e)
+        return
+    derivatives = None
+    if args.derivatives:
+        if args.storage_type == StorageType.NONE:
+            logging.error("args error, can not generate derivatives if storage_type is NONE")
+            return
+        try:
+            derivatives = DerivativeGenerator(wallpaper_mgr, args.download_path,
+                                              DerivativeSpec.parse_list(args.derivatives),
+                                              workers=args.derivative_workers)
+        except Exception as e:
+            logging.error("args error, %s", e)
+            return
+        resources.callback(derivatives.close)
+    blob_store = None
+    if args.blob_store != BlobLinkMode.OFF:
+        blob_store = BlobStore(args.download_path, args.blob_store)
+    if args.phash != PHashMode.OFF and not phash_available():
+        logging.warning("Pillow is not installed, near duplicate detection is disabled, pip install Pillow")
+        args.phash = PHashMode.OFF
     bing_downloader = BingWallpaperDownloader(en_search=en_search,
                                               download_offset=args.day_offset,
                                               download_cnt=args.day_count,
@@ -100,17 +412,125 @@ def run():
                                               max_retries=args.max_retries,
                                               retry_backoff_ms=args.retry_backoff,
                                               download_timeout_ms=args.download_timeout,
+                                              download_concurrency=args.download_concurrency,
                                               notify=notify,
-                                              wallpaper_mgr=wallpaper_mgr)
+                                              wallpaper_mgr=wallpaper_mgr,
+                                              session=session,
+                                              meta_cache=meta_cache,
+                                              markets=markets,
+                                              qualities=qualities,
+                                              bing_base_url=args.bing_base_url,
+                                              coordinator=coordinator,
+                                              blob_store=blob_store,
+                                              phash_mode=args.phash,
+                                              phash_distance=args.phash_distance,
+                                              derivatives=derivatives)
+
+    if args.command == 'export':
+        if args.storage_type == StorageType.NONE:
+            logging.error("args error, can not export if storage_type is NONE")
+            return
+        manifest = None
+        if args.export_checksum == 'ON':
+            manifest = Manifest(args.download_path, os.path.join(args.storage_path, "manifest.json"))
+        exporter = BingWallpaperExporter(wallpaper_mgr, batch_size=args.export_batch_size, manifest=manifest,
+                                         downloader=bing_downloader, download_path=args.download_path,
+                                         concurrency=args.download_concurrency)
+        try:
+            exporter.export(args.export_output, args.export_format,
+                            updated_after=args.export_since,
+                            watermark_name=args.export_watermark)
+        except Exception as e:
+            logging.error("failed to export, msg: %s", e)
+        return
+
+    if args.command == 'dedup':
+        if blob_store is None:
+            logging.error("args error, must specify blob_store to dedup")
+            return
+        manifest = Manifest(args.download_path, os.path.join(args.storage_path, "manifest.json"))
+        blob_store.dedup(manifest)
+        return
+
+    if args.command == 'derive':
+        if derivatives is None:
+            logging.error("args error, must specify derivatives to derive")
+            return
+        derivatives.backfill(restart=args.derive_restart)
+        return
+
+    if args.command == 'verify' or args.verify_on_start == 'ON':
+        if args.storage_type == StorageType.NONE:
+            logging.error("args error, can not verify if storage_type is NONE")
+            return
+        manifest = Manifest(args.download_path, os.path.join(args.storage_path, "manifest.json"))
+        verifier = BingWallpaperVerifier(bing_downloader, wallpaper_mgr, args.download_path, manifest,
+                                         check_digest=args.verify_digest == 'ON',
+                                         concurrency=args.download_concurrency)
+        verifier.run()
+        if args.command == 'verify':
+            return
+
+    if args.command == 'backfill':
+        backfill = BingWallpaperBackfill(bing_downloader, wallpaper_mgr,
+                                         days=args.backfill_days,
+                                         window=args.backfill_window,
+                                         rate=args.backfill_rate,
+                                         concurrency=args.download_concurrency,
+                                         restart=args.backfill_restart)
+        with log_context(cycle_id=new_correlation_id()):
+            backfill.run()
+        session.log_stats()
+        return
+
+    engine = None
+    if args.engine == 'ASYNCIO':
+        engine = AsyncBingWallpaperEngine([bing_downloader], per_host_limit=args.download_concurrency,
+                                          io_workers=args.http_pool_size)
+        resources.callback(engine.close)
+
+    if args.schedule == 'PUBLICATION':
+        scheduler = PublicationScheduler(max_interval=args.scan_interval, poll_interval=args.poll_interval,
+                                         poll_window=args.poll_window)
+        # the rounds only return the changed wallpapers, after a restart the stored ones tell the publication times
+        scheduler.observe([dataclasses.replace(w, zone=zone) for zone, w in wallpaper_mgr.latest_wallpapers()])
+    else:
+        scheduler = PublicationScheduler(max_interval=args.scan_interval, poll_interval=args.scan_interval,
+                                         poll_window=0, jitter=0)
+    server = None
+    if args.service_mode:
+        scheduler.install_signal_handlers()
+        if args.serve_port > 0:
+            server = start_server(args)
+            if server is None:
+                return
+            resources.callback(server.close)
+        if args.metrics_port > 0:
+            metrics_server = MetricsServer(args.metrics_host, args.metrics_port)
+            metrics_server.start()
+            resources.callback(metrics_server.close)
 
     while True:
-        bing_downloader.download()
+        start = time.time()
+        with log_context(cycle_id=new_correlation_id()):
+            rounds = engine.run() if engine else [bing_downloader.download()]
+            duration = time.time() - start
+            ROUND_DURATION.observe(duration)
+            success = all(r.failed == 0 for r in rounds)
+            ROUNDS.inc(result="success" if success else "failure")
+            logging.info("round finished, %d wallpapers, %d failed", sum(len(r.wallpapers) for r in rounds),
+                         sum(r.failed for r in rounds), extra={"duration_ms": round(duration * 1000, 1)})
+            if server:
+                server.invalidate()
+            session.log_stats()
         if not args.service_mode: break
 
-        logging.info("wait for next round after %d second", args.scan_interval)
-        try:
-            time.sleep(args.scan_interval)
-        except InterruptedError:
+        if args.schedule == 'PUBLICATION':
+            for r in rounds:
+                scheduler.observe(r.wallpapers)
+        NEXT_ROUND.set(scheduler.plan(success=success))
+        if not scheduler.wait():
+            logging.info("stopped, exit")
             break
 
 
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+import asyncio
+import functools
+import logging
+from concurrent.futures import Executor, ThreadPoolExecutor
+
+from bing_client import BingWallpaperClient, BingWallpaperInfo, MetadataCache, MetadataCacheEntry
+from bing_downloader import BingWallpaperDownloader, DownloadRound, DownloadTask
+from file_util import DownloadedFile
+from log import bind_log_context
+
+
+class AsyncBingWallpaperClient(object):
+    """
+    Awaitable interface of BingWallpaperClient. It is a thin shim, not a non-blocking client: every call runs the
+    blocking requests of the wrapped client on a thread of the executor, one thread for each request in flight.
+    """
+
+    def __init__(self, client: BingWallpaperClient = None, executor: Executor = None):
+        """
+
+        :param executor: runs the requests, default is the default executor of the running loop
+        """
+        self._client = client if client else BingWallpaperClient()
+        self._executor = executor
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, bind_log_context(functools.partial(func, *args, **kwargs)))
+
+    async def get_wallpaper_info(self, **kwargs) -> list[BingWallpaperInfo]:
+        return await self._run(self._client.get_wallpaper_info, **kwargs)
+
+    async def get_wallpaper_info_if_changed(self, cache: MetadataCache,
+                                            **kwargs) -> tuple[list[BingWallpaperInfo], MetadataCacheEntry]:
+        return await self._run(self._client.get_wallpaper_info_if_changed, cache, **kwargs)
+
+
+class AsyncBingWallpaperEngine(object):
+    """
+    Runs the download pipeline of several BingWallpaperDownloader on one event loop: the markets of all the
+    downloaders are fetched at once, the image downloads of all of them share a per-host concurrency limit, and the
+    sqlite writes and notifications are pushed to a single storage thread. The http requests still block, they run
+    on the io threads, so the engine does not need fewer threads than the thread pool one, it only schedules the
+    downloads of several downloaders together.
+    """
+
+    def __init__(self, downloaders: list[BingWallpaperDownloader], per_host_limit: int = 4, io_workers: int = 8):
+        """
+
+        :param downloaders: e.g. one for each storage or download path, markets and qualities of each are handled
+                            by the downloader itself
+        :param per_host_limit: max number of concurrent downloads from one host
+        :param io_workers: threads running the blocking http requests, one for each request in flight, more than
+                           per_host_limit to let the metadata requests and the downloads from other hosts go on
+        """
+        self._downloaders = downloaders
+        self._per_host_limit = max(1, per_host_limit)
+        self._io_executor = ThreadPoolExecutor(max_workers=max(io_workers, self._per_host_limit),
+                                               thread_name_prefix="bing-io")
+        # sqlite connections and the smtp client are used from this thread only, which keeps them serialized
+        self._storage_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bing-storage")
+        self._host_limits = {}
+
+    # run_in_executor does not pass the log context to the thread
+    async def _run_io(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._io_executor, bind_log_context(functools.partial(func, *args)))
+
+    async def _run_storage(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._storage_executor, bind_log_context(functools.partial(func, *args)))
+
+    def _host_limit(self, host: str) -> asyncio.Semaphore:
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self._per_host_limit)
+        return self._host_limits[host]
+
+    async def _download_task(self, downloader: BingWallpaperDownloader,
+                             task: DownloadTask) -> tuple[DownloadTask, DownloadedFile]:
+        async with self._host_limit(task.host):
+            # claimed once it may start, see BingWallpaperDownloader.download_task
+            claimed, _ = await self._run_storage(downloader.claim_downloads, [task])
+            if not claimed:
+                return task, None
+            task = claimed[0]
+            return task, await self._run_io(downloader.download_one_img, task.wallpaper, task.quality)
+
+    async def download_one(self, downloader: BingWallpaperDownloader) -> DownloadRound:
+        try:
+            results = await asyncio.gather(*(self._run_io(downloader.fetch_market, market)
+                                             for market in downloader.markets), return_exceptions=True)
+            wallpapers, cache_entries, fetch_failed = downloader.collect_wallpapers(results)
+            if not wallpapers:
+                if fetch_failed == 0:
+                    logging.info("[AsyncEngine] no changed wallpaper info, skip")
+                return DownloadRound(wallpapers=[], failed=fetch_failed)
+
+            tasks, zones = await self._run_storage(downloader.plan_downloads, wallpapers)
+            try:
+                results = await asyncio.gather(*(self._download_task(downloader, task) for task in tasks),
+                                               return_exceptions=True)
+                failed = 0
+                deferred = 0
+                downloaded = []
+                for task, result in zip(tasks, results):
+                    if isinstance(result, BaseException):
+                        failed += 1
+                        await self._run_storage(downloader.notify_error, task.wallpaper,
+                                                "quality: {}, {}".format(task.quality.name, result))
+                    elif result[1] is None:
+                        deferred += 1
+                    else:
+                        downloaded.append(result)
+
+                saved, save_failed = await self._run_storage(downloader.save_downloads, downloaded, zones)
+            finally:
+                await self._run_storage(downloader.release_downloads, tasks)
+            await self._run_storage(downloader.finish_round, saved, cache_entries, failed + save_failed, deferred)
+            return DownloadRound(wallpapers=wallpapers, failed=fetch_failed + failed + save_failed)
+        except Exception as e:
+            logging.error("[AsyncEngine] failed to download, msg: %s", e)
+            return DownloadRound(wallpapers=[], failed=1)
+
+    async def download(self) -> list[DownloadRound]:
+        # semaphores belong to the running loop, create them for every round
+        self._host_limits = {}
+        return await asyncio.gather(*(self.download_one(downloader) for downloader in self._downloaders))
+
+    def run(self) -> list[DownloadRound]:
+        """
+        Sync entry, run one round of all the downloaders.
+        """
+        return asyncio.run(self.download())
+
+    def close(self):
+        self._io_executor.shutdown(wait=True)
+        self._storage_executor.shutdown(wait=True)
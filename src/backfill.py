@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+import logging
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+
+from bing_client import BingWallpaperInfo
+from bing_downloader import BingWallpaperDownloader, DownloadRound, DownloadTask
+from bing_storage import BingWallpaperManager
+from file_util import DownloadedFile
+from http_session import RateLimiter
+from log import bind_log_context
+
+
+@dataclass
+class BackfillWindow(object):
+    idx: int
+    num: int
+    wallpapers: list[BingWallpaperInfo]
+    zones: list[BingWallpaperInfo]
+    futures: list[tuple[DownloadTask, Future]]
+    # tasks left to the other replicas
+    deferred: int = 0
+
+    @property
+    def end(self) -> int:
+        return self.idx + self.num
+
+
+class BingWallpaperBackfill(object):
+    """
+    Walks the idx/num windows of HPImageArchive back from today for every market, while the images of the fetched
+    windows are downloaded by a pool. A window is saved, and the progress of the market checkpointed in the same
+    transaction, once all of its images are downloaded, in window order, so a crashed backfill resumes from the
+    first window not saved. All the requests share one rate budget.
+    """
+
+    CHECKPOINT_PREFIX = "backfill:"
+    # windows fetched but not saved yet, bounds the memory when the downloads are slower than the fetches
+    MAX_PENDING_WINDOWS = 2
+
+    def __init__(self,
+                 downloader: BingWallpaperDownloader,
+                 wallpaper_mgr: BingWallpaperManager,
+                 days: int = 16,
+                 window: int = 8,
+                 rate: float = 1.0,
+                 concurrency: int = 4,
+                 restart: bool = False):
+        """
+
+        :param downloader: the markets, qualities and download path of the backfill
+        :param wallpaper_mgr: the storage of the downloader, also keeps the checkpoints
+        :param days: how many days before today to backfill
+        :param window: days of one HPImageArchive request, bing returns at most 8
+        :param rate: requests per second of all the metadata and image requests, 0 means unlimited
+        :param concurrency: max number of images to download at the same time
+        :param restart: ignore the checkpoints and start from today again
+        """
+        self._downloader = downloader
+        self._wallpaper_mgr = wallpaper_mgr
+        self._days = days
+        self._window = max(1, min(window, 8))
+        self._limiter = RateLimiter(rate)
+        self._concurrency = max(1, concurrency)
+        self._restart = restart
+
+    def checkpoint_name(self, market: str) -> str:
+        return BingWallpaperBackfill.CHECKPOINT_PREFIX + self._downloader.market_name(market)
+
+    def _download(self, task: DownloadTask) -> tuple[DownloadTask, DownloadedFile]:
+        self._limiter.acquire()
+        return self._downloader.download_task(task)
+
+    def _save_window(self, market: str, window: BackfillWindow, checkpoint: bool) -> int:
+        """
+
+        :param checkpoint: advance the checkpoint to the end of the window if all of its images are saved, and none
+                           of them was left to the other replicas
+        :return: the number of failed images
+        """
+        failed = 0
+        downloaded = []
+        for task, future in window.futures:
+            try:
+                task, file = future.result()
+                if file:
+                    downloaded.append((task, file))
+                else:
+                    window.deferred += 1
+            except Exception as e:
+                failed += 1
+                self._downloader.notify_error(task.wallpaper, "quality: {}, {}".format(task.quality.name, e))
+
+        try:
+            with self._wallpaper_mgr.batch():
+                saved, save_failed = self._downloader.save_downloads(downloaded, window.zones)
+                failed += save_failed
+                if checkpoint and failed == 0 and window.deferred == 0:
+                    done = window.end >= self._days
+                    self._wallpaper_mgr.save_checkpoint(self.checkpoint_name(market), {"next_idx": window.end})
+                    logging.info("[Backfill] market: %s, checkpoint idx %d%s", self._downloader.market_name(market),
+                                 window.end, ", done" if done else "")
+        finally:
+            self._downloader.release_downloads([task for task, _ in window.futures])
+        self._downloader.finish_round(saved, [], failed)
+        return failed
+
+    def backfill_market(self, market: str, executor: ThreadPoolExecutor) -> DownloadRound:
+        name = self._downloader.market_name(market)
+        checkpoint = {} if self._restart else self._wallpaper_mgr.load_checkpoint(self.checkpoint_name(market)) or {}
+        idx = checkpoint.get("next_idx", 0)
+        if checkpoint.get("exhausted") or idx >= self._days:
+            logging.info("[Backfill] market: %s, nothing to backfill before idx %d", name, self._days)
+            return DownloadRound(wallpapers=[], failed=0)
+        logging.info("[Backfill] market: %s, backfill from idx %d to %d", name, idx, self._days)
+
+        pending = deque()
+        wallpapers = []
+        seen_dates = set()
+        failed = 0
+        deferred = 0
+        exhausted = False
+
+        def save_head():
+            nonlocal failed, deferred
+            # once a window failed, or was partly left to the other replicas which may die, the checkpoint stays
+            # before it, the later windows are saved but retried later
+            window = pending.popleft()
+            failed += self._save_window(market, window, checkpoint=failed == 0 and deferred == 0)
+            deferred += window.deferred
+
+        while idx < self._days and failed == 0:
+            num = min(self._window, self._days - idx)
+            self._limiter.acquire()
+            try:
+                items = self._downloader.fetch_window(market, idx, num)
+            except Exception as e:
+                logging.error("[Backfill] failed to get wallpaper info, market: %s, idx: %d, msg: %s", name, idx, e)
+                failed += 1
+                break
+
+            # bing clamps the windows beyond its archive to the last one, nothing new means the archive is exhausted
+            items = [w for w in items if w.startdate not in seen_dates]
+            if not items:
+                exhausted = True
+                break
+            seen_dates.update(w.startdate for w in items)
+            wallpapers.extend(items)
+
+            tasks, zones = self._downloader.plan_downloads(items)
+            futures = [(task, executor.submit(bind_log_context(self._download), task)) for task in tasks]
+            pending.append(BackfillWindow(idx=idx, num=num, wallpapers=items, zones=zones, futures=futures))
+            idx += num
+
+            while pending and all(f.done() for _, f in pending[0].futures):
+                save_head()
+            if len(pending) >= BingWallpaperBackfill.MAX_PENDING_WINDOWS:
+                wait([f for _, f in pending[0].futures])
+                save_head()
+
+        while pending:
+            save_head()
+        if exhausted and failed == 0 and deferred == 0:
+            self._wallpaper_mgr.save_checkpoint(self.checkpoint_name(market), {"next_idx": idx, "exhausted": True})
+            logging.info("[Backfill] market: %s, archive exhausted at idx %d", name, idx)
+        logging.info("[Backfill] market: %s, %d wallpapers, %d failed", name, len(wallpapers), failed)
+        return DownloadRound(wallpapers=wallpapers, failed=failed)
+
+    def run(self) -> DownloadRound:
+        """
+        Backfill the markets one by one, so a wallpaper shared by several markets is only downloaded once.
+        """
+        wallpapers = []
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self._concurrency, thread_name_prefix="bing-backfill") as executor:
+            for market in self._downloader.markets:
+                r = self.backfill_market(market, executor)
+                wallpapers.extend(r.wallpapers)
+                failed += r.failed
+        logging.info("[Backfill] finished, %d wallpapers, %d failed", len(wallpapers), failed)
+        return DownloadRound(wallpapers=wallpapers, failed=failed)
@@ -2,14 +2,21 @@
 # -*- coding: utf8 -*-
 
 import dataclasses
+import hashlib
+import logging
+import os
+import re
+import threading
 import time
-import requests
 import json
 from enum import Enum, auto
 from dataclasses import dataclass
 
 from requests import RequestException
-from requests.adapters import HTTPAdapter, Retry
+
+from file_util import write_file_atomic
+from http_session import HttpSessionPool
+from metrics import OPERATION_DURATION
 
 
 class WallpaperQuality(Enum):
@@ -61,10 +68,75 @@ class BingWallpaperInfo:
     def tojson(self) -> str:
         return json.dumps(self.asdict(), ensure_ascii=False)
 
+    @staticmethod
+    def fromjson(data: str):
+        """
+        Parse the output of tojson, the fields missing from the bing response are saved as null.
+        """
+        return BingWallpaperInfo.fromdict({k: v for k, v in json.loads(data).items() if v is not None})
+
     def digest_str(self) -> str:
         return "[date: {}, hsh: {}, title: {}, url: {}]".format(self.startdate, self.hsh, self.title, self.url)
 
 
+@dataclass
+class MetadataCacheEntry:
+    key: str
+    digest: str
+    etag: str = None
+    last_modified: str = None
+
+
+class MetadataCache(object):
+    """
+    Keeps the digest and validators of the last fully processed HPImageArchive response for each set of request
+    params in a json file, so unchanged responses can be detected and skipped.
+    """
+
+    def __init__(self, cache_file: str):
+        self._cache_file = cache_file
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, "r") as file:
+                    self._entries = json.load(file)
+            except (OSError, ValueError) as e:
+                logging.warning("[MetadataCache] ignore invalid cache file %s, %s", cache_file, e)
+
+    @staticmethod
+    def make_key(params: dict, qualities: list[WallpaperQuality] = None) -> str:
+        """
+
+        :param qualities: downloaded from the response, an unchanged response is handled again when one is added
+        """
+        # the cache-buster changes on every request and is not part of the key
+        key = {k: v for k, v in params.items() if k != "nc"}
+        if qualities:
+            key["qualities"] = sorted(q.name for q in qualities)
+        return json.dumps(key, sort_keys=True)
+
+    def get(self, key: str) -> MetadataCacheEntry:
+        with self._lock:
+            entry = self._entries.get(key)
+        return MetadataCacheEntry(key=key, **entry) if entry else None
+
+    def put(self, entry: MetadataCacheEntry):
+        with self._lock:
+            self._entries[entry.key] = {"digest": entry.digest, "etag": entry.etag,
+                                        "last_modified": entry.last_modified}
+            data = json.dumps(self._entries, indent=2).encode()
+            write_file_atomic(self._cache_file, [data])
+
+    def clear(self):
+        """
+        Forget all the responses, the next fetch of every market handles its response again.
+        """
+        with self._lock:
+            self._entries = {}
+            write_file_atomic(self._cache_file, [b"{}"])
+
+
 class BingWallpaperClient(object):
     BING_BASE_URL = "https://www.bing.com"
     BING_ARCHIVE_RUL = BING_BASE_URL + "/HPImageArchive.aspx"
@@ -77,30 +149,42 @@ class BingWallpaperClient(object):
         WallpaperQuality.UHD_1609: [3840, 2160],
         WallpaperQuality.UHD_1610: [3840, 2400]
     }
+    # the quality of the image url returned by get_wallpaper_info
+    DEFAULT_QUALITY = WallpaperQuality.UHD_1609
 
-    def __init__(self, timeout: int = 3000, max_retries: int = 3, backoff: int = 1000):
+    def __init__(self, timeout: int = 3000, max_retries: int = 3, backoff: int = 1000,
+                 session: HttpSessionPool = None, base_url: str = None):
         """
 
         :param timeout: millisecond
         :param max_retries:
         :param backoff: millisecond
+        :param session: shared http session, a private one is created if not specified
+        :param base_url: bing web site, e.g. a mirror or a local stand-in server, default is BING_BASE_URL
         """
+        self._base_url = base_url.rstrip('/') if base_url else BingWallpaperClient.BING_BASE_URL
+        self._archive_url = self._base_url + "/HPImageArchive.aspx" if base_url \
+            else BingWallpaperClient.BING_ARCHIVE_RUL
         self._timeout = timeout / 1000
         self._max_retries = max_retries
         self._backoff = backoff / 1000
+        self._session = session if session else HttpSessionPool(max_retries=max_retries, retry_backoff_ms=backoff)
 
+    @OPERATION_DURATION.time(operation="get_wallpaper_info")
     def get_wallpaper_info(self,
                            quality: WallpaperQuality = WallpaperQuality.UHD_1609,
                            idx: int = 0,
                            num: int = 8,
                            en_search: bool = True,
+                           market: str = None,
                            **kwargs) -> list[BingWallpaperInfo]:
         """
 
         :param quality: wallpaper quality
         :param idx: the day from today
         :param num: number of images to get, max is 8
-        :param en_search: search en bing
+        :param en_search: search en bing, ignored if market is specified
+        :param market: bing market such as zh-CN, en-US, ja-JP, also used as the zone of the wallpapers
         :return:
         """
 
@@ -165,35 +249,99 @@ class BingWallpaperClient(object):
             }
         }
         """
+        params = self._build_params(quality, idx, num, en_search, market, **kwargs)
+        response = self._session.get(self._archive_url, params=params, timeout=self._timeout)
+        if response.status_code != 200:
+            raise RequestException('status code: {}'.format(response.status_code))
+
+        return self._parse_wallpaper_info(response.json(), en_search, market, self._base_url)
+
+    @OPERATION_DURATION.time(operation="get_wallpaper_info")
+    def get_wallpaper_info_if_changed(self,
+                                      cache: MetadataCache,
+                                      quality: WallpaperQuality = WallpaperQuality.UHD_1609,
+                                      idx: int = 0,
+                                      num: int = 8,
+                                      en_search: bool = True,
+                                      market: str = None,
+                                      qualities: list[WallpaperQuality] = None,
+                                      **kwargs) -> tuple[list[BingWallpaperInfo], MetadataCacheEntry]:
+        """
+        Same as get_wallpaper_info, but send the cached validators and compare the payload digest with the cached
+        one, the caller should `cache.put` the returned entry after all the wallpapers have been handled.
+
+        :param qualities: the qualities the caller downloads, see MetadataCache.make_key
+        :return: (None, None) if the response not changed since the cached one
+        """
+        params = self._build_params(quality, idx, num, en_search, market, **kwargs)
+        key = MetadataCache.make_key(params, qualities)
+        cached = cache.get(key)
+
+        headers = {}
+        if cached and cached.etag:
+            headers["If-None-Match"] = cached.etag
+        if cached and cached.last_modified:
+            headers["If-Modified-Since"] = cached.last_modified
+        response = self._session.get(self._archive_url, params=params, headers=headers,
+                                     timeout=self._timeout)
+        if response.status_code == 304 and cached:
+            return None, None
+        if response.status_code != 200:
+            raise RequestException('status code: {}'.format(response.status_code))
+
+        digest = hashlib.sha256(response.content).hexdigest()
+        if cached and cached.digest == digest:
+            return None, None
+
+        entry = MetadataCacheEntry(key=key, digest=digest, etag=response.headers.get("ETag"),
+                                   last_modified=response.headers.get("Last-Modified"))
+        return self._parse_wallpaper_info(response.json(), en_search, market, self._base_url), entry
+
+    @staticmethod
+    def variant_url(url: str, quality: WallpaperQuality) -> str:
+        """
+        Rewrite the w/h params of a UHD image url to get the image of another quality.
+        """
+        width, height = BingWallpaperClient.WALLPAPER_WH[quality]
+        for name, value in (("w", width), ("h", height)):
+            url, count = re.subn(r"([?&]{}=)\d+".format(name), r"\g<1>{}".format(value), url)
+            if count == 0:
+                url += "&{}={}".format(name, value)
+        return url
+
+    @staticmethod
+    def _build_params(quality: WallpaperQuality, idx: int, num: int, en_search: bool, market: str,
+                      **kwargs) -> dict:
         params = {
             "format": "js",
             "idx": idx,
             "n": num,
-            "nc": int(time.time() / 1000),
+            # millisecond timestamp, a different value for every request
+            "nc": int(time.time() * 1000),
             "pid": "hp",
-            "ensearch": 1 if en_search else 0,
+            "ensearch": 1 if en_search and not market else 0,
             "quiz": 1,
             "og": 1,
             "uhd": 1,
             "uhdwidth": BingWallpaperClient.WALLPAPER_WH[quality][0],
             "uhdheight": BingWallpaperClient.WALLPAPER_WH[quality][1],
         }
-        for k, v in kwargs:
+        if market:
+            params["mkt"] = market
+        for k, v in kwargs.items():
             params[k] = v
+        return params
 
-        s = requests.Session()
-        retries = Retry(total=self._max_retries, backoff_factor=self._backoff)
-        s.mount('https://', HTTPAdapter(max_retries=retries))
-
-        response = s.get(BingWallpaperClient.BING_ARCHIVE_RUL, params=params, timeout=self._timeout)
-        if response.status_code != 200:
-            raise RequestException('status code: {}'.format(response.status_code))
-
-        data = response.json()
+    @staticmethod
+    def _parse_wallpaper_info(data: dict, en_search: bool, market: str,
+                              base_url: str = BING_BASE_URL) -> list[BingWallpaperInfo]:
         wallpapers = []
         for img in data['images']:
-            img['zone'] = 'EN' if en_search else 'CN'
-            img['url'] = BingWallpaperClient.BING_BASE_URL + img['url']
+            if market:
+                img['zone'] = market
+            else:
+                img['zone'] = 'EN' if en_search else 'CN'
+            img['url'] = base_url + img['url']
             wallpapers.append(BingWallpaperInfo.fromdict(img))
         return wallpapers
 
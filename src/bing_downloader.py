@@ -1,123 +1,153 @@
 #!/usr/bin/python3
 # -*- coding: utf8 -*-
 
+import dataclasses
+import hashlib
+import json
 import logging
 import os
 import re
-import sqlite3
-from abc import ABCMeta, abstractmethod
-from enum import Enum, auto
-
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3 import Retry
-
-from bing_client import BingWallpaperInfo, BingWallpaperClient
-from notify import Notification
-
-
-class StorageType(Enum):
-    NONE = 'NONE'
-    SQLITE = 'SQLITE'
-
-    def __str__(self):
-        return self.value
-
-
-class BingWallpaperManager(metaclass=ABCMeta):
-    @abstractmethod
-    def init_db(self):
-        pass
-
-    @abstractmethod
-    def clean_db(self):
-        pass
-
-    @abstractmethod
-    def wallpaper_exist(self, hsh: str) -> bool:
-        pass
-
-    @abstractmethod
-    def save_wallpaper_info(self, wallpaper_info: BingWallpaperInfo):
-        pass
-
-
-class NoBingWallpaperManager(BingWallpaperManager):
-    def init_db(self):
-        pass
-
-    def clean_db(self):
-        pass
-
-    def wallpaper_exist(self, hsh: str) -> bool:
-        return False
-
-    def save_wallpaper_info(self, wallpaper_info: BingWallpaperInfo):
-        pass
-
-
-class SqliteBingWallpaperManager(BingWallpaperManager):
-    CREATE_TABLE_SQL = """
-        CREATE TABLE IF NOT EXISTS `bing.bing` (
-            `id` INTEGER PRIMARY KEY,
-            `date` varchar(16) NOT NULL DEFAULT '',
-            `url` varchar(255) NOT NULL DEFAULT '',
-            `copyright` text NOT NULL DEFAULT '',
-            `hsh` varchar(64) NOT NULL DEFAULT '' UNIQUE,
-            `zone` varchar(8) NOT NULL DEFAULT 'cn',
-            `detail` text DEFAULT '',
-            `_create_time` datetime DEFAULT CURRENT_TIMESTAMP,
-            `_update_time` datetime DEFAULT CURRENT_TIMESTAMP
-        )"""
-
-    CHECK_HSH_SQL = "SELECT `hsh`, `url` from `bing.bing` WHERE `hsh` = ? LIMIT 1"
-    INSERT_IMG_SQL = "REPLACE INTO `bing.bing` VALUES(NULL, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)"
-    CLEAN_DB_SQL = "DELETE FROM `bing.bing`"
-
-    def __init__(self, sqlite_file: str):
-        self._sqlite_file = sqlite_file
-        self._db_conn = sqlite3.connect(self._sqlite_file)
-
-    def init_db(self):
-        conn = sqlite3.connect(self._sqlite_file)
-        cur = conn.cursor()
-        cur.execute(SqliteBingWallpaperManager.CREATE_TABLE_SQL)
-        conn.close()
-
-    def clean_db(self):
-        if not os.path.exists(self._sqlite_file):
-            return
-        conn = sqlite3.connect(self._sqlite_file)
-        cur = conn.cursor()
-        cur.execute(SqliteBingWallpaperManager.CLEAN_DB_SQL)
-        conn.close()
-
-    def wallpaper_exist(self, hsh: str) -> bool:
-        cur = self._db_conn.cursor()
-        res = cur.execute(SqliteBingWallpaperManager.CHECK_HSH_SQL, (hsh,))
-        rows = res.fetchall()
-        return rows is not None and len(rows) > 0
-
-    def save_wallpaper_info(self, wallpaper_info: BingWallpaperInfo):
-        cur = self._db_conn.cursor()
-        cur.execute(SqliteBingWallpaperManager.INSERT_IMG_SQL,
-                    (wallpaper_info.startdate, wallpaper_info.url, wallpaper_info.copyright, wallpaper_info.hsh,
-                     wallpaper_info.zone, wallpaper_info.tojson()))
-        self._db_conn.commit()
-
-
-def write_file(file_name: str, data: bytes):
-    file_dir = os.path.dirname(file_name)
-    if not os.path.exists(file_dir):
-        os.mkdir(file_dir)
-        logging.info("[BingDownloader] create new dir: %s", file_dir)
-
-    with open(file_name, "w+b") as file:
-        file.write(data)
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from urllib.parse import urlparse
+
+from requests import RequestException
+
+from bing_client import BingWallpaperInfo, BingWallpaperClient, MetadataCache, MetadataCacheEntry, WallpaperQuality
+from bing_storage import BingWallpaperManager
+from blob_store import BlobStore
+from derivative import DerivativeGenerator
+from file_util import DownloadedFile, write_file_atomic, fsync_dir
+from http_session import HttpSessionPool
+from log import SAMPLED, bind_log_context, log_context
+from metrics import DOWNLOADED_BYTES, LAST_SUCCESS, NEAR_DUPLICATES, OPERATION_DURATION, RETRIES
+from notify import Notification, QueuedNotification
+from phash import HammingIndex, PHashMode, image_hash
+from replica import ReplicaCoordinator
+
+
+class PartialFile(object):
+    """
+    A partially downloaded file `<file_name>.part`, with its byte offset and the validator (ETag/Last-Modified) of
+    the response it came from recorded in `<file_name>.part.json`, so an interrupted download can resume with a
+    Range request in a later attempt or a later round.
+    """
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.part_name = file_name + ".part"
+        self.meta_name = file_name + ".part.json"
+
+    def load(self, url: str) -> tuple[int, str]:
+        """
+
+        :param url: the url to download
+        :return: byte offset to resume from and the validator to send in If-Range, (0, None) if can not resume
+        """
+        if not os.path.exists(self.part_name) or not os.path.exists(self.meta_name):
+            return 0, None
+        try:
+            with open(self.meta_name, "r") as file:
+                meta = json.load(file)
+        except (OSError, ValueError) as e:
+            logging.warning("[BingDownloader] invalid partial file meta %s, %s", self.meta_name, e)
+            return 0, None
+        validator = meta.get("etag") or meta.get("last_modified")
+        if meta.get("url") != url or not validator:
+            return 0, None
+        # data after the recorded offset may not have been flushed completely, ignore it
+        offset = min(os.path.getsize(self.part_name), meta.get("offset", 0))
+        return offset, validator
+
+    def save(self, url: str, offset: int, etag: str, last_modified: str):
+        meta = {"url": url, "offset": offset, "etag": etag, "last_modified": last_modified}
+        write_file_atomic(self.meta_name, [json.dumps(meta).encode()])
+
+    def digest_prefix(self, offset: int):
+        sha256 = hashlib.sha256()
+        with open(self.part_name, "rb") as file:
+            remain = offset
+            while remain > 0:
+                chunk = file.read(min(remain, BingWallpaperDownloader.DOWNLOAD_CHUNK_SIZE))
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                remain -= len(chunk)
+        return sha256
+
+    def commit(self, blob_store: BlobStore = None, digest: str = None):
+        """
+
+        :param blob_store: store the file as a blob and link it, see BlobStore.ingest
+        :param digest: sha256 of the complete file, required with blob_store
+        """
+        if blob_store:
+            blob_store.ingest(self.part_name, digest, self.file_name)
+        else:
+            os.replace(self.part_name, self.file_name)
+            fsync_dir(os.path.dirname(self.file_name))
+        self.discard_meta()
+
+    def discard(self):
+        if os.path.exists(self.part_name):
+            os.remove(self.part_name)
+        self.discard_meta()
+
+    def discard_meta(self):
+        if os.path.exists(self.meta_name):
+            os.remove(self.meta_name)
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class BodyInterrupted(RequestException):
+    """
+    The connection broke after the body started, the http adapter does not retry it.
+    """
+    pass
+
+
+@dataclass
+class DownloadTask:
+    # the same image from all the markets, the first one is downloaded
+    group: list[BingWallpaperInfo]
+    # the one already in storage if any
+    stored: BingWallpaperInfo
+    quality: WallpaperQuality
+
+    @property
+    def wallpaper(self) -> BingWallpaperInfo:
+        return self.group[0]
+
+    @property
+    def host(self) -> str:
+        return urlparse(self.wallpaper.url).netloc
+
+    @property
+    def key(self) -> tuple[str, str]:
+        """
+        (hsh, quality name) the variant is saved as, see save_downloads.
+        """
+        return (self.stored if self.stored else self.wallpaper).hsh, self.quality.name
+
+
+@dataclass
+class DownloadRound:
+    # wallpaper info fetched in the round, empty if not changed
+    wallpapers: list[BingWallpaperInfo]
+    # number of failed markets and images
+    failed: int
 
 
 class BingWallpaperDownloader(object):
-    FILE_NAME_PATTERN = re.compile(r"^https://www.bing.com/th\?id=(.*)&rf=.*", re.I)
+    # any host, the wallpapers may come from a mirror set by bing_base_url
+    FILE_NAME_PATTERN = re.compile(r"^https?://[^/]+/th\?id=(.*)&rf=.*", re.I)
+    # OHR.WallaceFF_EN-CN6550155171_UHD.jpg -> WallaceFF, the same image has the same name in all markets
+    IMAGE_NAME_PATTERN = re.compile(r"[?&]id=OHR\.([^_&]+)_", re.I)
+    DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
     def __init__(self,
                  en_search: bool = True,
@@ -128,9 +158,37 @@ class BingWallpaperDownloader(object):
                  retry_backoff_ms: int = 1000,
                  timeout_ms: int = 5000,
                  download_timeout_ms: int = 10000,
+                 download_concurrency: int = 4,
                  wallpaper_mgr: BingWallpaperManager = None,
-                 notify: Notification = None):
+                 notify: Notification | QueuedNotification = None,
+                 session: HttpSessionPool = None,
+                 meta_cache: MetadataCache = None,
+                 markets: list[str] = None,
+                 qualities: list[WallpaperQuality] = None,
+                 bing_base_url: str = None,
+                 coordinator: ReplicaCoordinator = None,
+                 blob_store: BlobStore = None,
+                 phash_mode: PHashMode = PHashMode.OFF,
+                 phash_distance: int = 8,
+                 derivatives: DerivativeGenerator = None):
+        """
+
+        :param markets: bing markets such as zh-CN, en-US, all of them are fetched in one round, en_search is
+                        ignored if specified
+        :param qualities: the variants to download of each wallpaper, default is BingWallpaperClient.DEFAULT_QUALITY
+        :param bing_base_url: bing web site, default is BingWallpaperClient.BING_BASE_URL
+        :param coordinator: splits the downloads with the other replicas sharing wallpaper_mgr
+        :param blob_store: store the images by content under download_path, the file names are links to them
+        :param phash_mode: detect the images perceptually close to a stored one, e.g. re-encoded or resized, requires
+                           Pillow
+        :param phash_distance: max hamming distance of the perceptual hashes of two near duplicates, out of 64 bits
+        :param derivatives: generate the derivatives of the new wallpapers at the end of every round
+        """
         self._en_search = en_search
+        self._markets = markets if markets else [None]
+        # markets fetched in the current round
+        self._fetched_markets = []
+        self._qualities = list(dict.fromkeys(qualities)) if qualities else [BingWallpaperClient.DEFAULT_QUALITY]
         self._download_offset = download_offset
         self._download_cnt = download_cnt
         self._download_path = download_path
@@ -138,55 +196,523 @@ class BingWallpaperDownloader(object):
         self._backoff = retry_backoff_ms / 1000
         self._timeout = timeout_ms / 1000
         self._download_timeout = download_timeout_ms / 1000
+        self._download_concurrency = max(1, download_concurrency)
         self._wallpaper_mgr = wallpaper_mgr
         self._notify = notify
-        self._wallpaper_client = BingWallpaperClient(timeout_ms, max_retries, retry_backoff_ms)
+        self._meta_cache = meta_cache
+        self._coordinator = coordinator
+        self._blob_store = blob_store
+        self._phash_mode = phash_mode
+        self._phash_distance = phash_distance
+        # (hsh, quality) -> perceptual hash of the stored variants, loaded on first use
+        self._phash_index = None
+        # (hsh, quality) -> (path, size, digest) of the stored variants
+        self._phash_files = {}
+        self._derivatives = derivatives
+        self._session = session if session else HttpSessionPool(pool_size=max(10, self._download_concurrency),
+                                                                max_retries=max_retries,
+                                                                retry_backoff_ms=retry_backoff_ms)
+        self._wallpaper_client = BingWallpaperClient(timeout_ms, max_retries, retry_backoff_ms, session=self._session,
+                                                     base_url=bing_base_url)
 
         if not os.path.exists(self._download_path):
             os.makedirs(self._download_path)
 
-    def get_filename(self, date: str, url: str) -> str:
+    def get_filename(self, date: str, url: str, quality: WallpaperQuality = None) -> str:
+        """
+
+        :param date:
+        :param url:
+        :param quality: the name of variants other than the default quality is suffixed with its size,
+                        e.g. 20200229_OHR.WallaceFF_EN-CN6550155171_UHD_1920x1080.jpg
+        :return:
+        """
         match = BingWallpaperDownloader.FILE_NAME_PATTERN.match(url)
         if not match:
             raise Exception('not found filename from url')
 
         file_name = date + '_' + match.group(1)
+        if quality and quality != BingWallpaperClient.DEFAULT_QUALITY:
+            root, ext = os.path.splitext(file_name)
+            file_name = "{}_{}x{}{}".format(root, *BingWallpaperClient.WALLPAPER_WH[quality], ext)
         month = date[:-2]
         file_dir = os.path.join(self._download_path, month)
         file_path = os.path.join(file_dir, file_name)
         return file_path
 
-    def download_one_img(self, wallpaper: BingWallpaperInfo):
-        filename = self.get_filename(wallpaper.startdate, wallpaper.url)
-        s = requests.Session()
-        retries = Retry(total=self._max_retries, backoff_factor=self._backoff)
-        s.mount('https://', HTTPAdapter(max_retries=retries))
-        r = s.get(wallpaper.url, timeout=self._download_timeout)
-        if r.status_code != 200:
-            raise Exception("status_code: %d, resp: %s".format(r.status_code, r.text))
-
-        write_file(file_name=filename, data=r.content)
-        logging.info("[BingDownloader] success download wallpaper, %s, filename: %s", wallpaper.digest_str(), filename)
-
-    def download(self):
-        try:
-            wallpapers = self._wallpaper_client.get_wallpaper_info(idx=self._download_offset,
-                                                                   num=self._download_cnt,
-                                                                   en_search=self._en_search)
-            for w in wallpapers:
-                if self._wallpaper_mgr.wallpaper_exist(w.hsh):
-                    logging.info("[BingDownloader] wallpaper exist: %s", w.digest_str())
-                    continue
-
+    @OPERATION_DURATION.time(operation="download_one_img")
+    def download_one_img(self, wallpaper: BingWallpaperInfo, quality: WallpaperQuality = None) -> DownloadedFile:
+        with log_context(image_id="{}:{}".format(wallpaper.hsh, (quality or BingWallpaperClient.DEFAULT_QUALITY).name)):
+            return self._download_one_img(wallpaper, quality)
+
+    def _download_one_img(self, wallpaper: BingWallpaperInfo, quality: WallpaperQuality = None) -> DownloadedFile:
+        start = time.time()
+        url = wallpaper.url
+        if quality and quality != BingWallpaperClient.DEFAULT_QUALITY:
+            url = BingWallpaperClient.variant_url(url, quality)
+        filename = self.get_filename(wallpaper.startdate, wallpaper.url, quality)
+        file_dir = os.path.dirname(filename)
+        if not os.path.exists(file_dir):
+            # several download threads may create the same month dir at once
+            os.makedirs(file_dir, exist_ok=True)
+            logging.info("[BingDownloader] create new dir: %s", file_dir)
+
+        # the http adapter only retries before the body is read, a connection broken in the middle of the body is
+        # retried here, resuming from what has been received, the errors the adapter already retried are raised
+        partial = PartialFile(filename)
+        attempt = 0
+        while True:
+            try:
+                downloaded = self._download_partial(url, partial)
+                break
+            except RangeNotSatisfiable as e:
+                logging.warning("[BingDownloader] can not resume %s, restart from zero, %s", filename, e)
+                partial.discard()
+            except BodyInterrupted as e:
+                if attempt >= self._max_retries:
+                    raise
+                logging.warning("[BingDownloader] download interrupted, %s, retry: %d, msg: %s",
+                                wallpaper.digest_str(), attempt + 1, e)
+                RETRIES.inc(operation="download")
+                time.sleep(self._backoff * (2 ** attempt))
+            attempt += 1
+
+        logging.info("[BingDownloader] success download wallpaper, %s, filename: %s, size: %d, sha256: %s",
+                     wallpaper.digest_str(), filename, downloaded.size, downloaded.digest,
+                     extra={"duration_ms": round((time.time() - start) * 1000, 1), "bytes": downloaded.size})
+        if self._phash_mode != PHashMode.OFF:
+            try:
+                downloaded.phash = image_hash(filename)
+            except Exception as e:
+                # not an image bing would serve, saved without a hash
+                logging.warning("[BingDownloader] failed to hash %s, msg: %s", filename, e)
+        return downloaded
+
+    def _download_partial(self, url: str, partial: PartialFile) -> DownloadedFile:
+        offset, validator = partial.load(url)
+        headers = {}
+        if offset > 0:
+            headers["Range"] = "bytes={}-".format(offset)
+            headers["If-Range"] = validator
+
+        with self._session.get(url, headers=headers, timeout=self._download_timeout, stream=True) as r:
+            if r.status_code == 416:
+                raise RangeNotSatisfiable("status_code: 416, offset: {}".format(offset))
+            if r.status_code == 206:
+                content_range = r.headers.get("Content-Range", "")
+                match = re.match(r"^bytes (\d+)-\d+/(\d+|\*)$", content_range.strip())
+                if not match or int(match.group(1)) != offset:
+                    raise RangeNotSatisfiable("unexpected Content-Range: {}".format(content_range))
+                logging.info("[BingDownloader] resume download %s from offset %d", partial.file_name, offset)
+            elif r.status_code == 200:
+                # the server ignored the range or the file changed, start over
+                offset = 0
+            else:
+                raise Exception("status_code: {}, resp: {}".format(r.status_code, r.text))
+
+            # Content-Length is the encoded size, it can only be checked against the raw body
+            expect_size = None
+            if 'Content-Length' in r.headers and not r.headers.get('Content-Encoding'):
+                expect_size = offset + int(r.headers['Content-Length'])
+            etag = r.headers.get("ETag")
+            last_modified = r.headers.get("Last-Modified")
+
+            sha256 = partial.digest_prefix(offset) if offset > 0 else hashlib.sha256()
+            size = offset
+            with open(partial.part_name, "r+b" if offset > 0 else "wb") as file:
+                file.seek(offset)
+                file.truncate()
                 try:
-                    self.download_one_img(w)
-                    self._wallpaper_mgr.save_wallpaper_info(w)
-                    logging.info("[BingDownloader] success save wallpaper info to database, %s", w.digest_str())
-                    if self._notify:
-                        self._notify.notify("Bing Wallpaper Download SUCCESS", w.tojson())
+                    for chunk in r.iter_content(chunk_size=self.DOWNLOAD_CHUNK_SIZE):
+                        if not chunk:
+                            continue
+                        file.write(chunk)
+                        sha256.update(chunk)
+                        size += len(chunk)
+                except BaseException as e:
+                    DOWNLOADED_BYTES.inc(size - offset)
+                    # keep what has been received, it can only be resumed if the response has a validator
+                    file.flush()
+                    os.fsync(file.fileno())
+                    if etag or last_modified:
+                        partial.save(url, size, etag, last_modified)
+                    else:
+                        partial.discard_meta()
+                    if isinstance(e, RequestException):
+                        raise BodyInterrupted("interrupted at {} bytes, {}".format(size, e)) from e
+                    raise
+                file.flush()
+                os.fsync(file.fileno())
+                DOWNLOADED_BYTES.inc(size - offset)
+
+        if expect_size is not None and size != expect_size:
+            partial.discard()
+            raise Exception("incomplete content, expect {} bytes, got {}".format(expect_size, size))
+        digest = sha256.hexdigest()
+        partial.commit(self._blob_store, digest)
+        return DownloadedFile(path=partial.file_name, size=size, digest=digest)
+
+    def notify_error(self, wallpaper: BingWallpaperInfo, e):
+        logging.error("[BingDownloader] failed to download wallpaper, %s, msg: %s", wallpaper.digest_str(), e)
+        if self._notify:
+            self._notify.notify("Bing Wallpaper Download ERROR", "msg: {}\ninfo: {}".format(e, wallpaper.tojson()))
+
+    def fetch_market(self, market: str) -> tuple[list[BingWallpaperInfo], MetadataCacheEntry]:
+        if self._meta_cache:
+            return self._wallpaper_client.get_wallpaper_info_if_changed(self._meta_cache,
+                                                                        idx=self._download_offset,
+                                                                        num=self._download_cnt,
+                                                                        en_search=self._en_search,
+                                                                        market=market,
+                                                                        qualities=self._qualities)
+        wallpapers = self._wallpaper_client.get_wallpaper_info(idx=self._download_offset,
+                                                               num=self._download_cnt,
+                                                               en_search=self._en_search,
+                                                               market=market)
+        return wallpapers, None
+
+    def fetch_window(self, market: str, idx: int, num: int) -> list[BingWallpaperInfo]:
+        """
+        Fetch the wallpaper info of any idx/num window, without the metadata cache.
+        """
+        return self._wallpaper_client.get_wallpaper_info(idx=idx, num=num, en_search=self._en_search, market=market)
+
+    def invalidate_meta_cache(self):
+        """
+        Plan the next round from the responses even if they are not changed, e.g. after a variant was forgotten.
+        """
+        if self._meta_cache:
+            self._meta_cache.clear()
+
+    @property
+    def markets(self) -> list[str]:
+        return self._markets
+
+    def market_name(self, market: str) -> str:
+        """
+        The zone of the wallpapers of the market, also for the default market selected by en_search.
+        """
+        return market if market else ('EN' if self._en_search else 'CN')
+
+    def fetch_wallpapers(self) -> tuple[list[BingWallpaperInfo], list[MetadataCacheEntry], int]:
+        """
+        Fetch the wallpaper info of all the markets concurrently.
+
+        :return: wallpapers of the changed markets, their cache entries and the number of failed markets
+        """
+        results = []
+        with ThreadPoolExecutor(max_workers=len(self._markets), thread_name_prefix="bing-meta") as executor:
+            futures = [executor.submit(self.fetch_market, market) for market in self._markets]
+            for future in futures:
+                try:
+                    results.append(future.result())
                 except Exception as e:
-                    logging.error("[BingDownloader] failed to download wallpaper, %s, msg: %s", w.digest_str(), e)
-                    if self._notify:
-                        self._notify.notify("Bing Wallpaper Download ERROR", "msg: {}\ninfo: {}".format(e, w.tojson()))
+                    results.append(e)
+        return self.collect_wallpapers(results)
+
+    def collect_wallpapers(self, results: list) -> tuple[list[BingWallpaperInfo], list[MetadataCacheEntry], int]:
+        """
+
+        :param results: the fetch_market result or exception of each market, in the order of markets
+        :return: same as fetch_wallpapers
+        """
+        wallpapers = []
+        cache_entries = []
+        failed = 0
+        self._fetched_markets = []
+        for market, result in zip(self._markets, results):
+            if isinstance(result, BaseException):
+                failed += 1
+                logging.error("[BingDownloader] failed to get wallpaper info, market: %s, msg: %s", market, result)
+                continue
+            self._fetched_markets.append(market)
+            items, cache_entry = result
+            if items is None:
+                logging.info("[BingDownloader] wallpaper info not changed since last round, market: %s", market)
+                continue
+            wallpapers.extend(items)
+            if cache_entry:
+                cache_entries.append(cache_entry)
+        if not wallpapers:
+            # nothing to download for the fetched markets
+            self._mark_success(self._fetched_markets)
+        return wallpapers, cache_entries, failed
+
+    def _mark_success(self, markets: list[str]):
+        now = time.time()
+        for market in markets:
+            LAST_SUCCESS.set(now, market=self.market_name(market))
+
+    @staticmethod
+    def image_name(url: str) -> str:
+        """
+        The lower case name of the image, e.g. wallaceff, the same in all markets, '' if not an OHR image.
+        """
+        match = BingWallpaperDownloader.IMAGE_NAME_PATTERN.search(url or '')
+        return match.group(1).lower() if match else ''
+
+    @staticmethod
+    def merge_wallpapers(wallpapers: list[BingWallpaperInfo]) -> list[list[BingWallpaperInfo]]:
+        """
+        Group the same image from different markets, by hsh or by image name.
+
+        :return: groups in the order of first appearance, the first one of each group is the one to download
+        """
+        groups = []
+        group_by_key = {}
+        for w in wallpapers:
+            keys = [w.hsh]
+            name = BingWallpaperDownloader.image_name(w.url)
+            if name:
+                keys.append("name:" + name)
+            group = next((group_by_key[k] for k in keys if k in group_by_key), None)
+            if group is None:
+                group = []
+                groups.append(group)
+            group.append(w)
+            for k in keys:
+                group_by_key.setdefault(k, group)
+        return groups
+
+    def adopt_rebuilt(self, groups: list[list[BingWallpaperInfo]], exist: set[str]):
+        """
+        Find the rows rebuilt by verify from the files of the wallpapers not stored, by date and image name, and
+        give them the hsh and info bing returns, so their files are not downloaded again.
+
+        :param exist: the stored hshs, the adopted ones are added
+        """
+        new = [group for group in groups if not any(w.hsh in exist for w in group)]
+        if not new:
+            return
+        rebuilt = {}
+        for hsh, date, url in self._wallpaper_mgr.rebuilt_wallpapers(set(w.startdate for g in new for w in g)):
+            name = self.image_name(url)
+            if name:
+                rebuilt.setdefault((date, name), []).append(hsh)
+        if not rebuilt:
+            return
+        with self._wallpaper_mgr.batch():
+            for group in new:
+                w = group[0]
+                # a row for the file of each market
+                hshs = [hsh for other in group for hsh in rebuilt.pop((other.startdate, self.image_name(other.url)),
+                                                                      [])]
+                for hsh in hshs:
+                    self._wallpaper_mgr.replace_wallpaper(hsh, w)
+                    logging.info("[BingDownloader] rebuilt wallpaper %s is %s", hsh, w.digest_str())
+                if hshs:
+                    exist.add(w.hsh)
+
+    def plan_downloads(self, wallpapers: list[BingWallpaperInfo]) -> tuple[list[DownloadTask], list[BingWallpaperInfo]]:
+        """
+        Merge the wallpapers of all markets and find the variants not stored yet.
+
+        :return: the variants to download, and the zone records of the stored wallpapers
+        """
+        groups = self.merge_wallpapers(wallpapers)
+        exist = self._wallpaper_mgr.wallpapers_exist(w.hsh for w in wallpapers)
+        self.adopt_rebuilt(groups, exist)
+        variants = self._wallpaper_mgr.variants_exist(exist) if exist else {}
+        tasks = []
+        zones = []
+        for group in groups:
+            stored = next((w for w in group if w.hsh in exist), None)
+            if stored:
+                zones.extend(dataclasses.replace(w, hsh=stored.hsh) for w in group)
+            stored_qualities = variants.get(stored.hsh, set()) if stored else set()
+            missing = [q for q in self._qualities if q.name not in stored_qualities]
+            if not missing:
+                logging.info("[BingDownloader] wallpaper exist: %s", stored.digest_str(), extra=SAMPLED)
+                continue
+            tasks.extend(DownloadTask(group=group, stored=stored, quality=q) for q in missing)
+        return tasks, zones
+
+    def claim_downloads(self, tasks: list[DownloadTask]) -> tuple[list[DownloadTask], int]:
+        """
+        Claim the tasks from the other replicas, only the claimed ones may be downloaded.
+
+        :return: the claimed tasks, and the number of tasks stored or being downloaded by the other replicas
+        """
+        if not self._coordinator:
+            return tasks, 0
+        claimed, deferred = self._coordinator.claim(tasks)
+        # another replica may have saved the wallpaper with another quality since it was planned, do not replace it
+        new = [t for t in claimed if not t.stored]
+        exist = self._wallpaper_mgr.wallpapers_exist(t.wallpaper.hsh for t in new) if new else set()
+        claimed = [dataclasses.replace(t, stored=t.wallpaper) if not t.stored and t.wallpaper.hsh in exist else t
+                   for t in claimed]
+        return claimed, deferred
+
+    def release_downloads(self, tasks: list[DownloadTask]):
+        if self._coordinator:
+            self._coordinator.release(tasks)
+
+    def download_task(self, task: DownloadTask) -> tuple[DownloadTask, DownloadedFile]:
+        """
+        Claim the task just before downloading it, so the replicas running at the same time split the tasks.
+
+        :return: the claimed task and its file, the file is None if the task is left to the other replicas
+        """
+        if self._coordinator:
+            claimed, _ = self.claim_downloads([task])
+            if not claimed:
+                return task, None
+            task = claimed[0]
+        return task, self.download_one_img(task.wallpaper, task.quality)
+
+    def _load_phash_index(self) -> HammingIndex:
+        if self._phash_index is None:
+            self._phash_index = HammingIndex()
+            for hsh, quality, path, size, digest, h in self._wallpaper_mgr.list_variant_phashes():
+                self._phash_index.add((hsh, quality), h)
+                self._phash_files[(hsh, quality)] = (path, size, digest)
+            logging.info("[BingDownloader] loaded %d perceptual hashes", len(self._phash_index))
+        return self._phash_index
+
+    def _check_near_duplicate(self, w: BingWallpaperInfo, quality: WallpaperQuality,
+                              file: DownloadedFile) -> tuple[DownloadedFile, str]:
+        """
+        Find a stored variant of another wallpaper perceptually close to a downloaded file, e.g. the same image
+        published again re-encoded. With SKIP the variant is saved as the file of the stored one, and the
+        downloaded file is removed once saved.
+
+        :return: the file to save the variant as, and the hsh of the wallpaper it duplicates, '' if none
+        """
+        if file.phash is None:
+            return file, ''
+        index = self._load_phash_index()
+        matches = [(d, key) for d, key in index.search(file.phash, self._phash_distance) if key[0] != w.hsh]
+        index.add((w.hsh, quality.name), file.phash)
+        if not matches:
+            self._phash_files[(w.hsh, quality.name)] = (os.path.relpath(file.path, self._download_path), file.size,
+                                                        file.digest)
+            return file, ''
+
+        distance, key = matches[0]
+        path, size, digest = self._phash_files[key]
+        NEAR_DUPLICATES.inc(action=self._phash_mode.value)
+        logging.warning("[BingDownloader] %s, quality: %s is a near duplicate of %s, quality: %s, distance: %d, %s",
+                        w.digest_str(), quality.name, key[0], key[1], distance,
+                        "the stored file is used" if self._phash_mode == PHashMode.SKIP else "both files are kept")
+        if self._phash_mode != PHashMode.SKIP:
+            self._phash_files[(w.hsh, quality.name)] = (os.path.relpath(file.path, self._download_path), file.size,
+                                                        file.digest)
+            return file, key[0]
+        self._phash_files[(w.hsh, quality.name)] = (path, size, digest)
+        return DownloadedFile(path=os.path.join(self._download_path, path), size=size, digest=digest,
+                              phash=file.phash), key[0]
+
+    def save_downloads(self, downloaded: list[tuple[DownloadTask, DownloadedFile]],
+                       zones: list[BingWallpaperInfo]) -> tuple[list[BingWallpaperInfo], int]:
+        """
+        Save all the downloaded variants of this round in one transaction.
+
+        :return: the newly saved wallpapers and the number of failed ones
+        """
+        by_group = {}
+        for task, file in downloaded:
+            by_group.setdefault(id(task.group), (task, []))[1].append((task.quality, file))
+
+        saved = []
+        failed = 0
+        # files of the near duplicates not kept, removed once their variants are saved
+        skipped = []
+        with self._wallpaper_mgr.batch():
+            for task, files in by_group.values():
+                w = task.stored if task.stored else task.group[0]
+                try:
+                    # (quality, downloaded file, file to save the variant as, hsh of the wallpaper it duplicates)
+                    checked = [(quality, file, *self._check_near_duplicate(w, quality, file))
+                               for quality, file in files]
+                    if not task.stored:
+                        # the row keeps the file of the first requested quality
+                        _, _, file, _ = min(checked, key=lambda item: self._qualities.index(item[0]))
+                        self._wallpaper_mgr.save_wallpaper_info(w, size=file.size, digest=file.digest)
+                        zones.extend(dataclasses.replace(other, hsh=w.hsh) for other in task.group[1:])
+                        saved.append(w)
+                    for quality, downloaded_file, file, dup_of in checked:
+                        self._wallpaper_mgr.save_wallpaper_variant(w.hsh, quality.name,
+                                                                   os.path.relpath(file.path, self._download_path),
+                                                                   size=file.size, digest=file.digest,
+                                                                   phash=file.phash, dup_of=dup_of)
+                        if os.path.abspath(file.path) != os.path.abspath(downloaded_file.path):
+                            skipped.append(downloaded_file.path)
+                except Exception as e:
+                    failed += 1
+                    self.notify_error(w, e)
+            if len(self._markets) > 1 and zones:
+                self._wallpaper_mgr.save_wallpaper_zones(zones)
+        for path in skipped:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.warning("[BingDownloader] failed to remove near duplicate %s, msg: %s", path, e)
+        for w in saved:
+            logging.info("[BingDownloader] success save wallpaper info to database, %s", w.digest_str())
+        return saved, failed
+
+    def finish_round(self, saved: list[BingWallpaperInfo], cache_entries: list[MetadataCacheEntry], failed: int,
+                     deferred: int = 0):
+        """
+
+        :param deferred: number of tasks left to the other replicas
+        """
+        if self._derivatives and saved:
+            # the failed ones are generated by the next derive command, the wallpapers are saved anyway
+            try:
+                self._derivatives.generate_wallpapers(w.hsh for w in saved)
+            except Exception as e:
+                logging.error("[BingDownloader] failed to generate derivatives, msg: %s", e)
+
+        if self._notify:
+            for w in saved:
+                self._notify.notify("Bing Wallpaper Download SUCCESS", w.tojson())
+            self._notify.flush()
+
+        # only remember the responses when all of the wallpapers are handled, otherwise retry them next round, the
+        # ones left to the other replicas are found stored next round, or claimed again if the other replica died
+        if failed == 0 and deferred == 0:
+            for cache_entry in cache_entries:
+                self._meta_cache.put(cache_entry)
+            self._mark_success(self._fetched_markets)
+
+    def download(self) -> DownloadRound:
+        try:
+            wallpapers, cache_entries, fetch_failed = self.fetch_wallpapers()
+            if not wallpapers:
+                if fetch_failed == 0:
+                    logging.info("[BingDownloader] no changed wallpaper info, skip")
+                return DownloadRound(wallpapers=[], failed=fetch_failed)
+
+            tasks, zones = self.plan_downloads(wallpapers)
+            failed = 0
+            deferred = 0
+            downloaded = []
+            try:
+                if tasks:
+                    # images are fetched by the pool, database writes and notifications stay on this thread so
+                    # they are serialized
+                    with ThreadPoolExecutor(max_workers=min(self._download_concurrency, len(tasks)),
+                                            thread_name_prefix="bing-dl") as executor:
+                        futures = {executor.submit(bind_log_context(self.download_task), task): task
+                                   for task in tasks}
+                        for future in as_completed(futures):
+                            task = futures[future]
+                            try:
+                                task, file = future.result()
+                                if file:
+                                    downloaded.append((task, file))
+                                else:
+                                    deferred += 1
+                            except Exception as e:
+                                failed += 1
+                                self.notify_error(task.wallpaper, "quality: {}, {}".format(task.quality.name, e))
+
+                saved, save_failed = self.save_downloads(downloaded, zones)
+            finally:
+                self.release_downloads(tasks)
+            self.finish_round(saved, cache_entries, failed + save_failed, deferred)
+            return DownloadRound(wallpapers=wallpapers, failed=fetch_failed + failed + save_failed)
         except Exception as e:
             logging.error("[BingDownloader] failed to download, msg: %s", e)
+            return DownloadRound(wallpapers=[], failed=1)
@@ -0,0 +1,1045 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from dataclasses import dataclass
+from enum import Enum
+from typing import Iterable, Iterator
+
+from bing_client import BingWallpaperInfo
+from metrics import OPERATION_DURATION
+from phash import to_signed, to_unsigned
+
+# hsh of the rows rebuilt from the files by verify, the real hsh is lost with the database
+REBUILT_HSH_PREFIX = "file-"
+
+
+class StorageType(Enum):
+    NONE = 'NONE'
+    SQLITE = 'SQLITE'
+
+    def __str__(self):
+        return self.value
+
+
+@dataclass
+class StoredVariant:
+    hsh: str
+    quality: str
+    # relative to the download path, empty for the rows saved before the variants were recorded
+    path: str
+    size: int
+    digest: str
+    date: str
+    url: str
+    detail: str
+
+
+@dataclass
+class StoredFile:
+    # WallpaperQuality name of a variant, or name of a derivative
+    name: str
+    # relative to the download path
+    path: str
+    size: int
+    digest: str
+
+
+@dataclass
+class SearchHit:
+    wallpaper: BingWallpaperInfo
+    # bm25 of the text search, lower is better, 0 if searched without text
+    rank: float
+
+
+class BingWallpaperManager(metaclass=ABCMeta):
+    @abstractmethod
+    def init_db(self):
+        pass
+
+    @abstractmethod
+    def clean_db(self):
+        pass
+
+    @abstractmethod
+    def wallpaper_exist(self, hsh: str) -> bool:
+        pass
+
+    @abstractmethod
+    def wallpapers_exist(self, hshs: Iterable[str]) -> set[str]:
+        """
+
+        :param hshs:
+        :return: the hshs already exist
+        """
+        pass
+
+    @abstractmethod
+    def save_wallpaper_info(self, wallpaper_info: BingWallpaperInfo, size: int = 0, digest: str = ''):
+        """
+
+        :param wallpaper_info:
+        :param size: byte size of the downloaded image file
+        :param digest: sha256 hex digest of the downloaded image file
+        """
+        pass
+
+    @abstractmethod
+    def save_wallpaper_zones(self, wallpapers: Iterable[BingWallpaperInfo]):
+        """
+        Record the zone each wallpaper appeared in, a wallpaper shared by several zones is saved only once but
+        recorded for all of them.
+        """
+        pass
+
+    @abstractmethod
+    def rebuilt_wallpapers(self, dates: Iterable[str]) -> list[tuple[str, str, str]]:
+        """
+
+        :return: (hsh, date, url) of the rows rebuilt by verify, see REBUILT_HSH_PREFIX, of the dates
+        """
+        pass
+
+    @abstractmethod
+    def replace_wallpaper(self, old_hsh: str, wallpaper_info: BingWallpaperInfo):
+        """
+        Give the row of old_hsh, and its variants, zones and derivatives, the hsh and info of wallpaper_info, or
+        merge them into its row if it is already stored. The size and digest of the row are kept.
+        """
+        pass
+
+    @abstractmethod
+    def variants_exist(self, hshs: Iterable[str]) -> dict[str, set[str]]:
+        """
+
+        :param hshs:
+        :return: hsh -> names of the stored qualities, for the hshs having any
+        """
+        pass
+
+    @abstractmethod
+    def save_wallpaper_variant(self, hsh: str, quality: str, path: str, size: int = 0, digest: str = '',
+                               phash: int = None, dup_of: str = ''):
+        """
+
+        :param hsh:
+        :param quality: WallpaperQuality name
+        :param path: file path relative to the download path
+        :param size: byte size of the file
+        :param digest: sha256 hex digest of the file
+        :param phash: unsigned 64 bits perceptual hash of the image, see phash.py
+        :param dup_of: hsh of the wallpaper this one is a near duplicate of
+        """
+        pass
+
+    @abstractmethod
+    def list_variant_phashes(self) -> Iterator[tuple[str, str, str, int, str, int]]:
+        """
+
+        :return: (hsh, quality, path, size, digest, phash) of the variants having a perceptual hash
+        """
+        pass
+
+    @abstractmethod
+    def list_variants(self) -> list[StoredVariant]:
+        """
+
+        :return: all the stored variants with the info of their wallpaper
+        """
+        pass
+
+    @abstractmethod
+    def list_variant_paths(self, after_hsh: str = '', limit: int = 1000) -> list[tuple[str, str, str]]:
+        """
+        Page through the variants having a file, by wallpaper.
+
+        :param after_hsh: only the wallpapers after it in hsh order
+        :param limit: max number of wallpapers, all the variants of each of them are returned
+        :return: (hsh, quality, path) ordered by hsh
+        """
+        pass
+
+    @abstractmethod
+    def variant_paths(self, hshs: Iterable[str]) -> list[tuple[str, str, str]]:
+        """
+
+        :return: (hsh, quality, path) of the variants of the wallpapers having a file
+        """
+        pass
+
+    @abstractmethod
+    def delete_wallpaper_variant(self, hsh: str, quality: str):
+        """
+        Forget a variant, so the next round downloads it again if the wallpaper is still returned by bing.
+        """
+        pass
+
+    @abstractmethod
+    def derivatives_exist(self, hshs: Iterable[str]) -> dict[str, set[str]]:
+        """
+
+        :return: hsh -> names of the derivatives generated from the wallpaper
+        """
+        pass
+
+    @abstractmethod
+    def save_derivative(self, hsh: str, name: str, quality: str, path: str, size: int = 0, digest: str = ''):
+        """
+
+        :param name: DerivativeSpec name, e.g. thumb
+        :param quality: WallpaperQuality name of the variant it is generated from
+        :param path: file path relative to the download path
+        """
+        pass
+
+    @abstractmethod
+    def search_wallpapers(self, text: str = None, start_date: str = None, end_date: str = None, zone: str = None,
+                          limit: int = 100) -> Iterator[SearchHit]:
+        """
+        Search title, caption, desc and copyright, the results are streamed.
+
+        :param text: words to search, all of them must match
+        :param start_date: e.g. 20200229, inclusive
+        :param end_date: inclusive
+        :param zone: e.g. CN, en-US, the wallpapers shared by several zones match any of them
+        :param limit: max number of results
+        :return: the best matches first, or the latest first if searched without text
+        """
+        pass
+
+    @abstractmethod
+    def latest_wallpapers(self, zone: str = None) -> list[tuple[str, BingWallpaperInfo]]:
+        """
+
+        :param zone: only the one of the zone if specified
+        :return: (zone, wallpaper) of the last wallpaper of every zone
+        """
+        pass
+
+    @abstractmethod
+    def get_wallpaper(self, hsh: str) -> BingWallpaperInfo:
+        """
+
+        :return: None if not stored
+        """
+        pass
+
+    @abstractmethod
+    def wallpaper_files(self, hsh: str) -> list[StoredFile]:
+        """
+
+        :return: the variants having a file and the derivatives of the wallpaper
+        """
+        pass
+
+    @abstractmethod
+    def iter_wallpapers(self, since: int = 0, batch_size: int = 1000, updated_after: str = None) -> Iterator[dict]:
+        """
+        Stream all the stored wallpapers in the order of change_seq, fetched in batches so the memory does not grow
+        with the number of rows. change_seq is taken from a counter on every change of the row or of its variants,
+        so it only grows, unlike _update_time which has a resolution of one second.
+
+        :param since: watermark, change_seq of the last exported row, only the rows changed after it are returned
+        :param batch_size: rows of one query
+        :param updated_after: only the rows updated at or after the time, e.g. "2024-01-01 00:00:00" UTC
+        :return: dicts of the columns of bing.bing, and `path` of the variant having the digest of the row
+        """
+        pass
+
+    @abstractmethod
+    def load_checkpoint(self, name: str) -> dict:
+        """
+
+        :param name: e.g. backfill:zh-CN
+        :return: the saved progress of a long running job, None if not exist
+        """
+        pass
+
+    @abstractmethod
+    def save_checkpoint(self, name: str, value: dict):
+        """
+        Save the progress of a long running job, saved in the same transaction as the other saves of a batch.
+        """
+        pass
+
+    @abstractmethod
+    def claim_variants(self, keys: Iterable[tuple[str, str]], owner: str, ttl: float) -> set[tuple[str, str]]:
+        """
+        Lease the variants to download to one of the replicas sharing the storage, so no two of them download the
+        same file at once. A variant already stored, or leased by another replica and not expired, is not claimed.
+
+        :param keys: (hsh, quality name)
+        :param owner: id of the replica
+        :param ttl: seconds until the claims expire and can be taken over, unless renewed
+        :return: the keys claimed by owner
+        """
+        pass
+
+    @abstractmethod
+    def renew_claims(self, owner: str, ttl: float) -> set[tuple[str, str]]:
+        """
+        Extend all the claims of owner.
+
+        :return: the keys still claimed by owner
+        """
+        pass
+
+    @abstractmethod
+    def release_claims(self, keys: Iterable[tuple[str, str]], owner: str):
+        pass
+
+    @contextmanager
+    def batch(self):
+        """
+        Group the saves inside the block into one transaction, committed when the block exits without error.
+        """
+        yield
+
+
+class NoBingWallpaperManager(BingWallpaperManager):
+    def init_db(self):
+        pass
+
+    def clean_db(self):
+        pass
+
+    def wallpaper_exist(self, hsh: str) -> bool:
+        return False
+
+    def wallpapers_exist(self, hshs: Iterable[str]) -> set[str]:
+        return set()
+
+    def save_wallpaper_info(self, wallpaper_info: BingWallpaperInfo, size: int = 0, digest: str = ''):
+        pass
+
+    def save_wallpaper_zones(self, wallpapers: Iterable[BingWallpaperInfo]):
+        pass
+
+    def rebuilt_wallpapers(self, dates: Iterable[str]) -> list[tuple[str, str, str]]:
+        return []
+
+    def replace_wallpaper(self, old_hsh: str, wallpaper_info: BingWallpaperInfo):
+        pass
+
+    def variants_exist(self, hshs: Iterable[str]) -> dict[str, set[str]]:
+        return {}
+
+    def save_wallpaper_variant(self, hsh: str, quality: str, path: str, size: int = 0, digest: str = '',
+                               phash: int = None, dup_of: str = ''):
+        pass
+
+    def list_variant_phashes(self) -> Iterator[tuple[str, str, str, int, str, int]]:
+        return iter([])
+
+    def list_variants(self) -> list[StoredVariant]:
+        return []
+
+    def list_variant_paths(self, after_hsh: str = '', limit: int = 1000) -> list[tuple[str, str, str]]:
+        return []
+
+    def variant_paths(self, hshs: Iterable[str]) -> list[tuple[str, str, str]]:
+        return []
+
+    def search_wallpapers(self, text: str = None, start_date: str = None, end_date: str = None, zone: str = None,
+                          limit: int = 100) -> Iterator[SearchHit]:
+        return iter([])
+
+    def latest_wallpapers(self, zone: str = None) -> list[tuple[str, BingWallpaperInfo]]:
+        return []
+
+    def get_wallpaper(self, hsh: str) -> BingWallpaperInfo:
+        return None
+
+    def wallpaper_files(self, hsh: str) -> list[StoredFile]:
+        return []
+
+    def iter_wallpapers(self, since: int = 0, batch_size: int = 1000, updated_after: str = None) -> Iterator[dict]:
+        return iter([])
+
+    def delete_wallpaper_variant(self, hsh: str, quality: str):
+        pass
+
+    def derivatives_exist(self, hshs: Iterable[str]) -> dict[str, set[str]]:
+        return {}
+
+    def save_derivative(self, hsh: str, name: str, quality: str, path: str, size: int = 0, digest: str = ''):
+        pass
+
+    def load_checkpoint(self, name: str) -> dict:
+        return None
+
+    def save_checkpoint(self, name: str, value: dict):
+        pass
+
+    def claim_variants(self, keys: Iterable[tuple[str, str]], owner: str, ttl: float) -> set[tuple[str, str]]:
+        # nothing shared to coordinate with
+        return set(keys)
+
+    def renew_claims(self, owner: str, ttl: float) -> set[tuple[str, str]]:
+        return set()
+
+    def release_claims(self, keys: Iterable[tuple[str, str]], owner: str):
+        pass
+
+
+class SqliteBingWallpaperManager(BingWallpaperManager):
+    CREATE_TABLE_SQL = """
+        CREATE TABLE IF NOT EXISTS `bing.bing` (
+            `id` INTEGER PRIMARY KEY,
+            `date` varchar(16) NOT NULL DEFAULT '',
+            `url` varchar(255) NOT NULL DEFAULT '',
+            `copyright` text NOT NULL DEFAULT '',
+            `hsh` varchar(64) NOT NULL DEFAULT '' UNIQUE,
+            `zone` varchar(8) NOT NULL DEFAULT 'cn',
+            `detail` text DEFAULT '',
+            `size` INTEGER NOT NULL DEFAULT 0,
+            `digest` varchar(64) NOT NULL DEFAULT '',
+            `_create_time` datetime DEFAULT CURRENT_TIMESTAMP,
+            `_update_time` datetime DEFAULT CURRENT_TIMESTAMP
+        )"""
+
+    CHECK_HSH_SQL = "SELECT `hsh`, `url` from `bing.bing` WHERE `hsh` = ? LIMIT 1"
+    CHECK_HSHS_SQL = "SELECT `hsh` from `bing.bing` WHERE `hsh` IN ({})"
+    LOAD_HSH_SQL = "SELECT `hsh` from `bing.bing`"
+    # keep the number of sql variables of one query under the default SQLITE_MAX_VARIABLE_NUMBER
+    CHECK_HSHS_BATCH = 500
+    INSERT_IMG_SQL = "REPLACE INTO `bing.bing` (`date`, `url`, `copyright`, `hsh`, `zone`, `detail`, `size`, " \
+                     "`digest`) VALUES(?, ?, ?, ?, ?, ?, ?, ?)"
+    INSERT_ZONE_SQL = "INSERT OR IGNORE INTO `bing.zone` (`hsh`, `zone`, `date`) VALUES(?, ?, ?)"
+    REBUILT_SQL = "SELECT `hsh`, `date`, `url` FROM `bing.bing` WHERE `hsh` LIKE '{}%' AND `date` IN ({{}})".format(
+        REBUILT_HSH_PREFIX)
+    REPLACE_IMG_SQL = "UPDATE `bing.bing` SET `date` = ?, `url` = ?, `copyright` = ?, `hsh` = ?, `zone` = ?, " \
+                      "`detail` = ?, `_update_time` = CURRENT_TIMESTAMP WHERE `hsh` = ?"
+    DELETE_IMG_SQL = "DELETE FROM `bing.bing` WHERE `hsh` = ?"
+    # the zone of a rebuilt row is guessed from the file name, replaced by the zone bing returns
+    DELETE_ZONES_SQL = "DELETE FROM `bing.zone` WHERE `hsh` = ?"
+    REPLACE_DUP_OF_SQL = "UPDATE `bing.variant` SET `dup_of` = ? WHERE `dup_of` = ?"
+    # the tables keyed by hsh moved by replace_wallpaper, the rows the new hsh already has are kept
+    HSH_TABLES = ["bing.variant", "bing.derivative"]
+    CHECK_VARIANTS_SQL = "SELECT `hsh`, `quality` from `bing.variant` WHERE `hsh` IN ({})"
+    INSERT_VARIANT_SQL = "REPLACE INTO `bing.variant` (`hsh`, `quality`, `path`, `size`, `digest`, `phash`, " \
+                         "`dup_of`) VALUES(?, ?, ?, ?, ?, ?, ?)"
+    LIST_PHASHES_SQL = "SELECT `hsh`, `quality`, `path`, `size`, `digest`, `phash` FROM `bing.variant` " \
+                       "WHERE `phash` IS NOT NULL"
+    LIST_VARIANTS_SQL = "SELECT v.`hsh`, v.`quality`, v.`path`, v.`size`, v.`digest`, b.`date`, b.`url`, b.`detail` " \
+                        "FROM `bing.variant` v JOIN `bing.bing` b ON v.`hsh` = b.`hsh`"
+    LIST_VARIANT_PATHS_SQL = "SELECT `hsh`, `quality`, `path` FROM `bing.variant` WHERE `path` != '' AND `hsh` IN " \
+                             "(SELECT DISTINCT `hsh` FROM `bing.variant` WHERE `path` != '' AND `hsh` > ? " \
+                             "ORDER BY `hsh` LIMIT ?) ORDER BY `hsh`, `quality`"
+    VARIANT_PATHS_SQL = "SELECT `hsh`, `quality`, `path` FROM `bing.variant` WHERE `path` != '' AND `hsh` IN ({})"
+    DELETE_VARIANT_SQL = "DELETE FROM `bing.variant` WHERE `hsh` = ? AND `quality` = ?"
+    CHECK_DERIVATIVES_SQL = "SELECT `hsh`, `name` from `bing.derivative` WHERE `hsh` IN ({})"
+    INSERT_DERIVATIVE_SQL = "REPLACE INTO `bing.derivative` (`hsh`, `name`, `quality`, `path`, `size`, `digest`) " \
+                            "VALUES(?, ?, ?, ?, ?, ?)"
+    ITER_COLUMNS = ["id", "date", "url", "copyright", "hsh", "zone", "detail", "size", "digest", "_create_time",
+                    "_update_time", "change_seq", "path"]
+    ITER_SQL = "SELECT b.`id`, b.`date`, b.`url`, b.`copyright`, b.`hsh`, b.`zone`, b.`detail`, b.`size`, " \
+               "b.`digest`, b.`_create_time`, b.`_update_time`, b.`change_seq`, " \
+               "(SELECT v.`path` FROM `bing.variant` v WHERE v.`hsh` = b.`hsh` AND v.`digest` = b.`digest` LIMIT 1) " \
+               "FROM `bing.bing` b WHERE b.`change_seq` > ? {} ORDER BY b.`change_seq` LIMIT ?"
+    LATEST_SQL = "SELECT z.`zone`, b.`detail` FROM `bing.zone` z JOIN `bing.bing` b ON b.`hsh` = z.`hsh` " \
+                 "WHERE z.`date` = (SELECT MAX(l.`date`) FROM `bing.zone` l WHERE l.`zone` = z.`zone`) {} " \
+                 "ORDER BY z.`zone`, b.`id` DESC"
+    GET_WALLPAPER_SQL = "SELECT `detail` FROM `bing.bing` WHERE `hsh` = ?"
+    WALLPAPER_FILES_SQL = "SELECT `quality`, `path`, `size`, `digest` FROM `bing.variant` WHERE `hsh` = ? " \
+                          "AND `path` != '' UNION ALL " \
+                          "SELECT `name`, `path`, `size`, `digest` FROM `bing.derivative` WHERE `hsh` = ?"
+    LOAD_CHECKPOINT_SQL = "SELECT `value` from `bing.checkpoint` WHERE `name` = ?"
+    SAVE_CHECKPOINT_SQL = "REPLACE INTO `bing.checkpoint` (`name`, `value`, `_update_time`) " \
+                          "VALUES(?, ?, CURRENT_TIMESTAMP)"
+    # expire_time is unix time, the replicas sharing the database must have synchronized clocks
+    EXPIRE_CLAIMS_SQL = "DELETE FROM `bing.claim` WHERE `expire_time` < ?"
+    CLAIM_SQL = "INSERT INTO `bing.claim` (`hsh`, `quality`, `owner`, `expire_time`) SELECT ?, ?, ?, ? " \
+                "WHERE NOT EXISTS (SELECT 1 FROM `bing.variant` WHERE `hsh` = ? AND `quality` = ?) " \
+                "ON CONFLICT (`hsh`, `quality`) DO UPDATE SET `expire_time` = excluded.`expire_time` " \
+                "WHERE `owner` = excluded.`owner`"
+    CHECK_CLAIM_SQL = "SELECT 1 FROM `bing.claim` WHERE `hsh` = ? AND `quality` = ? AND `owner` = ?"
+    RENEW_CLAIMS_SQL = "UPDATE `bing.claim` SET `expire_time` = ? WHERE `owner` = ?"
+    LIST_CLAIMS_SQL = "SELECT `hsh`, `quality` FROM `bing.claim` WHERE `owner` = ?"
+    RELEASE_CLAIM_SQL = "DELETE FROM `bing.claim` WHERE `hsh` = ? AND `quality` = ? AND `owner` = ?"
+    CLEAN_DB_SQL = "DELETE FROM `bing.bing`"
+    CLEAN_ZONE_SQL = "DELETE FROM `bing.zone`"
+    CLEAN_VARIANT_SQL = "DELETE FROM `bing.variant`"
+    CLEAN_DERIVATIVE_SQL = "DELETE FROM `bing.derivative`"
+
+    PRAGMAS = [
+        "PRAGMA journal_mode = WAL",
+        # with WAL, NORMAL only loses the last transactions on power failure and never corrupts the database
+        "PRAGMA synchronous = NORMAL",
+        "PRAGMA temp_store = MEMORY",
+        "PRAGMA cache_size = -16000",
+        "PRAGMA busy_timeout = 5000",
+        # the rows deleted by REPLACE fire the delete triggers only with recursive triggers, keeps bing.fts in sync
+        "PRAGMA recursive_triggers = ON",
+    ]
+
+    # trigram indexes any language including chinese, but only matches words of at least 3 characters
+    FTS_TOKENIZER = "trigram" if sqlite3.sqlite_version_info >= (3, 34, 0) else "unicode61 remove_diacritics 2"
+    FTS_MIN_TERM = 3 if FTS_TOKENIZER == "trigram" else 1
+    # bm25 weights of title, caption, description, copyright
+    FTS_WEIGHTS = (10.0, 5.0, 1.0, 2.0)
+    FTS_VALUES = "json_extract(new.`detail`, '$.title'), json_extract(new.`detail`, '$.caption'), " \
+                 "json_extract(new.`detail`, '$.desc'), new.`copyright`"
+    # terms too short for bing.fts are matched against the same text fields
+    LIKE_COLUMNS = ("json_extract(b.`detail`, '$.title')", "json_extract(b.`detail`, '$.caption')",
+                    "json_extract(b.`detail`, '$.desc')", "b.`copyright`")
+    FTS_INSERT_TRIGGER_SQL = """
+        INSERT INTO `bing.fts` (`rowid`, `title`, `caption`, `description`, `copyright`)
+        SELECT new.`id`, {} WHERE json_valid(new.`detail`);""".format(FTS_VALUES)
+    SEARCH_SQL = "SELECT b.`detail`, {} FROM {} WHERE {} ORDER BY {} LIMIT ?"
+    # every change of a row or of its variants takes the next value of the counter as the change_seq of the row
+    BUMP_CHANGE_SEQ_SQL = """
+        UPDATE `bing.sequence` SET `value` = `value` + 1 WHERE `name` = 'change_seq';
+        UPDATE `bing.bing` SET `_update_time` = CURRENT_TIMESTAMP,
+            `change_seq` = (SELECT `value` FROM `bing.sequence` WHERE `name` = 'change_seq') WHERE {};"""
+    # the triggers of bing.bing list the columns, so setting change_seq does not fire them again
+    CHANGE_SEQ_TRIGGERS = [
+        ("bing_change_insert", "AFTER INSERT ON `bing.bing`", "`id` = new.`id`"),
+        ("bing_change_update", "AFTER UPDATE OF `date`, `url`, `copyright`, `hsh`, `zone`, `detail`, `size`, "
+                               "`digest` ON `bing.bing`", "`id` = new.`id`"),
+        ("variant_change_insert", "AFTER INSERT ON `bing.variant`", "`hsh` = new.`hsh`"),
+        ("variant_change_update", "AFTER UPDATE OF `hsh`, `path`, `size`, `digest` ON `bing.variant`",
+         "`hsh` IN (old.`hsh`, new.`hsh`)"),
+        ("variant_change_delete", "AFTER DELETE ON `bing.variant`", "`hsh` = old.`hsh`"),
+    ]
+
+    def __init__(self, sqlite_file: str, hsh_index: bool = False):
+        """
+
+        :param sqlite_file:
+        :param hsh_index: keep all the hsh in memory, loaded in init_db and updated on every save, so existence
+                          checks do not hit the database
+        """
+        self._sqlite_file = sqlite_file
+        # the connection may be used by other threads, every access is guarded by the lock
+        self._lock = threading.RLock()
+        self._db_conn = sqlite3.connect(self._sqlite_file, check_same_thread=False)
+        for pragma in SqliteBingWallpaperManager.PRAGMAS:
+            self._db_conn.execute(pragma)
+        self._hsh_index = set() if hsh_index else None
+        self._in_batch = False
+        self._batch_hshs = []
+        # whether bing.fts exists, checked in init_db
+        self._fts = False
+
+    # schema migrations, the n-th function upgrades the database from user_version n to n + 1, append new ones to
+    # the end and never change the released ones
+    def _migrate_create_table(self, cur: sqlite3.Cursor):
+        cur.execute(SqliteBingWallpaperManager.CREATE_TABLE_SQL)
+
+    def _migrate_add_size_digest(self, cur: sqlite3.Cursor):
+        # tables created by the versions before user_version was used may already have the columns
+        columns = set(row[1] for row in cur.execute("PRAGMA table_info(`bing.bing`)"))
+        if "size" not in columns:
+            cur.execute("ALTER TABLE `bing.bing` ADD COLUMN `size` INTEGER NOT NULL DEFAULT 0")
+        if "digest" not in columns:
+            cur.execute("ALTER TABLE `bing.bing` ADD COLUMN `digest` varchar(64) NOT NULL DEFAULT ''")
+
+    def _migrate_add_date_zone_index(self, cur: sqlite3.Cursor):
+        cur.execute("CREATE INDEX IF NOT EXISTS `idx_bing_date` ON `bing.bing` (`date`)")
+        cur.execute("CREATE INDEX IF NOT EXISTS `idx_bing_zone_date` ON `bing.bing` (`zone`, `date`)")
+
+    def _migrate_create_zone_table(self, cur: sqlite3.Cursor):
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS `bing.zone` (
+                `hsh` varchar(64) NOT NULL,
+                `zone` varchar(8) NOT NULL,
+                `date` varchar(16) NOT NULL DEFAULT '',
+                `_create_time` datetime DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (`hsh`, `zone`)
+            )""")
+        cur.execute("CREATE INDEX IF NOT EXISTS `idx_zone_zone_date` ON `bing.zone` (`zone`, `date`)")
+        cur.execute("INSERT OR IGNORE INTO `bing.zone` (`hsh`, `zone`, `date`) "
+                    "SELECT `hsh`, `zone`, `date` FROM `bing.bing`")
+
+    def _migrate_create_variant_table(self, cur: sqlite3.Cursor):
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS `bing.variant` (
+                `hsh` varchar(64) NOT NULL,
+                `quality` varchar(16) NOT NULL,
+                `path` varchar(255) NOT NULL DEFAULT '',
+                `size` INTEGER NOT NULL DEFAULT 0,
+                `digest` varchar(64) NOT NULL DEFAULT '',
+                `_create_time` datetime DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (`hsh`, `quality`)
+            )""")
+        # all the wallpapers downloaded before are of the default quality
+        cur.execute("INSERT OR IGNORE INTO `bing.variant` (`hsh`, `quality`, `size`, `digest`) "
+                    "SELECT `hsh`, 'UHD_1609', `size`, `digest` FROM `bing.bing`")
+
+    def _migrate_create_checkpoint_table(self, cur: sqlite3.Cursor):
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS `bing.checkpoint` (
+                `name` varchar(64) NOT NULL PRIMARY KEY,
+                `value` text NOT NULL DEFAULT '{}',
+                `_update_time` datetime DEFAULT CURRENT_TIMESTAMP
+            )""")
+
+    def _migrate_create_fts_table(self, cur: sqlite3.Cursor):
+        try:
+            cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS `bing.fts` USING fts5("
+                        "`title`, `caption`, `description`, `copyright`, tokenize = '{}')".format(
+                            SqliteBingWallpaperManager.FTS_TOKENIZER))
+        except sqlite3.OperationalError as e:
+            # sqlite built without fts5, search falls back to scanning the detail
+            logging.warning("[BingWallpaperManager] full text search not supported, %s", e)
+            return
+        cur.execute("CREATE TRIGGER IF NOT EXISTS `bing_fts_insert` AFTER INSERT ON `bing.bing` BEGIN {} END".format(
+            SqliteBingWallpaperManager.FTS_INSERT_TRIGGER_SQL))
+        cur.execute("CREATE TRIGGER IF NOT EXISTS `bing_fts_update` AFTER UPDATE OF `detail`, `copyright` "
+                    "ON `bing.bing` BEGIN DELETE FROM `bing.fts` WHERE `rowid` = old.`id`; {} END".format(
+                        SqliteBingWallpaperManager.FTS_INSERT_TRIGGER_SQL))
+        cur.execute("CREATE TRIGGER IF NOT EXISTS `bing_fts_delete` AFTER DELETE ON `bing.bing` BEGIN "
+                    "DELETE FROM `bing.fts` WHERE `rowid` = old.`id`; END")
+        cur.execute("INSERT INTO `bing.fts` (`rowid`, `title`, `caption`, `description`, `copyright`) "
+                    "SELECT `id`, {} FROM `bing.bing` new WHERE json_valid(new.`detail`)".format(
+                        SqliteBingWallpaperManager.FTS_VALUES))
+
+    def _migrate_add_update_time_index(self, cur: sqlite3.Cursor):
+        cur.execute("CREATE INDEX IF NOT EXISTS `idx_bing_update_time` ON `bing.bing` (`_update_time`, `id`)")
+
+    def _migrate_create_claim_table(self, cur: sqlite3.Cursor):
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS `bing.claim` (
+                `hsh` varchar(64) NOT NULL,
+                `quality` varchar(16) NOT NULL,
+                `owner` varchar(128) NOT NULL,
+                `expire_time` REAL NOT NULL,
+                PRIMARY KEY (`hsh`, `quality`)
+            )""")
+        cur.execute("CREATE INDEX IF NOT EXISTS `idx_claim_owner` ON `bing.claim` (`owner`)")
+
+    def _migrate_add_variant_phash(self, cur: sqlite3.Cursor):
+        cur.execute("ALTER TABLE `bing.variant` ADD COLUMN `phash` INTEGER")
+        cur.execute("ALTER TABLE `bing.variant` ADD COLUMN `dup_of` varchar(64) NOT NULL DEFAULT ''")
+
+    def _migrate_create_derivative_table(self, cur: sqlite3.Cursor):
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS `bing.derivative` (
+                `hsh` varchar(64) NOT NULL,
+                `name` varchar(64) NOT NULL,
+                `quality` varchar(16) NOT NULL,
+                `path` varchar(255) NOT NULL,
+                `size` INTEGER NOT NULL DEFAULT 0,
+                `digest` varchar(64) NOT NULL DEFAULT '',
+                `_create_time` datetime DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (`hsh`, `name`)
+            )""")
+
+    def _migrate_add_change_seq(self, cur: sqlite3.Cursor):
+        cur.execute("ALTER TABLE `bing.bing` ADD COLUMN `change_seq` INTEGER NOT NULL DEFAULT 0")
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS `bing.sequence` (
+                `name` varchar(64) NOT NULL PRIMARY KEY,
+                `value` INTEGER NOT NULL DEFAULT 0
+            )""")
+        # the existing rows are numbered in the order of the old watermark (_update_time, id)
+        ids = [row[0] for row in cur.execute("SELECT `id` FROM `bing.bing` ORDER BY `_update_time`, `id`")]
+        cur.executemany("UPDATE `bing.bing` SET `change_seq` = ? WHERE `id` = ?",
+                        ((seq, row_id) for seq, row_id in enumerate(ids, start=1)))
+        cur.execute("INSERT INTO `bing.sequence` (`name`, `value`) VALUES ('change_seq', ?)", (len(ids),))
+        cur.execute("CREATE INDEX IF NOT EXISTS `idx_bing_change_seq` ON `bing.bing` (`change_seq`)")
+        for name, event, where in SqliteBingWallpaperManager.CHANGE_SEQ_TRIGGERS:
+            cur.execute("CREATE TRIGGER IF NOT EXISTS `{}` {} BEGIN {} END".format(
+                name, event, SqliteBingWallpaperManager.BUMP_CHANGE_SEQ_SQL.format(where)))
+        # the saved export watermarks (_update_time, id) become the change_seq given to the row they point to
+        for name, value in cur.execute("SELECT `name`, `value` FROM `bing.checkpoint` WHERE `name` LIKE 'export:%'") \
+                .fetchall():
+            watermark = json.loads(value)
+            if "update_time" not in watermark:
+                continue
+            seq = cur.execute("SELECT COUNT(*) FROM `bing.bing` WHERE (`_update_time`, `id`) <= (?, ?)",
+                              (watermark["update_time"], watermark["id"])).fetchone()[0]
+            cur.execute(SqliteBingWallpaperManager.SAVE_CHECKPOINT_SQL, (name, json.dumps({"change_seq": seq})))
+
+    MIGRATIONS = [
+        _migrate_create_table,
+        _migrate_add_size_digest,
+        _migrate_add_date_zone_index,
+        _migrate_create_zone_table,
+        _migrate_create_variant_table,
+        _migrate_create_checkpoint_table,
+        _migrate_create_fts_table,
+        _migrate_add_update_time_index,
+        _migrate_create_claim_table,
+        _migrate_add_variant_phash,
+        _migrate_create_derivative_table,
+        _migrate_add_change_seq,
+    ]
+
+    def schema_version(self) -> int:
+        with self._lock:
+            return self._db_conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def init_db(self):
+        with self._lock:
+            migrations = SqliteBingWallpaperManager.MIGRATIONS
+            while self.schema_version() < len(migrations):
+                cur = self._db_conn.cursor()
+                try:
+                    # the version is read again after taking the write lock, replicas starting at the same time
+                    # never run the same migration twice
+                    cur.execute("BEGIN IMMEDIATE")
+                    version = cur.execute("PRAGMA user_version").fetchone()[0]
+                    if version >= len(migrations):
+                        cur.execute("COMMIT")
+                        break
+                    migrations[version](self, cur)
+                    # PRAGMA does not accept parameters
+                    cur.execute("PRAGMA user_version = {}".format(version + 1))
+                    cur.execute("COMMIT")
+                except Exception:
+                    cur.execute("ROLLBACK")
+                    raise
+                logging.info("[BingWallpaperManager] migrate database %s to version %d", self._sqlite_file,
+                             version + 1)
+
+            self._fts = self._db_conn.execute("SELECT 1 FROM `sqlite_master` WHERE `name` = 'bing.fts'").fetchone() \
+                is not None
+            if self._hsh_index is not None:
+                cur = self._db_conn.cursor()
+                self._hsh_index = set(row[0] for row in cur.execute(SqliteBingWallpaperManager.LOAD_HSH_SQL))
+                logging.info("[BingWallpaperManager] load %d hsh into index", len(self._hsh_index))
+
+    def clean_db(self):
+        if not os.path.exists(self._sqlite_file):
+            return
+        with self._lock:
+            self._db_conn.execute(SqliteBingWallpaperManager.CLEAN_DB_SQL)
+            self._db_conn.execute(SqliteBingWallpaperManager.CLEAN_ZONE_SQL)
+            self._db_conn.execute(SqliteBingWallpaperManager.CLEAN_VARIANT_SQL)
+            self._db_conn.execute(SqliteBingWallpaperManager.CLEAN_DERIVATIVE_SQL)
+            self._db_conn.commit()
+            if self._hsh_index is not None:
+                self._hsh_index = set()
+
+    @OPERATION_DURATION.time(operation="wallpaper_exist")
+    def wallpaper_exist(self, hsh: str) -> bool:
+        with self._lock:
+            if self._hsh_index is not None:
+                return hsh in self._hsh_index
+            cur = self._db_conn.cursor()
+            res = cur.execute(SqliteBingWallpaperManager.CHECK_HSH_SQL, (hsh,))
+            rows = res.fetchall()
+            return rows is not None and len(rows) > 0
+
+    @OPERATION_DURATION.time(operation="wallpapers_exist")
+    def wallpapers_exist(self, hshs: Iterable[str]) -> set[str]:
+        hshs = list(dict.fromkeys(hshs))
+        with self._lock:
+            if self._hsh_index is not None:
+                return set(hsh for hsh in hshs if hsh in self._hsh_index)
+
+            exist = set()
+            cur = self._db_conn.cursor()
+            batch_size = SqliteBingWallpaperManager.CHECK_HSHS_BATCH
+            for i in range(0, len(hshs), batch_size):
+                batch = hshs[i:i + batch_size]
+                sql = SqliteBingWallpaperManager.CHECK_HSHS_SQL.format(", ".join("?" * len(batch)))
+                exist.update(row[0] for row in cur.execute(sql, batch))
+            return exist
+
+    @OPERATION_DURATION.time(operation="save_wallpaper_info")
+    def save_wallpaper_info(self, wallpaper_info: BingWallpaperInfo, size: int = 0, digest: str = ''):
+        with self._lock:
+            cur = self._db_conn.cursor()
+            cur.execute(SqliteBingWallpaperManager.INSERT_IMG_SQL,
+                        (wallpaper_info.startdate, wallpaper_info.url, wallpaper_info.copyright, wallpaper_info.hsh,
+                         wallpaper_info.zone, wallpaper_info.tojson(), size, digest))
+            cur.execute(SqliteBingWallpaperManager.INSERT_ZONE_SQL,
+                        (wallpaper_info.hsh, wallpaper_info.zone, wallpaper_info.startdate))
+            if self._in_batch:
+                self._batch_hshs.append(wallpaper_info.hsh)
+                return
+            self._db_conn.commit()
+            if self._hsh_index is not None:
+                self._hsh_index.add(wallpaper_info.hsh)
+
+    def save_wallpaper_zones(self, wallpapers: Iterable[BingWallpaperInfo]):
+        with self._lock:
+            cur = self._db_conn.cursor()
+            cur.executemany(SqliteBingWallpaperManager.INSERT_ZONE_SQL,
+                            ((w.hsh, w.zone, w.startdate) for w in wallpapers))
+            if not self._in_batch:
+                self._db_conn.commit()
+
+    def rebuilt_wallpapers(self, dates: Iterable[str]) -> list[tuple[str, str, str]]:
+        dates = list(dict.fromkeys(dates))
+        rows = []
+        with self._lock:
+            cur = self._db_conn.cursor()
+            batch_size = SqliteBingWallpaperManager.CHECK_HSHS_BATCH
+            for i in range(0, len(dates), batch_size):
+                batch = dates[i:i + batch_size]
+                sql = SqliteBingWallpaperManager.REBUILT_SQL.format(", ".join("?" * len(batch)))
+                rows.extend(cur.execute(sql, batch))
+        return rows
+
+    def replace_wallpaper(self, old_hsh: str, wallpaper_info: BingWallpaperInfo):
+        new_hsh = wallpaper_info.hsh
+        with self._lock:
+            cur = self._db_conn.cursor()
+            if cur.execute(SqliteBingWallpaperManager.CHECK_HSH_SQL, (new_hsh,)).fetchone():
+                cur.execute(SqliteBingWallpaperManager.DELETE_IMG_SQL, (old_hsh,))
+            else:
+                cur.execute(SqliteBingWallpaperManager.REPLACE_IMG_SQL,
+                            (wallpaper_info.startdate, wallpaper_info.url, wallpaper_info.copyright, new_hsh,
+                             wallpaper_info.zone, wallpaper_info.tojson(), old_hsh))
+            for table in SqliteBingWallpaperManager.HSH_TABLES:
+                cur.execute("UPDATE OR IGNORE `{}` SET `hsh` = ? WHERE `hsh` = ?".format(table), (new_hsh, old_hsh))
+                cur.execute("DELETE FROM `{}` WHERE `hsh` = ?".format(table), (old_hsh,))
+            cur.execute(SqliteBingWallpaperManager.REPLACE_DUP_OF_SQL, (new_hsh, old_hsh))
+            cur.execute(SqliteBingWallpaperManager.DELETE_ZONES_SQL, (old_hsh,))
+            cur.execute(SqliteBingWallpaperManager.INSERT_ZONE_SQL,
+                        (new_hsh, wallpaper_info.zone, wallpaper_info.startdate))
+            if self._hsh_index is not None:
+                self._hsh_index.discard(old_hsh)
+            if self._in_batch:
+                self._batch_hshs.append(new_hsh)
+                return
+            self._db_conn.commit()
+            if self._hsh_index is not None:
+                self._hsh_index.add(new_hsh)
+
+    def variants_exist(self, hshs: Iterable[str]) -> dict[str, set[str]]:
+        hshs = list(dict.fromkeys(hshs))
+        variants = {}
+        with self._lock:
+            cur = self._db_conn.cursor()
+            batch_size = SqliteBingWallpaperManager.CHECK_HSHS_BATCH
+            for i in range(0, len(hshs), batch_size):
+                batch = hshs[i:i + batch_size]
+                sql = SqliteBingWallpaperManager.CHECK_VARIANTS_SQL.format(", ".join("?" * len(batch)))
+                for hsh, quality in cur.execute(sql, batch):
+                    variants.setdefault(hsh, set()).add(quality)
+        return variants
+
+    @OPERATION_DURATION.time(operation="save_wallpaper_variant")
+    def save_wallpaper_variant(self, hsh: str, quality: str, path: str, size: int = 0, digest: str = '',
+                               phash: int = None, dup_of: str = ''):
+        with self._lock:
+            self._db_conn.execute(SqliteBingWallpaperManager.INSERT_VARIANT_SQL,
+                                  (hsh, quality, path, size, digest,
+                                   to_signed(phash) if phash is not None else None, dup_of))
+            if not self._in_batch:
+                self._db_conn.commit()
+
+    def list_variant_phashes(self) -> Iterator[tuple[str, str, str, int, str, int]]:
+        with self._lock:
+            rows = self._db_conn.execute(SqliteBingWallpaperManager.LIST_PHASHES_SQL).fetchall()
+        for hsh, quality, path, size, digest, phash in rows:
+            yield hsh, quality, path, size, digest, to_unsigned(phash)
+
+    def list_variants(self) -> list[StoredVariant]:
+        with self._lock:
+            rows = self._db_conn.execute(SqliteBingWallpaperManager.LIST_VARIANTS_SQL).fetchall()
+        return [StoredVariant(*row) for row in rows]
+
+    def list_variant_paths(self, after_hsh: str = '', limit: int = 1000) -> list[tuple[str, str, str]]:
+        with self._lock:
+            return self._db_conn.execute(SqliteBingWallpaperManager.LIST_VARIANT_PATHS_SQL,
+                                         (after_hsh, limit)).fetchall()
+
+    def variant_paths(self, hshs: Iterable[str]) -> list[tuple[str, str, str]]:
+        hshs = list(dict.fromkeys(hshs))
+        paths = []
+        with self._lock:
+            cur = self._db_conn.cursor()
+            batch_size = SqliteBingWallpaperManager.CHECK_HSHS_BATCH
+            for i in range(0, len(hshs), batch_size):
+                batch = hshs[i:i + batch_size]
+                sql = SqliteBingWallpaperManager.VARIANT_PATHS_SQL.format(", ".join("?" * len(batch)))
+                paths.extend(cur.execute(sql, batch))
+        return paths
+
+    def delete_wallpaper_variant(self, hsh: str, quality: str):
+        with self._lock:
+            self._db_conn.execute(SqliteBingWallpaperManager.DELETE_VARIANT_SQL, (hsh, quality))
+            if not self._in_batch:
+                self._db_conn.commit()
+
+    def derivatives_exist(self, hshs: Iterable[str]) -> dict[str, set[str]]:
+        hshs = list(dict.fromkeys(hshs))
+        derivatives = {}
+        with self._lock:
+            cur = self._db_conn.cursor()
+            batch_size = SqliteBingWallpaperManager.CHECK_HSHS_BATCH
+            for i in range(0, len(hshs), batch_size):
+                batch = hshs[i:i + batch_size]
+                sql = SqliteBingWallpaperManager.CHECK_DERIVATIVES_SQL.format(", ".join("?" * len(batch)))
+                for hsh, name in cur.execute(sql, batch):
+                    derivatives.setdefault(hsh, set()).add(name)
+        return derivatives
+
+    def save_derivative(self, hsh: str, name: str, quality: str, path: str, size: int = 0, digest: str = ''):
+        with self._lock:
+            self._db_conn.execute(SqliteBingWallpaperManager.INSERT_DERIVATIVE_SQL,
+                                  (hsh, name, quality, path, size, digest))
+            if not self._in_batch:
+                self._db_conn.commit()
+
+    @staticmethod
+    def _fts_phrase(term: str) -> str:
+        return '"{}"'.format(term.replace('"', '""'))
+
+    def search_wallpapers(self, text: str = None, start_date: str = None, end_date: str = None, zone: str = None,
+                          limit: int = 100) -> Iterator[SearchHit]:
+        terms = text.split() if text else []
+        match_terms = [t for t in terms if self._fts and len(t) >= SqliteBingWallpaperManager.FTS_MIN_TERM]
+        like_terms = [t for t in terms if t not in match_terms]
+
+        conditions = []
+        params = []
+        if match_terms:
+            tables = "`bing.fts` JOIN `bing.bing` b ON b.`id` = `bing.fts`.`rowid`"
+            rank = "bm25(`bing.fts`, {})".format(", ".join(str(w) for w in SqliteBingWallpaperManager.FTS_WEIGHTS))
+            order = "score"
+            conditions.append("`bing.fts` MATCH ?")
+            params.append(" ".join(self._fts_phrase(t) for t in match_terms))
+        else:
+            tables = "`bing.bing` b"
+            rank = "0.0"
+            order = "b.`date` DESC"
+        for t in like_terms:
+            # only the text fields, the url, the hsh and the key names in the detail would match most short terms
+            columns = SqliteBingWallpaperManager.LIKE_COLUMNS
+            pattern = "%{}%".format(t.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+            conditions.append("({})".format(" OR ".join("{} LIKE ? ESCAPE '\\'".format(c) for c in columns)))
+            params.extend([pattern] * len(columns))
+        if start_date:
+            conditions.append("b.`date` >= ?")
+            params.append(start_date)
+        if end_date:
+            conditions.append("b.`date` <= ?")
+            params.append(end_date)
+        if zone:
+            conditions.append("(b.`zone` = ? OR EXISTS (SELECT 1 FROM `bing.zone` z WHERE z.`hsh` = b.`hsh` "
+                              "AND z.`zone` = ?))")
+            params.extend([zone, zone])
+        sql = SqliteBingWallpaperManager.SEARCH_SQL.format(
+            rank + " AS score", tables, " AND ".join(conditions) if conditions else "1", order)
+        params.append(limit)
+
+        with self._lock:
+            cur = self._db_conn.execute(sql, params)
+        while True:
+            # hold the lock only while fetching, so a long stream does not block the downloads
+            with self._lock:
+                rows = cur.fetchmany(256)
+            if not rows:
+                return
+            for detail, rank in rows:
+                try:
+                    yield SearchHit(wallpaper=BingWallpaperInfo.fromjson(detail), rank=rank)
+                except Exception as e:
+                    logging.warning("[BingWallpaperManager] skip broken detail, %s", e)
+
+    def latest_wallpapers(self, zone: str = None) -> list[tuple[str, BingWallpaperInfo]]:
+        sql = SqliteBingWallpaperManager.LATEST_SQL.format("AND z.`zone` = ?" if zone else "")
+        with self._lock:
+            rows = self._db_conn.execute(sql, (zone,) if zone else ()).fetchall()
+        latest = {}
+        for row_zone, detail in rows:
+            if row_zone in latest:
+                # several wallpapers of one day, the last saved one
+                continue
+            try:
+                latest[row_zone] = BingWallpaperInfo.fromjson(detail)
+            except Exception as e:
+                logging.warning("[BingWallpaperManager] skip broken detail, %s", e)
+        return list(latest.items())
+
+    def get_wallpaper(self, hsh: str) -> BingWallpaperInfo:
+        with self._lock:
+            row = self._db_conn.execute(SqliteBingWallpaperManager.GET_WALLPAPER_SQL, (hsh,)).fetchone()
+        return BingWallpaperInfo.fromjson(row[0]) if row and row[0] else None
+
+    def wallpaper_files(self, hsh: str) -> list[StoredFile]:
+        with self._lock:
+            rows = self._db_conn.execute(SqliteBingWallpaperManager.WALLPAPER_FILES_SQL, (hsh, hsh)).fetchall()
+        return [StoredFile(*row) for row in rows]
+
+    def iter_wallpapers(self, since: int = 0, batch_size: int = 1000, updated_after: str = None) -> Iterator[dict]:
+        # keyset pagination, every batch is a short query, so the lock is never held while the caller works
+        sql = SqliteBingWallpaperManager.ITER_SQL.format("AND b.`_update_time` >= ?" if updated_after else "")
+        last = since if since else 0
+        while True:
+            params = (last, updated_after, batch_size) if updated_after else (last, batch_size)
+            with self._lock:
+                rows = self._db_conn.execute(sql, params).fetchall()
+            for row in rows:
+                yield dict(zip(SqliteBingWallpaperManager.ITER_COLUMNS, row))
+            if len(rows) < batch_size:
+                return
+            last = rows[-1][11]
+
+    def load_checkpoint(self, name: str) -> dict:
+        with self._lock:
+            row = self._db_conn.execute(SqliteBingWallpaperManager.LOAD_CHECKPOINT_SQL, (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_checkpoint(self, name: str, value: dict):
+        with self._lock:
+            self._db_conn.execute(SqliteBingWallpaperManager.SAVE_CHECKPOINT_SQL, (name, json.dumps(value)))
+            if not self._in_batch:
+                self._db_conn.commit()
+
+    @OPERATION_DURATION.time(operation="claim_variants")
+    def claim_variants(self, keys: Iterable[tuple[str, str]], owner: str, ttl: float) -> set[tuple[str, str]]:
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        claimed = set()
+        with self._lock:
+            cur = self._db_conn.cursor()
+            # the first write takes the database lock, the claims of all the replicas are serialized
+            cur.execute(SqliteBingWallpaperManager.EXPIRE_CLAIMS_SQL, (now,))
+            for hsh, quality in keys:
+                cur.execute(SqliteBingWallpaperManager.CLAIM_SQL, (hsh, quality, owner, now + ttl, hsh, quality))
+                if cur.execute(SqliteBingWallpaperManager.CHECK_CLAIM_SQL, (hsh, quality, owner)).fetchone():
+                    claimed.add((hsh, quality))
+            if not self._in_batch:
+                self._db_conn.commit()
+        return claimed
+
+    def renew_claims(self, owner: str, ttl: float) -> set[tuple[str, str]]:
+        with self._lock:
+            self._db_conn.execute(SqliteBingWallpaperManager.RENEW_CLAIMS_SQL, (time.time() + ttl, owner))
+            held = set(self._db_conn.execute(SqliteBingWallpaperManager.LIST_CLAIMS_SQL, (owner,)))
+            if not self._in_batch:
+                self._db_conn.commit()
+            return held
+
+    def release_claims(self, keys: Iterable[tuple[str, str]], owner: str):
+        with self._lock:
+            self._db_conn.executemany(SqliteBingWallpaperManager.RELEASE_CLAIM_SQL,
+                                      ((hsh, quality, owner) for hsh, quality in keys))
+            if not self._in_batch:
+                self._db_conn.commit()
+
+    @contextmanager
+    def batch(self):
+        with self._lock:
+            if self._in_batch:
+                # nested batch joins the outer transaction
+                yield
+                return
+            self._in_batch = True
+            self._batch_hshs = []
+            try:
+                yield
+                self._db_conn.commit()
+                if self._hsh_index is not None:
+                    self._hsh_index.update(self._batch_hshs)
+            except BaseException:
+                self._db_conn.rollback()
+                raise
+            finally:
+                self._in_batch = False
+                self._batch_hshs = []
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+import logging
+import os
+import time
+from dataclasses import dataclass
+from enum import Enum
+
+from file_util import fsync_dir, temp_name
+from manifest import Manifest
+from metrics import DEDUPLICATED_BYTES
+
+
+class BlobLinkMode(Enum):
+    OFF = 'OFF'
+    HARDLINK = 'HARDLINK'
+    SYMLINK = 'SYMLINK'
+
+    def __str__(self):
+        return self.value
+
+
+@dataclass
+class DedupReport:
+    files: int = 0
+    # files replaced by a link to a blob of the same content
+    deduplicated: int = 0
+    saved_bytes: int = 0
+    # blobs no longer linked from the download tree
+    removed_blobs: int = 0
+    failed: int = 0
+
+
+class BlobStore(object):
+    """
+    Content addressed storage under `<download path>/.blobs`: every distinct image is stored once, as
+    `.blobs/<first 2 hex>/<sha256><ext>`, and the usual `YYYYMM/date_id` paths are hard or symbolic links to it, so
+    an image republished on another date or in another market takes no space. The directory is hidden, the
+    manifest and the verifier only see the links.
+    """
+
+    DIR_NAME = ".blobs"
+    # seconds a blob is kept by gc after it was stored or reused, a put may be about to link it
+    GC_GRACE = 3600
+
+    def __init__(self, download_path: str, mode: BlobLinkMode = BlobLinkMode.HARDLINK):
+        """
+
+        :param mode: HARDLINK needs the blobs and the links on one file system, the links of SYMLINK are relative so
+                     the tree can be moved as a whole
+        """
+        self._download_path = download_path
+        self._root = os.path.join(download_path, BlobStore.DIR_NAME)
+        self._mode = mode
+
+    def blob_path(self, digest: str, ext: str) -> str:
+        return os.path.join(self._root, digest[:2], digest + ext.lower())
+
+    def _link(self, blob: str, file_name: str):
+        """
+        Point file_name at blob, replacing what file_name was atomically.
+        """
+        file_dir = os.path.dirname(file_name)
+        os.makedirs(file_dir, exist_ok=True)
+        tmp_name = temp_name(file_name)
+        if self._mode == BlobLinkMode.SYMLINK:
+            os.symlink(os.path.relpath(blob, file_dir), tmp_name)
+        else:
+            os.link(blob, tmp_name)
+        try:
+            os.replace(tmp_name, file_name)
+        except BaseException:
+            os.remove(tmp_name)
+            raise
+        fsync_dir(file_dir)
+
+    def _same(self, blob: str, file_name: str) -> bool:
+        try:
+            return os.path.samefile(blob, file_name)
+        except OSError:
+            return False
+
+    def ingest(self, src: str, digest: str, file_name: str) -> bool:
+        """
+        Store a complete file as a blob, unless the same content is already stored, and link file_name to it.
+
+        :param src: the file just written, moved into the store or removed
+        :param digest: sha256 of src
+        :param file_name: where the file is expected, e.g. 202002/20200229_OHR.WallaceFF_EN-CN6550155171_UHD.jpg
+        :return: True if the content was already stored and src was dropped
+        """
+        blob = self.blob_path(digest, os.path.splitext(file_name)[1])
+        size = os.path.getsize(src)
+        if os.path.exists(blob) and os.path.getsize(blob) == size:
+            try:
+                # a blob not linked any more is only removed by gc once older than GC_GRACE
+                os.utime(blob)
+                self._link(blob, file_name)
+            except FileNotFoundError:
+                # removed by a gc running at the same time, src is stored instead
+                logging.info("[BlobStore] %s was removed, store it again", blob)
+            else:
+                os.remove(src)
+                DEDUPLICATED_BYTES.inc(size)
+                logging.info("[BlobStore] %s is the same as %s, not stored again", file_name, blob)
+                return True
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        os.replace(src, blob)
+        os.utime(blob)
+        fsync_dir(os.path.dirname(blob))
+        self._link(blob, file_name)
+        return False
+
+    def dedup(self, manifest: Manifest) -> DedupReport:
+        """
+        Move an existing download tree into the store: the first file of each content becomes the blob, in place
+        with HARDLINK, and all the files are replaced by links to it. Safe to run again, e.g. after an interruption.
+        """
+        report = DedupReport()
+        entries = manifest.scan()
+        for entry in sorted(entries.values(), key=lambda e: e.path):
+            report.files += 1
+            file_name = manifest.full_path(entry.path)
+            try:
+                digest = manifest.digest(entry)
+                blob = self.blob_path(digest, os.path.splitext(file_name)[1])
+                if self._same(blob, file_name):
+                    continue
+                if os.path.exists(blob) and os.path.getsize(blob) == entry.size:
+                    self._link(blob, file_name)
+                    report.deduplicated += 1
+                    report.saved_bytes += entry.size
+                    DEDUPLICATED_BYTES.inc(entry.size)
+                else:
+                    os.makedirs(os.path.dirname(blob), exist_ok=True)
+                    if self._mode == BlobLinkMode.SYMLINK:
+                        os.replace(file_name, blob)
+                        self._link(blob, file_name)
+                    else:
+                        # the file itself becomes the blob, nothing is copied
+                        if os.path.lexists(blob):
+                            os.remove(blob)
+                        os.link(file_name, blob)
+                    fsync_dir(os.path.dirname(blob))
+                manifest.update(entry.path, digest)
+            except OSError as e:
+                report.failed += 1
+                logging.error("[BlobStore] failed to move %s into the blob store, msg: %s", entry.path, e)
+            if report.files % 1000 == 0:
+                # keep the digests if interrupted
+                manifest.save()
+        manifest.save()
+        report.removed_blobs = self.gc()
+        logging.info("[BlobStore] files: %d, deduplicated: %d, saved: %d bytes, removed blobs: %d, failed: %d",
+                     report.files, report.deduplicated, report.saved_bytes, report.removed_blobs, report.failed)
+        return report
+
+    def gc(self, grace: float = GC_GRACE) -> int:
+        """
+        Remove the blobs not linked from the download tree any more, e.g. of the deleted variants. Only possible
+        with HARDLINK, symbolic links are not counted by the file system.
+
+        :param grace: seconds, the blobs stored or reused more recently are kept, an ingest running at the same
+                      time may not have linked them yet
+        :return: the number of removed blobs
+        """
+        if self._mode != BlobLinkMode.HARDLINK or not os.path.isdir(self._root):
+            return 0
+        expire = time.time() - grace
+        removed = 0
+        for prefix in os.scandir(self._root):
+            if not prefix.is_dir(follow_symlinks=False):
+                continue
+            for blob in os.scandir(prefix.path):
+                if not blob.is_file(follow_symlinks=False):
+                    continue
+                st = blob.stat(follow_symlinks=False)
+                if st.st_nlink == 1 and st.st_mtime < expire:
+                    os.remove(blob.path)
+                    removed += 1
+        return removed
@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from enum import Enum
+from typing import Iterable
+
+from bing_client import BingWallpaperClient, WallpaperQuality
+from bing_storage import BingWallpaperManager
+from file_util import write_file_atomic
+from metrics import DERIVATIVES
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+
+class DerivativeFormat(Enum):
+    JPEG = 'JPEG'
+    WEBP = 'WEBP'
+    # Pillow 11.3 or later built with libavif
+    AVIF = 'AVIF'
+
+    def __str__(self):
+        return self.value
+
+    @property
+    def ext(self) -> str:
+        return ".jpg" if self == DerivativeFormat.JPEG else "." + self.value.lower()
+
+
+@dataclass(frozen=True)
+class DerivativeSpec:
+    name: str
+    width: int
+    height: int
+    fmt: DerivativeFormat = DerivativeFormat.JPEG
+    quality: int = 85
+
+    def __str__(self):
+        return "{}={}x{}:{}:{}".format(self.name, self.width, self.height, self.fmt, self.quality)
+
+    @staticmethod
+    def parse(text: str) -> 'DerivativeSpec':
+        """
+
+        :param text: `name=WIDTHxHEIGHT[:FORMAT[:QUALITY]]`, e.g. thumb=320x180:WEBP:80, or a WallpaperQuality name
+                     for a JPEG of its size, e.g. FHD_1609
+        """
+        text = text.strip()
+        if text in WallpaperQuality.__members__:
+            width, height = BingWallpaperClient.WALLPAPER_WH[WallpaperQuality[text]]
+            return DerivativeSpec(text, width, height)
+        try:
+            name, rest = text.split("=", 1)
+            parts = rest.split(":")
+            width, height = (int(v) for v in parts[0].lower().split("x"))
+            fmt = DerivativeFormat(parts[1].upper()) if len(parts) > 1 and parts[1] else DerivativeFormat.JPEG
+            quality = int(parts[2]) if len(parts) > 2 else 85
+        except ValueError:
+            raise ValueError("invalid derivative {}, expect name=WIDTHxHEIGHT[:FORMAT[:QUALITY]]".format(text))
+        if not name.strip() or width <= 0 or height <= 0 or not 0 < quality <= 100:
+            raise ValueError("invalid derivative {}".format(text))
+        return DerivativeSpec(name.strip(), width, height, fmt, quality)
+
+    @staticmethod
+    def parse_list(text: str) -> list['DerivativeSpec']:
+        specs = [DerivativeSpec.parse(t) for t in text.split(",") if t.strip()]
+        names = [spec.name for spec in specs]
+        if len(set(names)) != len(names):
+            raise ValueError("duplicate derivative names in {}".format(text))
+        return specs
+
+
+def available() -> bool:
+    return Image is not None
+
+
+def render(source: str, outputs: list[tuple[DerivativeSpec, str]]) -> list[tuple[str, int, str]]:
+    """
+    Run in the worker processes: decode the source once, JPEG at the smallest scale still larger than the largest
+    output, and write every output cropped to its aspect ratio and resized.
+
+    :param outputs: (spec, file name)
+    :return: (name, size, sha256) of every output
+    """
+    largest = max((spec for spec, _ in outputs), key=lambda spec: spec.width * spec.height)
+    with Image.open(source) as img:
+        img.draft("RGB", (largest.width, largest.height))
+        img = img.convert("RGB")
+    rendered = []
+    for spec, file_name in outputs:
+        out = ImageOps.fit(img, (spec.width, spec.height), Image.LANCZOS)
+        buf = io.BytesIO()
+        out.save(buf, spec.fmt.value, quality=spec.quality)
+        data = buf.getvalue()
+        write_file_atomic(file_name, [data])
+        rendered.append((spec.name, len(data), hashlib.sha256(data).hexdigest()))
+    return rendered
+
+
+@dataclass
+class DerivativeReport:
+    # wallpapers looked at
+    wallpapers: int = 0
+    # wallpapers having all the derivatives already
+    skipped: int = 0
+    generated: int = 0
+    failed: int = 0
+
+    def add(self, other: 'DerivativeReport'):
+        self.wallpapers += other.wallpapers
+        self.skipped += other.skipped
+        self.generated += other.generated
+        self.failed += other.failed
+
+
+class DerivativeGenerator(object):
+    """
+    Generates smaller renditions of the downloaded wallpapers on a process pool, decoding a UHD JPEG takes far more
+    CPU than downloading it and the GIL would serialize it on threads. Each wallpaper is decoded once, from its
+    largest stored variant, for all of its missing derivatives, written under `<download path>/.derivatives/<name>`
+    with the layout of the variants, and recorded in the storage, so the work is incremental: the new wallpapers
+    of every round, and `backfill` over the existing tree resumed from a checkpoint.
+    """
+
+    DIR_NAME = ".derivatives"
+    CHECKPOINT_NAME = "derivatives"
+
+    def __init__(self,
+                 wallpaper_mgr: BingWallpaperManager,
+                 download_path: str,
+                 specs: list[DerivativeSpec],
+                 workers: int = 0,
+                 batch_size: int = 64):
+        """
+
+        :param workers: processes of the pool, 0 means the number of cores
+        :param batch_size: wallpapers of one backfill step, the checkpoint is saved after every step
+        """
+        if not available():
+            raise Exception("Pillow is required to generate derivatives, pip install Pillow")
+        Image.init()
+        for spec in specs:
+            if spec.fmt.value not in Image.SAVE:
+                raise Exception("Pillow can not write {}, required by derivative {}".format(spec.fmt, spec.name))
+        self._wallpaper_mgr = wallpaper_mgr
+        self._download_path = download_path
+        self._specs = specs
+        self._workers = workers if workers > 0 else os.cpu_count() or 1
+        self._batch_size = max(1, batch_size)
+        self._executor = None
+
+    def derivative_path(self, spec: DerivativeSpec, variant_path: str) -> str:
+        """
+
+        :param variant_path: relative to the download path, e.g. 202002/20200229_OHR.WallaceFF_EN-CN6550155171_UHD.jpg
+        :return: relative to the download path, e.g. .derivatives/thumb/202002/20200229_OHR.WallaceFF_..._UHD.webp
+        """
+        root = os.path.splitext(variant_path)[0]
+        return os.path.join(DerivativeGenerator.DIR_NAME, spec.name, root + spec.fmt.ext)
+
+    @staticmethod
+    def _source(variants: list[tuple[str, str]]) -> tuple[str, str]:
+        """
+        The (quality, path) of the largest variant.
+        """
+        def area(item: tuple[str, str]) -> int:
+            quality = WallpaperQuality.__members__.get(item[0])
+            width, height = BingWallpaperClient.WALLPAPER_WH.get(quality, (0, 0))
+            return width * height
+        return max(variants, key=area)
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn, forking a process running the download, heartbeat and metrics threads is not safe
+            self._executor = ProcessPoolExecutor(max_workers=self._workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def generate(self, variants: Iterable[tuple[str, str, str]], checkpoint: dict = None) -> DerivativeReport:
+        """
+        Generate the missing derivatives of the wallpapers, and wait for them.
+
+        :param variants: (hsh, quality, path) of the stored variants
+        :param checkpoint: saved in the transaction recording the derivatives, if none of them failed
+        """
+        by_hsh = {}
+        for hsh, quality, path in variants:
+            by_hsh.setdefault(hsh, []).append((quality, path))
+        report = DerivativeReport(wallpapers=len(by_hsh))
+        done = self._wallpaper_mgr.derivatives_exist(by_hsh.keys()) if by_hsh else {}
+
+        jobs = []
+        for hsh, hsh_variants in by_hsh.items():
+            missing = [spec for spec in self._specs if spec.name not in done.get(hsh, set())]
+            if not missing:
+                report.skipped += 1
+                continue
+            quality, path = self._source(hsh_variants)
+            outputs = [(spec, os.path.join(self._download_path, self.derivative_path(spec, path))) for spec in missing]
+            future = self._pool().submit(render, os.path.join(self._download_path, path), outputs)
+            jobs.append((hsh, quality, path, missing, future))
+
+        rendered = []
+        for hsh, quality, path, missing, future in jobs:
+            try:
+                rendered.append((hsh, quality, path, future.result()))
+            except Exception as e:
+                report.failed += 1
+                DERIVATIVES.inc(len(missing), result="failed")
+                logging.error("[Derivative] failed to generate %s of %s, msg: %s",
+                              ",".join(spec.name for spec in missing), path, e)
+
+        specs = {spec.name: spec for spec in self._specs}
+        with self._wallpaper_mgr.batch():
+            for hsh, quality, path, outputs in rendered:
+                for name, size, digest in outputs:
+                    self._wallpaper_mgr.save_derivative(hsh, name, quality, self.derivative_path(specs[name], path),
+                                                        size=size, digest=digest)
+                    report.generated += 1
+                    DERIVATIVES.inc(result="generated")
+            if checkpoint is not None and report.failed == 0:
+                self._wallpaper_mgr.save_checkpoint(DerivativeGenerator.CHECKPOINT_NAME, checkpoint)
+        return report
+
+    def generate_wallpapers(self, hshs: Iterable[str]) -> DerivativeReport:
+        """
+        Generate the derivatives of the wallpapers just saved.
+        """
+        hshs = list(hshs)
+        if not hshs:
+            return DerivativeReport()
+        report = self.generate(self._wallpaper_mgr.variant_paths(hshs))
+        logging.info("[Derivative] %d wallpapers, generated: %d, failed: %d", report.wallpapers, report.generated,
+                     report.failed)
+        return report
+
+    def backfill(self, restart: bool = False) -> DerivativeReport:
+        """
+        Generate the derivatives of all the stored wallpapers in hsh order, the checkpoint is the last hsh before
+        which all of them are generated, and is discarded when the configured derivatives changed.
+
+        :param restart: ignore the checkpoint, the wallpapers having all the derivatives are still skipped
+        """
+        specs = [str(spec) for spec in self._specs]
+        checkpoint = {} if restart else self._wallpaper_mgr.load_checkpoint(DerivativeGenerator.CHECKPOINT_NAME) or {}
+        after = checkpoint.get("after_hsh", "") if checkpoint.get("specs") == specs else ""
+        if after:
+            logging.info("[Derivative] resume after hsh %s", after)
+
+        total = DerivativeReport()
+        while True:
+            variants = self._wallpaper_mgr.list_variant_paths(after, self._batch_size)
+            if not variants:
+                break
+            after = variants[-1][0]
+            # once a wallpaper failed the checkpoint stays before it, the later ones are still generated and
+            # skipped by the next backfill
+            report = self.generate(variants, {"after_hsh": after, "specs": specs} if total.failed == 0 else None)
+            total.add(report)
+            logging.info("[Derivative] backfill %d wallpapers, generated: %d, failed: %d", total.wallpapers,
+                         total.generated, total.failed)
+        logging.info("[Derivative] backfill finished, wallpapers: %d, skipped: %d, generated: %d, failed: %d",
+                     total.wallpapers, total.skipped, total.generated, total.failed)
+        return total
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+import csv
+import io
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from itertools import islice
+from typing import Iterable, Iterator
+
+from bing_client import BingWallpaperClient, BingWallpaperInfo
+from bing_downloader import BingWallpaperDownloader
+from bing_storage import BingWallpaperManager
+from file_util import temp_name, write_file_atomic
+from manifest import Manifest
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class ExportFormat(Enum):
+    JSONL = 'JSONL'
+    CSV = 'CSV'
+    PARQUET = 'PARQUET'
+
+    def __str__(self):
+        return self.value
+
+
+class BingWallpaperExporter(object):
+    """
+    Streams the stored wallpapers through a generator pipeline: rows are read in batches, flattened with the
+    fields of their detail, optionally checksummed against the image files, and written as they come, so the
+    memory is bounded by `batch_size` whatever the size of the archive.
+    """
+
+    CHECKPOINT_PREFIX = "export:"
+    COLUMNS = ["id", "date", "hsh", "zone", "url", "copyright", "copyrightlink", "copyrightonly", "title", "caption",
+               "desc", "fullstartdate", "enddate", "quiz", "size", "digest", "path", "create_time", "update_time"]
+    CHECKSUM_COLUMNS = ["file_size", "file_digest", "file_ok"]
+    INT_COLUMNS = {"id", "size", "file_size"}
+
+    def __init__(self,
+                 wallpaper_mgr: BingWallpaperManager,
+                 batch_size: int = 1000,
+                 manifest: Manifest = None,
+                 downloader: BingWallpaperDownloader = None,
+                 download_path: str = None,
+                 concurrency: int = 4):
+        """
+
+        :param batch_size: rows read, checksummed and written at a time
+        :param manifest: index of the download path, the image files are checksummed if specified
+        :param downloader: finds the files of the rows saved before the file paths were recorded
+        :param download_path: the download path of the manifest
+        :param concurrency: threads to hash the files
+        """
+        self._wallpaper_mgr = wallpaper_mgr
+        self._batch_size = max(1, batch_size)
+        self._manifest = manifest
+        self._downloader = downloader
+        self._download_path = download_path
+        self._concurrency = max(1, concurrency)
+        self._watermark = None
+
+    @property
+    def columns(self) -> list[str]:
+        return BingWallpaperExporter.COLUMNS + (BingWallpaperExporter.CHECKSUM_COLUMNS if self._manifest else [])
+
+    @property
+    def watermark(self) -> int:
+        """
+        change_seq of the last exported row.
+        """
+        return self._watermark
+
+    def _flatten(self, row: dict) -> dict:
+        try:
+            detail = BingWallpaperInfo.fromjson(row["detail"]).asdict() if row["detail"] else {}
+        except Exception:
+            detail = {}
+        record = {c: detail.get(c) for c in BingWallpaperExporter.COLUMNS}
+        for c in ["id", "date", "hsh", "zone", "url", "copyright", "size", "digest", "path"]:
+            record[c] = row[c]
+        record["create_time"] = row["_create_time"]
+        record["update_time"] = row["_update_time"]
+        self._watermark = row["change_seq"]
+        return record
+
+    def _file_path(self, record: dict) -> str:
+        if record["path"]:
+            return record["path"].replace(os.sep, "/")
+        if not self._downloader or not record["url"]:
+            return None
+        try:
+            path = self._downloader.get_filename(record["date"], record["url"], BingWallpaperClient.DEFAULT_QUALITY)
+        except Exception:
+            return None
+        return os.path.relpath(path, self._download_path).replace(os.sep, "/")
+
+    def _checksum(self, record: dict) -> dict:
+        path = self._file_path(record)
+        entry = self._manifest.entries.get(path) if path else None
+        if entry is None:
+            record.update(file_size=None, file_digest=None, file_ok=False)
+            return record
+        digest = self._manifest.digest(entry)
+        ok = entry.size == record["size"] and (not record["digest"] or digest == record["digest"])
+        record.update(file_size=entry.size, file_digest=digest, file_ok=ok)
+        return record
+
+    def records(self, since: int = 0, updated_after: str = None) -> Iterator[dict]:
+        records = map(self._flatten, self._wallpaper_mgr.iter_wallpapers(since, self._batch_size, updated_after))
+        if not self._manifest:
+            yield from records
+            return
+
+        self._manifest.scan()
+        with ThreadPoolExecutor(max_workers=self._concurrency, thread_name_prefix="bing-export") as executor:
+            while True:
+                # map a batch at a time, executor.map would submit the whole iterator at once
+                batch = list(islice(records, self._batch_size))
+                if not batch:
+                    break
+                yield from executor.map(self._checksum, batch)
+        self._manifest.save()
+
+    def _jsonl_chunks(self, records: Iterable[dict]) -> Iterator[bytes]:
+        lines = []
+        for record in records:
+            lines.append(json.dumps(record, ensure_ascii=False))
+            if len(lines) >= self._batch_size:
+                yield ("\n".join(lines) + "\n").encode("utf-8")
+                lines = []
+        if lines:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+
+    def _csv_chunks(self, records: Iterable[dict]) -> Iterator[bytes]:
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=self.columns)
+        writer.writeheader()
+        for i, record in enumerate(records):
+            writer.writerow(record)
+            if (i + 1) % self._batch_size == 0:
+                yield buf.getvalue().encode("utf-8")
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue().encode("utf-8")
+
+    def _write_parquet(self, records: Iterable[dict], output: str) -> int:
+        schema = pyarrow.schema([(c, pyarrow.int64() if c in BingWallpaperExporter.INT_COLUMNS
+                                  else pyarrow.bool_() if c == "file_ok" else pyarrow.string())
+                                 for c in self.columns])
+        tmp_name = temp_name(os.path.abspath(output))
+        count = 0
+        try:
+            with pyarrow.parquet.ParquetWriter(tmp_name, schema) as writer:
+                while True:
+                    # one row group for each batch
+                    batch = list(islice(records, self._batch_size))
+                    if not batch:
+                        break
+                    writer.write_table(pyarrow.Table.from_pylist(batch, schema=schema))
+                    count += len(batch)
+            os.replace(tmp_name, output)
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+        return count
+
+    def export(self, output: str, fmt: ExportFormat = ExportFormat.JSONL, updated_after: str = None,
+               watermark_name: str = None) -> int:
+        """
+
+        :param output: file path, '-' means stdout, the file is replaced only when the export finished
+        :param updated_after: only export the rows updated at or after the time, e.g. "2024-01-01 00:00:00" UTC
+        :param watermark_name: resume from the watermark saved under this name, and save the new one when finished,
+                               `updated_after` is ignored if there is a saved one
+        :return: the number of exported rows
+        """
+        checkpoint_name = BingWallpaperExporter.CHECKPOINT_PREFIX + watermark_name if watermark_name else None
+        since = 0
+        if checkpoint_name:
+            saved = self._wallpaper_mgr.load_checkpoint(checkpoint_name)
+            if saved:
+                since = saved["change_seq"]
+                updated_after = None
+        self._watermark = since if since else None
+
+        count = 0
+
+        def counted(records: Iterable[dict]) -> Iterator[dict]:
+            nonlocal count
+            for record in records:
+                count += 1
+                yield record
+
+        records = counted(self.records(since, updated_after))
+        if fmt == ExportFormat.PARQUET:
+            if pyarrow is None:
+                raise Exception("pyarrow is required to export parquet, pip install pyarrow")
+            if output == "-":
+                raise Exception("parquet can not be written to stdout")
+            self._write_parquet(records, output)
+        else:
+            chunks = self._jsonl_chunks(records) if fmt == ExportFormat.JSONL else self._csv_chunks(records)
+            if output == "-":
+                for chunk in chunks:
+                    sys.stdout.buffer.write(chunk)
+                sys.stdout.flush()
+            else:
+                write_file_atomic(os.path.abspath(output), chunks)
+
+        if checkpoint_name and self._watermark:
+            self._wallpaper_mgr.save_checkpoint(checkpoint_name, {"change_seq": self._watermark})
+        logging.info("[Export] export %d wallpapers to %s, watermark: %s", count, output, self._watermark)
+        return count
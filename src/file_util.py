@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+import hashlib
+import logging
+import os
+import uuid
+from dataclasses import dataclass
+from typing import Iterable
+
+
+@dataclass
+class DownloadedFile:
+    path: str
+    size: int
+    digest: str
+    # perceptual hash of the image if computed
+    phash: int = None
+
+
+def write_file_atomic(file_name: str, chunks: Iterable[bytes], expect_size: int = None) -> DownloadedFile:
+    """
+    Write chunks to a temp file next to `file_name`, fsync it and rename it to `file_name`, so a crash never
+    leaves a truncated file under the final name.
+
+    :param file_name: final file path
+    :param chunks: file content
+    :param expect_size: raise if the written size not equal to it, skip the check if None
+    :return: size and sha256 digest of the file
+    """
+    file_dir = os.path.dirname(file_name)
+    if not os.path.exists(file_dir):
+        # several download threads may create the same month dir at once
+        os.makedirs(file_dir, exist_ok=True)
+        logging.info("[FileUtil] create new dir: %s", file_dir)
+
+    tmp_name = temp_name(file_name)
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_name, "wb") as file:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                file.write(chunk)
+                sha256.update(chunk)
+                size += len(chunk)
+            if expect_size is not None and size != expect_size:
+                raise Exception("incomplete content, expect {} bytes, got {}".format(expect_size, size))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_name, file_name)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+    fsync_dir(file_dir)
+    return DownloadedFile(path=file_name, size=size, digest=sha256.hexdigest())
+
+
+def temp_name(file_name: str) -> str:
+    """
+    A hidden name next to file_name to write it before the rename, unique among the threads and the instances sharing
+    the directory, the pid is not, every container runs the app as pid 1.
+    """
+    name = ".{}.{}.tmp".format(os.path.basename(file_name), uuid.uuid4().hex)
+    return os.path.join(os.path.dirname(file_name), name)
+
+
+def fsync_dir(dir_name: str):
+    # persist the rename, not supported on every platform
+    try:
+        fd = os.open(dir_name, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -0,0 +1,449 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ChunkedEncodingError
+from urllib3 import Retry
+from urllib3.exceptions import MaxRetryError
+
+from metrics import CIRCUIT_OPEN, CONCURRENCY_LIMIT, REJECTED, RETRIES
+
+
+class CountingRetry(Retry):
+    """
+    Retry that counts every retry of the http adapter in the metrics.
+    """
+
+    # a longer Retry-After is not waited in the request, the response is returned and the circuit breaker skips the
+    # endpoint until then, instead of blocking a thread
+    MAX_RETRY_AFTER = 10
+
+    def increment(self, method: str = None, url: str = None, response=None, *args, **kwargs) -> Retry:
+        if response is not None:
+            retry_after = self.get_retry_after(response)
+            if retry_after is not None and retry_after > CountingRetry.MAX_RETRY_AFTER:
+                raise MaxRetryError(kwargs.get("_pool"), url)
+        # raises when exhausted, only the retries really made are counted
+        retry = super().increment(method, url, response, *args, **kwargs)
+        RETRIES.inc(operation="http")
+        return retry
+
+
+class CircuitOpenError(Exception):
+    """
+    The request is skipped without being sent, the endpoint failed too often recently or asked to retry later.
+    """
+    pass
+
+
+def parse_retry_after(value: str) -> float:
+    """
+
+    :param value: Retry-After header, seconds or an http date
+    :return: seconds to wait, None if invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker(object):
+    """
+    Opens after `failure_threshold` consecutive failures, or at once if the server sent Retry-After, and rejects
+    the requests while open. Once the cooldown is over one probe request is let through (half open): its success
+    closes the circuit, its failure opens it again for twice the cooldown.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, cooldown: float = 30, max_cooldown: float = 600):
+        """
+
+        :param name: the endpoint, for logs and metrics
+        :param failure_threshold: consecutive failures to open the circuit, 0 means never
+        :param cooldown: seconds to stay open before the probe
+        :param max_cooldown: max seconds of the doubled cooldowns
+        """
+        self._name = name
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._max_cooldown = max(cooldown, max_cooldown)
+        self._lock = threading.Lock()
+        self._state = CircuitBreaker.CLOSED
+        self._failures = 0
+        self._current_cooldown = cooldown
+        self._open_until = 0.0
+        self._probing = False
+        CIRCUIT_OPEN.set(0, endpoint=name)
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def retry_in(self) -> float:
+        """
+        Seconds until the next request may be sent.
+        """
+        return max(0.0, self._open_until - time.monotonic())
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == CircuitBreaker.CLOSED:
+                return True
+            if self._state == CircuitBreaker.OPEN and time.monotonic() >= self._open_until:
+                self._state = CircuitBreaker.HALF_OPEN
+                self._probing = False
+            if self._state == CircuitBreaker.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._state != CircuitBreaker.CLOSED:
+                logging.info("[HttpSession] circuit of %s closed", self._name)
+                CIRCUIT_OPEN.set(0, endpoint=self._name)
+            self._state = CircuitBreaker.CLOSED
+            self._failures = 0
+            self._current_cooldown = self._cooldown
+            self._probing = False
+
+    def record_ignored(self):
+        """
+        The request ended without telling anything about the endpoint, e.g. interrupted or failed locally, a probe
+        is let through again.
+        """
+        with self._lock:
+            if self._state == CircuitBreaker.HALF_OPEN:
+                self._probing = False
+
+    def record_failure(self, retry_after: float = None):
+        """
+
+        :param retry_after: seconds of the Retry-After of the response if any
+        """
+        with self._lock:
+            self._failures += 1
+            if self._state == CircuitBreaker.HALF_OPEN:
+                self._current_cooldown = min(self._current_cooldown * 2, self._max_cooldown)
+            elif retry_after is None and (self._failure_threshold <= 0 or self._failures < self._failure_threshold):
+                return
+            if self._state == CircuitBreaker.OPEN and retry_after is None:
+                # the requests sent before it opened
+                return
+            wait = max(self._current_cooldown, retry_after or 0)
+            self._state = CircuitBreaker.OPEN
+            self._open_until = time.monotonic() + wait
+            self._probing = False
+            CIRCUIT_OPEN.set(1, endpoint=self._name)
+            logging.warning("[HttpSession] circuit of %s open for %.1fs after %d failures%s", self._name, wait,
+                            self._failures, ", Retry-After: {:.1f}s".format(retry_after) if retry_after else "")
+
+
+class AdaptiveConcurrency(object):
+    """
+    Limits the concurrent requests to one endpoint, the limit grows by one for every `limit` fast successes and is
+    halved, at most once a second, on errors or when the smoothed latency goes above `latency_factor` times its
+    baseline (AIMD).
+    """
+
+    DECREASE_INTERVAL = 1.0
+    # the jitter of fast responses is not congestion
+    MIN_LATENCY_INCREASE = 0.05
+
+    def __init__(self, name: str, max_limit: int, min_limit: int = 1, latency_factor: float = 2.0):
+        self._name = name
+        self._max_limit = max(1, max_limit)
+        self._min_limit = max(1, min(min_limit, self._max_limit))
+        self._latency_factor = latency_factor
+        self._limit = float(self._max_limit)
+        self._inflight = 0
+        self._cond = threading.Condition()
+        self._ewma = None
+        self._baseline = None
+        self._last_decrease = 0.0
+        CONCURRENCY_LIMIT.set(self._max_limit, endpoint=name)
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def acquire(self):
+        with self._cond:
+            while self._inflight >= int(self._limit):
+                self._cond.wait()
+            self._inflight += 1
+
+    def release(self, latency: float, ok: bool):
+        """
+
+        :param latency: seconds until the response headers
+        :param ok: False on error responses and connection errors
+        """
+        with self._cond:
+            self._inflight -= 1
+            congested = not ok
+            if ok:
+                self._ewma = latency if self._ewma is None else 0.8 * self._ewma + 0.2 * latency
+                # the best latency seen, slowly following the current one so a lasting change is accepted
+                self._baseline = self._ewma if self._baseline is None else \
+                    min(self._ewma, 0.99 * self._baseline + 0.01 * self._ewma)
+                congested = self._ewma > self._latency_factor * self._baseline and \
+                    self._ewma - self._baseline > AdaptiveConcurrency.MIN_LATENCY_INCREASE
+            limit = self._limit
+            now = time.monotonic()
+            if congested:
+                if now - self._last_decrease >= AdaptiveConcurrency.DECREASE_INTERVAL:
+                    self._limit = max(self._min_limit, self._limit / 2)
+                    self._last_decrease = now
+            else:
+                self._limit = min(self._max_limit, self._limit + 1 / self._limit)
+            if int(limit) != int(self._limit):
+                CONCURRENCY_LIMIT.set(int(self._limit), endpoint=self._name)
+                logging.info("[HttpSession] concurrency limit of %s: %d", self._name, int(self._limit))
+            self._cond.notify_all()
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared by threads, `acquire` blocks until a token is available.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        """
+
+        :param rate: tokens per second, 0 means unlimited
+        :param burst: max tokens kept when idle
+        """
+        self._rate = rate
+        self._burst = max(1, burst)
+        self._tokens = float(self._burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int = 1):
+        if self._rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self._rate
+            time.sleep(wait)
+
+
+class HttpSessionPool(object):
+    """
+    A long-lived keep-alive http session shared by the bing client, the downloader and the notifier,
+    so sockets to the same host are reused across requests and across service-mode rounds.
+    """
+
+    DEFAULT_RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self,
+                 pool_size: int = 10,
+                 max_retries: int = 3,
+                 retry_backoff_ms: int = 1000,
+                 retry_status: tuple = DEFAULT_RETRY_STATUS,
+                 rate: float = 0,
+                 circuit_failures: int = 5,
+                 circuit_cooldown: float = 30,
+                 adaptive_concurrency: bool = True):
+        """
+
+        :param pool_size: max number of keep-alive connections kept for each host, also the max concurrency of
+                          each endpoint
+        :param max_retries: times to retry on connection errors and on `retry_status` responses
+        :param retry_backoff_ms: millisecond
+        :param retry_status: http status codes to retry on, also the failures of the circuit breakers
+        :param rate: max requests per second of all the requests, 0 means unlimited
+        :param circuit_failures: consecutive failed requests to open the circuit of an endpoint, 0 means never
+        :param circuit_cooldown: seconds an open circuit rejects the requests before trying again
+        :param adaptive_concurrency: lower the concurrency of an endpoint when its errors or latency grow
+        """
+        self._retries = CountingRetry(total=max_retries,
+                                      backoff_factor=retry_backoff_ms / 1000,
+                                      status_forcelist=retry_status,
+                                      raise_on_status=False)
+        self._adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=self._retries)
+        self._session = requests.Session()
+        self._session.mount('https://', self._adapter)
+        self._session.mount('http://', self._adapter)
+        self._pool_size = pool_size
+        self._retry_status = set(retry_status)
+        self._rate_limiter = RateLimiter(rate, burst=max(1, int(rate)))
+        self._circuit_failures = circuit_failures
+        self._circuit_cooldown = circuit_cooldown
+        self._adaptive_concurrency = adaptive_concurrency
+        self._guards_lock = threading.Lock()
+        # endpoint -> (CircuitBreaker, AdaptiveConcurrency or None)
+        self._guards = {}
+
+    @property
+    def session(self) -> requests.Session:
+        return self._session
+
+    @staticmethod
+    def endpoint(url: str) -> str:
+        """
+        e.g. https://www.bing.com/HPImageArchive.aspx and https://www.bing.com/th, the metadata and the images are
+        throttled independently.
+        """
+        u = urlparse(url)
+        return "{}://{}/{}".format(u.scheme, u.netloc, u.path.lstrip("/").split("/", 1)[0])
+
+    def _guard(self, endpoint: str) -> tuple[CircuitBreaker, AdaptiveConcurrency]:
+        with self._guards_lock:
+            if endpoint not in self._guards:
+                concurrency = AdaptiveConcurrency(endpoint, self._pool_size) if self._adaptive_concurrency else None
+                self._guards[endpoint] = (CircuitBreaker(endpoint, self._circuit_failures, self._circuit_cooldown),
+                                          concurrency)
+            return self._guards[endpoint]
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """
+        requests.get through the rate limiter, the circuit breaker and the concurrency limit of the endpoint. A
+        streamed response holds its concurrency slot until closed, and its success is only recorded once its body
+        is read, see _guard_stream.
+
+        :raise CircuitOpenError: the endpoint is skipped
+        """
+        endpoint = HttpSessionPool.endpoint(url)
+        breaker, concurrency = self._guard(endpoint)
+        if not breaker.allow():
+            REJECTED.inc(endpoint=endpoint)
+            raise CircuitOpenError("circuit of {} is open, retry in {:.1f}s".format(endpoint, breaker.retry_in()))
+        self._rate_limiter.acquire()
+        if concurrency:
+            concurrency.acquire()
+        start = time.monotonic()
+        try:
+            r = self._session.get(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            breaker.record_failure()
+            if concurrency:
+                concurrency.release(time.monotonic() - start, False)
+            raise
+        except BaseException:
+            # not caused by the endpoint
+            breaker.record_ignored()
+            if concurrency:
+                concurrency.release(time.monotonic() - start, True)
+            raise
+
+        latency = time.monotonic() - start
+        ok = r.status_code not in self._retry_status
+        stream = kwargs.get("stream")
+        if not ok:
+            breaker.record_failure(parse_retry_after(r.headers.get("Retry-After")))
+        elif not stream:
+            breaker.record_success()
+        if stream:
+            self._guard_stream(r, breaker if ok else None, concurrency, latency, ok)
+        elif concurrency:
+            concurrency.release(latency, ok)
+        return r
+
+    @staticmethod
+    def _guard_stream(r: requests.Response, breaker: CircuitBreaker, concurrency: AdaptiveConcurrency,
+                      latency: float, ok: bool):
+        """
+        Record the outcome of a streamed response when its body is read: a connection broken or timed out in the
+        middle of the body is a failure of the endpoint, a body left unread after the headers a success, and a
+        body abandoned half way, e.g. by a local error, neither.
+
+        :param breaker: None if the outcome is already recorded from the status
+        """
+        iter_content = r.iter_content
+        close = r.close
+        pending = breaker is not None
+        started = False
+        failed = False
+        released = False
+
+        def record(success: bool):
+            nonlocal pending
+            if not pending:
+                return
+            pending = False
+            if success:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+
+        def guarded_iter_content(*args, **kwargs):
+            nonlocal started, failed
+            started = True
+            try:
+                yield from iter_content(*args, **kwargs)
+            except (requests.ConnectionError, requests.Timeout, ChunkedEncodingError):
+                failed = True
+                record(False)
+                raise
+            record(True)
+
+        def close_and_release():
+            nonlocal pending, released
+            try:
+                close()
+            finally:
+                if pending and not started:
+                    record(True)
+                elif pending:
+                    pending = False
+                    breaker.record_ignored()
+                if concurrency and not released:
+                    released = True
+                    concurrency.release(latency, ok and not failed)
+
+        # r.content and r.text read the body through iter_content too
+        r.iter_content = guarded_iter_content
+        r.close = close_and_release
+
+    def connection_stats(self) -> dict[str, dict]:
+        """
+        Number of requests and of newly opened connections for each host, requests minus connections is the
+        number of requests served by a reused connection.
+
+        :return: {"https://www.bing.com:443": {"requests": 10, "connections": 2, "reused": 8}}
+        """
+        stats = {}
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = "{}://{}:{}".format(pool.scheme, pool.host, pool.port)
+            item = stats.setdefault(host, {"requests": 0, "connections": 0, "reused": 0})
+            item["requests"] += pool.num_requests
+            item["connections"] += pool.num_connections
+            item["reused"] = max(0, item["requests"] - item["connections"])
+        return stats
+
+    def log_stats(self):
+        for host, item in self.connection_stats().items():
+            logging.info("[HttpSession] host: %s, requests: %d, connections: %d, reused: %d",
+                         host, item["requests"], item["connections"], item["reused"])
+
+    def close(self):
+        self._session.close()
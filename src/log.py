@@ -1,30 +1,197 @@
 #!/usr/bin/python3
 # -*- coding: utf8 -*-
 
+import atexit
+import contextvars
+import datetime
+import functools
+import json
 import logging
 import os.path
+import queue
+import re
 import sys
-from logging.handlers import RotatingFileHandler
+import threading
+import uuid
+from contextlib import contextmanager
+from enum import Enum
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
+from metrics import LOG_DROPPED
 
-def init_logging(log_path: str, log_level: str):
+# pass as `extra` to the lines repeated for every wallpaper of every round, only 1 in `sample` of them is logged
+SAMPLED = {"sampled": True}
+
+# fields added to every record logged in the context, e.g. cycle_id, image_id
+_log_context = contextvars.ContextVar("bing_log_context", default={})
+
+
+class LogFormat(Enum):
+    TEXT = 'TEXT'
+    # one json object per line
+    JSON = 'JSON'
+
+    def __str__(self):
+        return self.value
+
+
+def new_correlation_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    Add the fields to all the records logged inside, including the ones of the threads started with
+    bind_log_context.
+    """
+    token = _log_context.set(dict(_log_context.get(), **fields))
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+def bind_log_context(func):
+    """
+    Run func in a copy of the current log context, the executors do not pass it to their threads.
+    """
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Copy the log context to the record, in the thread logging it.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for k, v in _log_context.get().items():
+            if not hasattr(record, k):
+                setattr(record, k, v)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Only pass the first and then 1 in `rate` of the records logged with SAMPLED, counted by message template.
+    """
+
+    def __init__(self, rate: int):
+        super().__init__()
+        self._rate = max(1, rate)
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self._rate == 1 or not getattr(record, "sampled", False):
+            return True
+        with self._lock:
+            count = self._counts.get(record.msg, 0)
+            self._counts[record.msg] = count + 1
+        record.sample_rate = self._rate
+        return count % self._rate == 0
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One json object per line: time, level, component (the `[BingDownloader]` prefix), msg, file, line, thread, the
+    log context and the `extra` fields of the record, e.g. duration_ms.
+    """
+
+    COMPONENT_PATTERN = re.compile(r"^\[(\w+)\] ")
+    STANDARD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName",
+                                                                                 "sampled"}
+
+    def format(self, record: logging.LogRecord) -> str:
+        msg = record.getMessage()
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(
+                timespec="milliseconds"),
+            "level": record.levelname,
+        }
+        match = JsonFormatter.COMPONENT_PATTERN.match(msg)
+        if match:
+            entry["component"] = match.group(1)
+            msg = msg[match.end():]
+        entry.update(msg=msg, file=record.filename, line=record.lineno, thread=record.threadName)
+        for k, v in record.__dict__.items():
+            if k not in JsonFormatter.STANDARD_FIELDS and not k.startswith("_"):
+                entry[k] = v
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class AsyncQueueHandler(QueueHandler):
+    """
+    Only puts the records into a bounded queue, the formatting and the writes, including the rollover of the
+    files, are done by the listener thread. Drops the records instead of blocking when the queue is full.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # the arguments are merged now as they may change later, formatting is left to the listener
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+class AsyncQueueListener(QueueListener):
+    def enqueue_sentinel(self):
+        # blocks until there is room, so the records queued before are all written
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        # also called at exit, after being stopped
+        if self._thread is not None:
+            super().stop()
+
+
+def init_logging(log_path: str, log_level: str, stream=None, log_format: LogFormat = LogFormat.TEXT,
+                 async_queue: bool = False, queue_size: int = 10000, sample: int = 1) -> QueueListener:
+    """
+
+    :param stream: where to log if log_path is not specified, default is stdout
+    :param async_queue: format and write the records from a background thread, see AsyncQueueHandler
+    :param queue_size: max number of records waiting for the background thread
+    :param sample: only log 1 in `sample` of the lines logged with SAMPLED
+    :return: the listener thread if async_queue, stopped at exit, stop it to flush the queue earlier
+    """
     logger = logging.getLogger()
-    formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(filename)s:%(lineno)d %(message)s')
+    if log_format == LogFormat.JSON:
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(filename)s:%(lineno)d %(message)s')
 
     if not log_path or len(log_path) == 0:
-        stdout_hdl = logging.StreamHandler(sys.stdout)
-        stdout_hdl.setFormatter(formatter)
-        logger.addHandler(stdout_hdl)
+        handler = logging.StreamHandler(stream if stream else sys.stdout)
     else:
         if not os.path.exists(log_path):
             os.makedirs(log_path)
         log_file = os.path.join(log_path, "bing.log")
-        file_hdl = RotatingFileHandler(log_file, maxBytes=100 * 1024 * 1024, backupCount=10)
-        file_hdl.setFormatter(formatter)
-        logger.addHandler(file_hdl)
+        handler = RotatingFileHandler(log_file, maxBytes=100 * 1024 * 1024, backupCount=10)
+    handler.setFormatter(formatter)
+
+    listener = None
+    if async_queue:
+        listener = AsyncQueueListener(queue.Queue(queue_size), handler, respect_handler_level=True)
+        listener.start()
+        # write what is still queued at exit
+        atexit.register(listener.stop)
+        handler = AsyncQueueHandler(listener.queue)
+    # in the thread logging, before the record is queued
+    handler.addFilter(SamplingFilter(sample))
+    handler.addFilter(ContextFilter())
+    logger.addHandler(handler)
 
     level = logging.getLevelName(log_level)
     logger.setLevel(level)
+    return listener
 
 
 if __name__ == '__main__':
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass
+
+from file_util import write_file_atomic
+
+
+@dataclass
+class ManifestEntry:
+    # relative to the root, with '/' as separator
+    path: str
+    size: int
+    mtime_ns: int
+    # sha256 hex digest, empty until computed
+    digest: str = ''
+
+
+class Manifest(object):
+    """
+    Index of the files under the download path, built by one os.scandir walk. The digests are cached in
+    `cache_file` together with the size and mtime they were computed for, so a repeated scan only hashes the new
+    and the changed files.
+    """
+
+    VERSION = 1
+    HASH_CHUNK_SIZE = 1024 * 1024
+    # the partial downloads and the temp files of the atomic writes
+    IGNORE_SUFFIXES = (".part", ".part.json", ".tmp")
+
+    def __init__(self, root: str, cache_file: str = None):
+        """
+
+        :param root: the download path
+        :param cache_file: where to keep the digests between scans, not cached if None
+        """
+        self._root = root
+        self._cache_file = cache_file
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._cached = self._load_cache()
+
+    def _load_cache(self) -> dict[str, ManifestEntry]:
+        if not self._cache_file or not os.path.exists(self._cache_file):
+            return {}
+        try:
+            with open(self._cache_file, "r") as f:
+                data = json.load(f)
+            if data.get("version") != Manifest.VERSION:
+                return {}
+            return {path: ManifestEntry(path, size, mtime_ns, digest)
+                    for path, (size, mtime_ns, digest) in data["files"].items()}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning("[Manifest] ignore broken cache %s, %s", self._cache_file, e)
+            return {}
+
+    @property
+    def entries(self) -> dict[str, ManifestEntry]:
+        return self._entries
+
+    def scan(self) -> dict[str, ManifestEntry]:
+        """
+        Walk the whole tree, the entries of unchanged files keep their cached digest.
+
+        :return: relative path -> entry
+        """
+        entries = {}
+        stack = [""]
+        while stack:
+            rel_dir = stack.pop()
+            try:
+                it = os.scandir(os.path.join(self._root, rel_dir) if rel_dir else self._root)
+            except FileNotFoundError:
+                continue
+            with it:
+                for dir_entry in it:
+                    if dir_entry.name.startswith("."):
+                        continue
+                    rel_path = rel_dir + "/" + dir_entry.name if rel_dir else dir_entry.name
+                    if dir_entry.is_dir(follow_symlinks=False):
+                        stack.append(rel_path)
+                        continue
+                    if not dir_entry.is_file() or dir_entry.name.endswith(Manifest.IGNORE_SUFFIXES):
+                        continue
+                    st = dir_entry.stat()
+                    entry = ManifestEntry(rel_path, st.st_size, st.st_mtime_ns)
+                    cached = self._cached.get(rel_path)
+                    if cached and cached.size == entry.size and cached.mtime_ns == entry.mtime_ns:
+                        entry.digest = cached.digest
+                    entries[rel_path] = entry
+        with self._lock:
+            self._entries = entries
+        logging.info("[Manifest] scan %s, %d files", self._root, len(entries))
+        return entries
+
+    def full_path(self, rel_path: str) -> str:
+        return os.path.join(self._root, *rel_path.split("/"))
+
+    def digest(self, entry: ManifestEntry) -> str:
+        """
+        The sha256 of the file, computed and cached if not known yet.
+        """
+        if entry.digest:
+            return entry.digest
+        sha256 = hashlib.sha256()
+        with open(self.full_path(entry.path), "rb") as f:
+            while True:
+                chunk = f.read(Manifest.HASH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+        entry.digest = sha256.hexdigest()
+        return entry.digest
+
+    def update(self, rel_path: str, digest: str):
+        """
+        Record a file just written, e.g. a re-downloaded one, with its known digest.
+        """
+        st = os.stat(self.full_path(rel_path))
+        with self._lock:
+            self._entries[rel_path] = ManifestEntry(rel_path, st.st_size, st.st_mtime_ns, digest)
+
+    def save(self):
+        if not self._cache_file:
+            return
+        with self._lock:
+            files = {e.path: [e.size, e.mtime_ns, e.digest] for e in self._entries.values()}
+        data = json.dumps({"version": Manifest.VERSION, "files": files}, separators=(",", ":")).encode()
+        write_file_atomic(self._cache_file, [data])
+        self._cached = dict(self._entries)
@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    items = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        items.append('{}="{}"'.format(name, value))
+    return "{" + ",".join(items) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric(object):
+    TYPE = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        # label values tuple -> value
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple[tuple[str, str], ...]:
+        if set(labels.keys()) != set(self.labelnames):
+            raise ValueError("{} expects labels {}, got {}".format(self.name, self.labelnames, tuple(labels.keys())))
+        return tuple((name, "" if labels[name] is None else str(labels[name])) for name in self.labelnames)
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+    def render(self) -> list[str]:
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.TYPE)]
+        for name, labels, value in self.samples():
+            lines.append("{}{} {}".format(name, _format_labels(labels), _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # [count of each bucket..., sum, count]
+            item = self._values.get(key)
+            if item is None:
+                item = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    item[i] += 1
+            item[-2] += value
+            item[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the duration in second of the block, also works as a decorator.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            item = self._values.get(self._key(labels))
+            return item[-1] if item else 0
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        samples = []
+        with self._lock:
+            for key, item in self._values.items():
+                for bound, count in zip(self.buckets, item):
+                    samples.append((self.name + "_bucket", key + (("le", _format_value(bound)),), count))
+                samples.append((self.name + "_sum", key, item[-2]))
+                samples.append((self.name + "_count", key, item[-1]))
+        return samples
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError("duplicated metric: {}".format(metric.name))
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (),
+                  buckets: tuple = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """
+        Prometheus text exposition format 0.0.4.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+OPERATION_DURATION = REGISTRY.histogram(
+    "bing_operation_duration_seconds",
+    "Latency of the hot path operations: get_wallpaper_info, download_one_img, wallpaper_exist, wallpapers_exist, "
+    "save_wallpaper_info, save_wallpaper_variant and notify",
+    ("operation",))
+DOWNLOADED_BYTES = REGISTRY.counter(
+    "bing_downloaded_bytes_total", "Bytes of wallpaper images received, including the ones of interrupted downloads")
+DEDUPLICATED_BYTES = REGISTRY.counter(
+    "bing_deduplicated_bytes_total", "Bytes of files linked to a stored blob of the same content instead of stored")
+RETRIES = REGISTRY.counter(
+    "bing_retries_total", "Retries of http requests, of interrupted downloads and of notifications", ("operation",))
+ROUND_DURATION = REGISTRY.histogram(
+    "bing_round_duration_seconds", "Duration of a whole download round", (),
+    (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800))
+ROUNDS = REGISTRY.counter("bing_rounds_total", "Download rounds by result", ("result",))
+LAST_SUCCESS = REGISTRY.gauge(
+    "bing_last_success_timestamp_seconds",
+    "Unix time of the last round in which the market was fetched and all of its wallpapers were handled",
+    ("market",))
+NEXT_ROUND = REGISTRY.gauge("bing_next_round_timestamp_seconds", "Unix time of the next planned round")
+NEAR_DUPLICATES = REGISTRY.counter("bing_near_duplicates_total",
+                                  "Downloaded images perceptually close to a stored one, by action", ("action",))
+DERIVATIVES = REGISTRY.counter("bing_derivatives_total", "Derivatives of the wallpapers generated or failed",
+                               ("result",))
+SERVE_REQUESTS = REGISTRY.counter("bing_serve_requests_total", "Requests of the serve mode by route and status",
+                                  ("route", "status"))
+SERVE_CACHE = REGISTRY.counter("bing_serve_cache_total", "Lookups of the serve mode cache by result", ("result",))
+LOG_DROPPED = REGISTRY.counter("bing_log_dropped_total", "Log records dropped because the async log queue was full")
+CIRCUIT_OPEN = REGISTRY.gauge("bing_http_circuit_open",
+                              "1 if the requests to the endpoint are skipped by the circuit breaker", ("endpoint",))
+CONCURRENCY_LIMIT = REGISTRY.gauge("bing_http_concurrency_limit", "Adaptive concurrency limit of the endpoint",
+                                   ("endpoint",))
+REJECTED = REGISTRY.counter("bing_http_rejected_total", "Requests skipped because the circuit was open",
+                            ("endpoint",))
+CLAIMS = REGISTRY.counter("bing_replica_claims_total",
+                          "Variants claimed by this replica, deferred to other replicas, or lost before renewed",
+                          ("result",))
+
+
+class MetricsServer(object):
+    """
+    Serves the registry at /metrics from a background thread.
+    """
+
+    def __init__(self, host: str = "0.0.0.0", port: int = 9100, registry: MetricsRegistry = REGISTRY):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                logging.debug("[Metrics] %s - %s", self.address_string(), fmt % args)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="bing-metrics", daemon=True)
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self._server.server_address[:2]
+
+    def start(self):
+        self._thread.start()
+        logging.info("[Metrics] serving metrics at http://%s:%d/metrics", *self.address)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -2,10 +2,14 @@
 # -*- coding: utf8 -*-
 
 import logging
-import requests
+import queue
+import threading
+import time
 from requests import RequestException
 
-from send_mail import send_mail
+from http_session import HttpSessionPool
+from metrics import OPERATION_DURATION, RETRIES
+from send_mail import MailSender
 
 
 class Notification(object):
@@ -16,26 +20,154 @@ class Notification(object):
                  my_password: str = None,
                  my_name: str = 'Robot',
                  to_mail: str = None,
-                 server_chan_key: str = None):
+                 server_chan_key: str = None,
+                 session: HttpSessionPool = None):
         self._my_mail = my_mail
         self._my_pass = my_password
         self._my_name = my_name
         self._to_mail = to_mail
         self._server_chan_key = server_chan_key
+        self._session = session if session else HttpSessionPool(pool_size=1)
+        # the smtp connection is kept between mails
+        self._mail_sender = MailSender(my_mail, my_name, my_password) if to_mail else None
+        self._mail_lock = threading.Lock()
 
-    def notify(self, title: str, content: str):
+    @property
+    def channels(self) -> list[str]:
+        channels = []
         if self._to_mail:
+            channels.append("mail")
+        if self._server_chan_key:
+            channels.append("server-chan")
+        return channels
+
+    @OPERATION_DURATION.time(operation="notify")
+    def send(self, channel: str, title: str, content: str):
+        """
+        Send to one channel, raise if failed.
+
+        :param channel: one of channels
+        """
+        if channel == "mail":
+            with self._mail_lock:
+                self._mail_sender.send(self._to_mail, title, content)
+        elif channel == "server-chan":
+            r = self._session.get(Notification.SERVER_CHAN_URI + self._server_chan_key + ".send",
+                                  params={"text": title}, timeout=5)
+            if r.status_code != 200:
+                raise RequestException("status_code={}, msg={}".format(r.status_code, r.text))
+
+    def notify(self, title: str, content: str):
+        for channel in self.channels:
             try:
-                send_mail(self._my_mail, self._my_name, self._my_pass, self._to_mail, title, content)
+                self.send(channel, title, content)
             except Exception as e:
-                logging.error("[Notify] failed to send mail, %s", e)
+                logging.error("[Notify] failed to notify %s, %s", channel, e)
 
-        if self._server_chan_key:
+    def flush(self):
+        """
+        Called at the end of every round, nothing to do as the notifications are sent at once.
+        """
+        pass
+
+    def close(self):
+        if self._mail_sender:
+            with self._mail_lock:
+                self._mail_sender.close()
+
+
+class QueuedNotification(object):
+    """
+    Same interface as Notification, but `notify` only puts the event on a queue. A background worker merges the
+    events of a round into one digest, sent when `flush` is called at the end of the round (or `max_delay` after the
+    first pending event), and retries each channel with exponential backoff, so the download path never waits for
+    the mail server.
+    """
+
+    FLUSH = object()
+    STOP = object()
+
+    def __init__(self,
+                 notification: Notification,
+                 max_retries: int = 3,
+                 retry_backoff: float = 5,
+                 max_delay: float = 300):
+        """
+
+        :param notification: the channels to send the digest to
+        :param max_retries: times to retry each channel
+        :param retry_backoff: second, doubled after every retry
+        :param max_delay: second, send the pending events even if flush is not called
+        """
+        self._notification = notification
+        self._max_retries = max_retries
+        self._retry_backoff = retry_backoff
+        self._max_delay = max_delay
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="bing-notify", daemon=True)
+        self._worker.start()
+
+    def notify(self, title: str, content: str):
+        self._queue.put((title, content))
+
+    def flush(self):
+        self._queue.put(QueuedNotification.FLUSH)
+
+    def close(self, timeout: float = 30):
+        """
+        Send the pending events and stop the worker.
+        """
+        self._queue.put(QueuedNotification.STOP)
+        self._worker.join(timeout)
+        self._notification.close()
+
+    def _run(self):
+        pending = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.time(), 0)
             try:
-                r = requests.get(Notification.SERVER_CHAN_URI + self._server_chan_key + ".send", params={"text": title},
-                                 timeout=5)
-                if r.status_code != 200:
-                    logging.error("[Notify] failed to notify server chan, status_code=%d, msg=%s", r.status_code,
-                                  r.text)
-            except RequestException as e:
-                logging.error("[Notify] failed to notify server-chan, %s", e)
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = QueuedNotification.FLUSH
+
+            if item is QueuedNotification.FLUSH or item is QueuedNotification.STOP:
+                if pending:
+                    self._send_digest(pending)
+                pending = []
+                deadline = None
+                if item is QueuedNotification.STOP:
+                    return
+                continue
+
+            pending.append(item)
+            if deadline is None:
+                deadline = time.time() + self._max_delay
+
+    @staticmethod
+    def make_digest(events: list[tuple[str, str]]) -> tuple[str, str]:
+        if len(events) == 1:
+            return events[0]
+        counts = {}
+        for title, _ in events:
+            counts[title] = counts.get(title, 0) + 1
+        title = ", ".join("{} x{}".format(t, n) for t, n in counts.items())
+        content = "\n\n".join("[{}] {}\n{}".format(i + 1, t, c) for i, (t, c) in enumerate(events))
+        return title, content
+
+    def _send_digest(self, events: list[tuple[str, str]]):
+        title, content = self.make_digest(events)
+        for channel in self._notification.channels:
+            for attempt in range(self._max_retries + 1):
+                try:
+                    self._notification.send(channel, title, content)
+                    logging.info("[Notify] sent %d events to %s", len(events), channel)
+                    break
+                except Exception as e:
+                    if attempt >= self._max_retries:
+                        logging.error("[Notify] failed to notify %s, give up %d events, %s", channel, len(events), e)
+                        break
+                    backoff = self._retry_backoff * (2 ** attempt)
+                    logging.warning("[Notify] failed to notify %s, retry after %.1f second, %s", channel, backoff, e)
+                    RETRIES.inc(operation="notify")
+                    time.sleep(backoff)
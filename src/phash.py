@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+import math
+from enum import Enum
+from itertools import combinations
+from typing import Hashable
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class PHashMode(Enum):
+    OFF = 'OFF'
+    # save the near duplicates as usual, with the wallpaper they duplicate recorded
+    FLAG = 'FLAG'
+    # do not keep the file of a near duplicate, its variant points to the file it duplicates
+    SKIP = 'SKIP'
+
+    def __str__(self):
+        return self.value
+
+
+# the image is shrunk to IMG_SIZE x IMG_SIZE, the HASH_SIZE x HASH_SIZE lowest frequencies of its DCT are the hash
+IMG_SIZE = 32
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+def _dct_matrix(n: int) -> list[list[float]]:
+    """
+    Orthonormal DCT-II, the DCT of a matrix X is D X D^T.
+    """
+    return [[(math.sqrt(1 / n) if k == 0 else math.sqrt(2 / n)) * math.cos(math.pi * (2 * i + 1) * k / (2 * n))
+             for i in range(n)] for k in range(n)]
+
+
+_DCT = _dct_matrix(IMG_SIZE)
+_DCT_LOW = _DCT[:HASH_SIZE]
+_DCT_NP = numpy.array(_DCT) if numpy is not None else None
+
+
+def available() -> bool:
+    """
+    Whether images can be hashed, Pillow decodes them, numpy is optional.
+    """
+    return Image is not None
+
+
+def _bits_to_int(bits) -> int:
+    h = 0
+    for bit in bits:
+        h = (h << 1) | int(bool(bit))
+    return h
+
+
+def _median(values: list[float]) -> float:
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2
+
+
+def dct_hash(pixels) -> int:
+    """
+
+    :param pixels: IMG_SIZE x IMG_SIZE gray levels, a numpy array or a list of rows
+    :return: HASH_BITS bits, set where the low frequency is above the median of them (DC excluded)
+    """
+    if numpy is not None:
+        return dct_hashes(numpy.asarray(pixels, dtype=numpy.float64)[numpy.newaxis])[0]
+    # only the low rows of D X D^T are needed
+    rows = [[sum(d[i] * row[j] for i, row in enumerate(pixels)) for j in range(IMG_SIZE)] for d in _DCT_LOW]
+    low = [sum(r[i] * d[i] for i in range(IMG_SIZE)) for r in rows for d in _DCT_LOW]
+    median = _median(low[1:])
+    return _bits_to_int(v > median for v in low)
+
+
+def dct_hashes(stack) -> list[int]:
+    """
+    Vectorized dct_hash of many images at once, requires numpy.
+
+    :param stack: numpy array of shape (n, IMG_SIZE, IMG_SIZE)
+    """
+    d = _DCT_NP[:HASH_SIZE]
+    low = (d @ stack @ d.T).reshape(len(stack), HASH_BITS)
+    median = numpy.median(low[:, 1:], axis=1, keepdims=True)
+    packed = numpy.packbits(low > median, axis=1)
+    return [int(h) for h in packed.view(">u8").ravel()]
+
+
+def image_pixels(path: str):
+    """
+    Decode and shrink an image to IMG_SIZE x IMG_SIZE gray levels, JPEG is decoded at a reduced scale directly.
+    """
+    with Image.open(path) as img:
+        img.draft("L", (IMG_SIZE * 4, IMG_SIZE * 4))
+        small = img.convert("L").resize((IMG_SIZE, IMG_SIZE), Image.BILINEAR)
+    if numpy is not None:
+        return numpy.asarray(small, dtype=numpy.float64)
+    data = list(small.getdata())
+    return [data[i * IMG_SIZE:(i + 1) * IMG_SIZE] for i in range(IMG_SIZE)]
+
+
+def image_hash(path: str) -> int:
+    return dct_hash(image_pixels(path))
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def to_signed(h: int) -> int:
+    """
+    sqlite INTEGER is signed 64 bits.
+    """
+    return h - (1 << HASH_BITS) if h >= 1 << (HASH_BITS - 1) else h
+
+
+def to_unsigned(h: int) -> int:
+    return h + (1 << HASH_BITS) if h < 0 else h
+
+
+class HammingIndex(object):
+    """
+    Multi-index hashing: the hashes are split into CHUNKS chunks, each indexed by an exact hash table. Two hashes
+    within distance r have at least one chunk within r // CHUNKS (pigeonhole), so a search probes every value
+    within that distance of each chunk of the query, and checks the full distance of the candidates only. Exact,
+    and the cost of a search hardly grows with the number of hashes.
+    """
+
+    CHUNKS = 4
+    CHUNK_BITS = HASH_BITS // CHUNKS
+    _CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+    def __init__(self):
+        self._tables = [{} for _ in range(HammingIndex.CHUNKS)]
+        self._hashes = {}
+        # radius -> xor masks of one chunk
+        self._probes = {}
+
+    def __len__(self):
+        return len(self._hashes)
+
+    @staticmethod
+    def _chunks(h: int) -> list[int]:
+        return [(h >> (i * HammingIndex.CHUNK_BITS)) & HammingIndex._CHUNK_MASK for i in range(HammingIndex.CHUNKS)]
+
+    def _masks(self, radius: int) -> list[int]:
+        if radius not in self._probes:
+            masks = []
+            for r in range(min(radius, HammingIndex.CHUNK_BITS) + 1):
+                for bits in combinations(range(HammingIndex.CHUNK_BITS), r):
+                    masks.append(sum(1 << b for b in bits))
+            self._probes[radius] = masks
+        return self._probes[radius]
+
+    def add(self, key: Hashable, h: int):
+        """
+        Add or replace the hash of key.
+        """
+        old = self._hashes.get(key)
+        if old == h:
+            return
+        if old is not None:
+            self.remove(key)
+        self._hashes[key] = h
+        for table, chunk in zip(self._tables, self._chunks(h)):
+            table.setdefault(chunk, []).append(key)
+
+    def remove(self, key: Hashable):
+        h = self._hashes.pop(key, None)
+        if h is None:
+            return
+        for table, chunk in zip(self._tables, self._chunks(h)):
+            bucket = table[chunk]
+            bucket.remove(key)
+            if not bucket:
+                del table[chunk]
+
+    def search(self, h: int, max_distance: int) -> list[tuple[int, Hashable]]:
+        """
+
+        :return: (distance, key) of all the hashes within max_distance, nearest first
+        """
+        masks = self._masks(max_distance // HammingIndex.CHUNKS)
+        candidates = set()
+        for table, chunk in zip(self._tables, self._chunks(h)):
+            for mask in masks:
+                bucket = table.get(chunk ^ mask)
+                if bucket:
+                    candidates.update(bucket)
+        found = []
+        for key in candidates:
+            distance = hamming(self._hashes[key], h)
+            if distance <= max_distance:
+                found.append((distance, key))
+        found.sort(key=lambda item: item[0])
+        return found
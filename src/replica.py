@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+import logging
+import os
+import socket
+import threading
+import uuid
+
+from bing_storage import BingWallpaperManager
+from metrics import CLAIMS
+
+
+class ReplicaCoordinator(object):
+    """
+    Splits the downloads among the replicas sharing one storage: every replica claims the variants it is about to
+    download in the database, skips the ones claimed by the others, and renews its claims from a heartbeat thread
+    while they are downloaded. The claims of a dead replica are no longer renewed and are taken over by the others
+    once expired, the `.part` file it left is resumed by the new owner.
+    """
+
+    def __init__(self, wallpaper_mgr: BingWallpaperManager, replica_id: str = None, ttl: float = 300):
+        """
+
+        :param replica_id: unique among the replicas, default is hostname-pid-random
+        :param ttl: seconds a claim is kept without renewal, the heartbeat renews them every ttl / 3
+        """
+        self._wallpaper_mgr = wallpaper_mgr
+        self._replica_id = replica_id if replica_id else "{}-{}-{}".format(socket.gethostname(), os.getpid(),
+                                                                            uuid.uuid4().hex[:8])
+        self._ttl = max(1.0, ttl)
+        self._lock = threading.Lock()
+        self._held = set()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    @property
+    def replica_id(self) -> str:
+        return self._replica_id
+
+    def claim(self, tasks: list) -> tuple[list, int]:
+        """
+
+        :param tasks: DownloadTask
+        :return: the tasks claimed by this replica, and the number of tasks left to the others
+        """
+        if not tasks:
+            return [], 0
+        claimed_keys = self._wallpaper_mgr.claim_variants((t.key for t in tasks), self._replica_id, self._ttl)
+        claimed = [t for t in tasks if t.key in claimed_keys]
+        deferred = len(tasks) - len(claimed)
+        with self._lock:
+            self._held.update(claimed_keys)
+        self._start_heartbeat()
+        CLAIMS.inc(len(claimed), result="claimed")
+        CLAIMS.inc(deferred, result="deferred")
+        if deferred:
+            logging.info("[Replica] %s claimed %d variants, %d are stored or being downloaded by other replicas",
+                         self._replica_id, len(claimed), deferred)
+        return claimed, deferred
+
+    def release(self, tasks: list):
+        keys = [t.key for t in tasks]
+        if not keys:
+            return
+        self._wallpaper_mgr.release_claims(keys, self._replica_id)
+        with self._lock:
+            self._held.difference_update(keys)
+
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is not None:
+                return
+            self._heartbeat = threading.Thread(target=self._renew_loop, name="bing-replica", daemon=True)
+            self._heartbeat.start()
+
+    def _renew_loop(self):
+        while not self._stop.wait(self._ttl / 3):
+            with self._lock:
+                held = set(self._held)
+            if not held:
+                continue
+            try:
+                renewed = self._wallpaper_mgr.renew_claims(self._replica_id, self._ttl)
+            except Exception as e:
+                logging.warning("[Replica] failed to renew claims, msg: %s", e)
+                continue
+            with self._lock:
+                # the claims made or released while renewing are not in the snapshot
+                lost = (held - renewed) & self._held
+                self._held -= lost
+            if lost:
+                # expired before renewed, e.g. the database was locked too long, another replica may take them over
+                CLAIMS.inc(len(lost), result="lost")
+                logging.warning("[Replica] %s lost %d claims, %s", self._replica_id, len(lost), sorted(lost))
+
+    def close(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        with self._lock:
+            held = list(self._held)
+            self._held.clear()
+        if held:
+            self._wallpaper_mgr.release_claims(held, self._replica_id)
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+import logging
+import random
+import signal
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from bing_client import BingWallpaperInfo
+
+
+class PublicationScheduler(object):
+    """
+    Plans the service mode rounds from the publication time of the wallpapers: a new wallpaper of a zone is
+    expected one day after the `fullstartdate` (UTC) of the latest one, the scheduler sleeps until shortly before
+    that, polls every `poll_interval` until the new one shows up or `poll_window` has passed, and falls back to
+    `max_interval` otherwise. Failed rounds are retried with exponential backoff.
+    """
+
+    PUBLISH_PERIOD = timedelta(days=1)
+    FULL_START_DATE_FORMAT = "%Y%m%d%H%M"
+
+    def __init__(self,
+                 max_interval: float = 3600,
+                 poll_interval: float = 60,
+                 poll_window: float = 3600,
+                 jitter: float = 30):
+        """
+
+        :param max_interval: second, the longest sleep between two rounds
+        :param poll_interval: second, the interval to poll around the expected publication time, also the first
+                              backoff after an error
+        :param poll_window: second, how long to poll densely before and after the expected publication time
+        :param jitter: second, max random delay added to every planned round
+        """
+        self._max_interval = max_interval
+        self._poll_interval = poll_interval
+        self._poll_window = poll_window
+        self._jitter = jitter
+        # zone -> latest fullstartdate
+        self._latest = {}
+        self._errors = 0
+        self._next_run = time.time()
+        self._stop = threading.Event()
+
+    @property
+    def next_run_time(self) -> float:
+        """
+        Timestamp of the next planned round.
+        """
+        return self._next_run
+
+    def expected_publications(self) -> dict[str, datetime]:
+        return {zone: latest + PublicationScheduler.PUBLISH_PERIOD for zone, latest in self._latest.items()}
+
+    def observe(self, wallpapers: list[BingWallpaperInfo]):
+        for w in wallpapers:
+            if not w.fullstartdate:
+                continue
+            try:
+                start = datetime.strptime(w.fullstartdate, PublicationScheduler.FULL_START_DATE_FORMAT)
+            except ValueError:
+                continue
+            start = start.replace(tzinfo=timezone.utc)
+            if w.zone not in self._latest or start > self._latest[w.zone]:
+                self._latest[w.zone] = start
+
+    def plan(self, success: bool, now: float = None) -> float:
+        """
+        Plan the next round after a round finished.
+
+        :param success: whether the last round succeeded
+        :param now: timestamp, default is current time
+        :return: timestamp of the next round
+        """
+        now = time.time() if now is None else now
+        if not success:
+            self._errors += 1
+            delay = min(self._poll_interval * (2 ** (self._errors - 1)), self._max_interval)
+        else:
+            self._errors = 0
+            delay = self._max_interval
+            for expected in self.expected_publications().values():
+                expected = expected.timestamp()
+                if now < expected - self._poll_window:
+                    delay = min(delay, expected - self._poll_window - now)
+                elif now < expected + self._poll_window:
+                    delay = min(delay, self._poll_interval)
+        self._next_run = now + max(delay, 0) + random.uniform(0, self._jitter)
+        next_run = datetime.fromtimestamp(self._next_run).isoformat(sep=' ', timespec='seconds')
+        logging.info("[Scheduler] next round at %s, after %d second", next_run, self._next_run - now)
+        return self._next_run
+
+    def wait(self) -> bool:
+        """
+        Sleep until the next planned round.
+
+        :return: False if stopped while waiting
+        """
+        return not self._stop.wait(max(self._next_run - time.time(), 0))
+
+    def stop(self, *args):
+        self._stop.set()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stop.is_set()
+
+    def install_signal_handlers(self):
+        """
+        Stop waiting on SIGTERM and SIGINT, must be called from the main thread.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
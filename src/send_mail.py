@@ -58,23 +58,62 @@ def __get_smtp_info(mail_address: str) -> SmtpInfo:
     return SMTP_INFO[smtp_type]
 
 
-def send_mail(from_address: str, from_name: str, pwd: str, to_address: str, title: str, content: str):
+def _make_msg(from_address: str, from_name: str, to_address: str, title: str, content: str) -> MIMEText:
     msg = MIMEText(content, 'plain', 'utf-8')
     msg['From'] = formataddr((from_name, from_address))
     msg['To'] = formataddr(("", to_address))
     msg['Subject'] = title
+    return msg
+
 
+def _connect(from_address: str, pwd: str) -> smtplib.SMTP:
     smtp_info = __get_smtp_info(from_address)
     if smtp_info.ssl:
         server = smtplib.SMTP_SSL(smtp_info.server, smtp_info.port)
     else:
         server = smtplib.SMTP(smtp_info.server, smtp_info.port)
-
     server.login(from_address, pwd)
+    return server
+
+
+def send_mail(from_address: str, from_name: str, pwd: str, to_address: str, title: str, content: str):
+    msg = _make_msg(from_address, from_name, to_address, title, content)
+    server = _connect(from_address, pwd)
     server.sendmail(from_address, [to_address, ], msg.as_string())
     server.quit()
 
 
+class MailSender:
+    """Keeps one logged in smtp connection for sending several mails, reconnects once if it was closed."""
+
+    def __init__(self, from_address: str, from_name: str, pwd: str):
+        self.from_address = from_address
+        self.from_name = from_name
+        self.pwd = pwd
+        self.server = None
+
+    def send(self, to_address: str, title: str, content: str):
+        msg = _make_msg(self.from_address, self.from_name, to_address, title, content).as_string()
+        if self.server is not None:
+            try:
+                self.server.sendmail(self.from_address, [to_address, ], msg)
+                return
+            except (smtplib.SMTPServerDisconnected, OSError):
+                # the server closes idle connections, reconnect
+                self.server = None
+        self.server = _connect(self.from_address, self.pwd)
+        self.server.sendmail(self.from_address, [to_address, ], msg)
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.server = None
+
+
 def get_options(args=None):
     if args is None:
         args = sys.argv[1:]
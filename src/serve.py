@@ -0,0 +1,368 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+import socket
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from bing_client import BingWallpaperClient, BingWallpaperInfo, WallpaperQuality
+from bing_storage import BingWallpaperManager, StoredFile
+from metrics import SERVE_CACHE, SERVE_REQUESTS
+
+
+class LRUCache(object):
+    """
+    Thread safe LRU of at most max_size entries, each expires ttl seconds after it is put.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 10):
+        self._max_size = max(0, max_size)
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (expire time, value)
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                SERVE_CACHE.inc(result="miss")
+                return None
+            self._entries.move_to_end(key)
+        SERVE_CACHE.inc(result="hit")
+        return entry[1]
+
+    def put(self, key, value):
+        if self._max_size == 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self._ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class WallpaperServer(object):
+    """
+    Serves the stored wallpapers from a background thread:
+
+    - `GET /api/latest[?zone=]`: the last wallpaper of every zone
+    - `GET /api/wallpapers[?start=&end=&zone=&q=&limit=]`: the wallpapers of a date range, newest first, q searches
+      the text
+    - `GET /api/wallpapers/<hsh>`: a wallpaper and all of its files
+    - `GET /images/<hsh>[/<quality or derivative>]`: a file, the largest variant by default, `/images/latest[?zone=]`
+      is the last wallpaper
+
+    The images are sent with sendfile(2) from the page cache, and support Range and If-None-Match with the stored
+    sha256 as ETag. The JSON responses and the file lookups are kept in an LRU for cache_ttl seconds, and dropped by
+    invalidate() once a round saved new wallpapers, so the hot requests never hit the database.
+    """
+
+    IMAGE_PATH_PATTERN = re.compile(r"^/images/([^/]+)(?:/([^/]+))?$")
+    WALLPAPER_PATH_PATTERN = re.compile(r"^/api/wallpapers/([^/]+)$")
+    MAX_LIMIT = 1000
+
+    def __init__(self,
+                 wallpaper_mgr: BingWallpaperManager,
+                 download_path: str,
+                 host: str = "0.0.0.0",
+                 port: int = 8080,
+                 cache_size: int = 1024,
+                 cache_ttl: float = 10):
+        """
+
+        :param wallpaper_mgr: better a connection of its own, so the requests do not wait for the writes of the
+                              downloader
+        :param cache_size: max number of cached responses and file lookups
+        :param cache_ttl: seconds a cached response is served, bounds how stale it may be
+        """
+        self._wallpaper_mgr = wallpaper_mgr
+        self._download_path = os.path.abspath(download_path)
+        self._cache = LRUCache(cache_size, cache_ttl)
+        gallery = self
+
+        class Handler(GalleryRequestHandler):
+            server_app = gallery
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self._server.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="bing-serve", daemon=True)
+        self._thread.start()
+        logging.info("[Serve] serving wallpapers at http://%s:%d", *self.address)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def invalidate(self):
+        self._cache.clear()
+
+    @staticmethod
+    def _wallpaper_json(w: BingWallpaperInfo) -> dict:
+        return dict(w.asdict(), image="/images/{}".format(w.hsh))
+
+    def _cached_json(self, key: str, build) -> tuple[bytes, str]:
+        """
+
+        :return: body and ETag of the response
+        """
+        cached = self._cache.get(key)
+        if cached is None:
+            body = json.dumps(build(), ensure_ascii=False).encode("utf-8")
+            cached = (body, '"{}"'.format(hashlib.sha1(body).hexdigest()))
+            self._cache.put(key, cached)
+        return cached
+
+    @staticmethod
+    def _query_value(query: dict, name: str) -> str:
+        values = query.get(name)
+        return values[0] if values else None
+
+    def api(self, path: str, query: dict) -> tuple[bytes, str]:
+        if path == "/api/latest":
+            zone = self._query_value(query, "zone")
+            return self._cached_json("latest:{}".format(zone), lambda: {
+                "wallpapers": [dict(self._wallpaper_json(w), zone=z) for z, w in
+                               self._wallpaper_mgr.latest_wallpapers(zone)]})
+
+        if path == "/api/wallpapers":
+            start, end, zone, text = (self._query_value(query, name) for name in ("start", "end", "zone", "q"))
+            try:
+                limit = min(int(self._query_value(query, "limit") or 100), WallpaperServer.MAX_LIMIT)
+            except ValueError:
+                raise HttpError(400, "limit must be a number")
+            for date in (start, end):
+                if date and not re.fullmatch(r"\d{8}", date):
+                    raise HttpError(400, "dates must be like 20200229")
+            key = "wallpapers:{}:{}:{}:{}:{}".format(start, end, zone, text, limit)
+            return self._cached_json(key, lambda: {
+                "wallpapers": [self._wallpaper_json(hit.wallpaper) for hit in self._wallpaper_mgr.search_wallpapers(
+                    text=text, start_date=start, end_date=end, zone=zone, limit=limit)]})
+
+        match = WallpaperServer.WALLPAPER_PATH_PATTERN.match(path)
+        if match:
+            hsh = match.group(1)
+
+            def build():
+                w = self._wallpaper_mgr.get_wallpaper(hsh)
+                if w is None:
+                    return None
+                files = [{"name": f.name, "size": f.size, "digest": f.digest,
+                          "url": "/images/{}/{}".format(hsh, f.name)} for f in self.files(hsh)]
+                return dict(self._wallpaper_json(w), files=files)
+
+            body, etag = self._cached_json("wallpaper:" + hsh, build)
+            if body == b"null":
+                raise HttpError(404, "wallpaper not found")
+            return body, etag
+        raise HttpError(404, "not found")
+
+    def files(self, hsh: str) -> list[StoredFile]:
+        files = self._cache.get("files:" + hsh)
+        if files is None:
+            files = self._wallpaper_mgr.wallpaper_files(hsh)
+            self._cache.put("files:" + hsh, files)
+        return files
+
+    @staticmethod
+    def _area(f: StoredFile) -> int:
+        quality = WallpaperQuality.__members__.get(f.name)
+        width, height = BingWallpaperClient.WALLPAPER_WH.get(quality, (0, 0))
+        return width * height
+
+    def find_file(self, hsh: str, name: str, zone: str = None) -> tuple[str, StoredFile]:
+        """
+
+        :param hsh: 'latest' for the last wallpaper of the zone, of any zone if not specified
+        :param name: the largest variant if not specified
+        :return: full path and the stored file
+        """
+        if hsh == "latest":
+            key = "latest-hsh:{}".format(zone)
+            hsh = self._cache.get(key)
+            if hsh is None:
+                latest = self._wallpaper_mgr.latest_wallpapers(zone)
+                if not latest:
+                    raise HttpError(404, "no wallpaper")
+                hsh = max((w for _, w in latest), key=lambda w: w.startdate).hsh
+                self._cache.put(key, hsh)
+
+        variants = [f for f in self.files(hsh) if f.name in WallpaperQuality.__members__]
+        if name:
+            found = next((f for f in self.files(hsh) if f.name == name), None)
+        else:
+            found = max(variants, key=WallpaperServer._area) if variants else None
+        if found is None:
+            raise HttpError(404, "image not found")
+        rel_path = os.path.normpath(found.path)
+        if os.path.isabs(rel_path) or rel_path.startswith(".."):
+            raise HttpError(404, "image not found")
+        return os.path.join(self._download_path, rel_path), found
+
+
+class GalleryRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # drop the idle keep-alive connections, each of them holds a thread
+    timeout = 60
+    server_app: WallpaperServer = None
+
+    RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+    def setup(self):
+        super().setup()
+        # the headers and the body are separate writes, with Nagle the body would wait for the delayed ack
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, fmt, *args):
+        logging.debug("[Serve] %s - %s", self.address_string(), fmt % args)
+
+    def _send_headers(self, status: int, headers: dict):
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+
+    def _send_bytes(self, status: int, body: bytes, headers: dict, head: bool):
+        headers["Content-Length"] = str(len(body))
+        self._send_headers(status, headers)
+        if not head:
+            self.wfile.write(body)
+
+    def _send_error_json(self, status: int, message: str, head: bool):
+        self._send_bytes(status, json.dumps({"error": message}).encode("utf-8"),
+                         {"Content-Type": "application/json; charset=utf-8"}, head)
+
+    def _not_modified(self, etag: str) -> bool:
+        if_none_match = self.headers.get("If-None-Match")
+        if not if_none_match:
+            return False
+        tags = [t.strip() for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags or "W/" + etag in tags
+
+    def _range(self, size: int, etag: str) -> tuple[int, int]:
+        """
+
+        :return: [start, end) to send, None for the whole file
+        """
+        value = self.headers.get("Range")
+        if not value:
+            return None
+        if_range = self.headers.get("If-Range")
+        # a strong comparison (RFC 9110 13.1.5), the client may have another version if either validator is weak or
+        # it is a date, send the whole file
+        if if_range and (etag.startswith("W/") or if_range.strip() != etag):
+            return None
+        match = GalleryRequestHandler.RANGE_PATTERN.match(value.strip())
+        if not match or match.group(1) == match.group(2) == "":
+            # multiple ranges are not supported, answering with the whole file is allowed
+            return None
+        first, last = match.group(1), match.group(2)
+        if first == "":
+            start, end = max(0, size - int(last)), size
+        else:
+            start, end = int(first), min(size, int(last) + 1) if last else size
+        if start >= size or start >= end:
+            raise HttpError(416, "range not satisfiable")
+        return start, end
+
+    def _serve_image(self, hsh: str, name: str, query: dict, head: bool):
+        app = self.server_app
+        file_name, stored = app.find_file(hsh, name, WallpaperServer._query_value(query, "zone"))
+        try:
+            file = open(file_name, "rb")
+        except OSError:
+            raise HttpError(404, "image file not found")
+        with file:
+            st = os.fstat(file.fileno())
+            size = st.st_size
+            # the stored digest may be stale if the file was replaced, then the size usually differs too
+            etag = '"{}"'.format(stored.digest) if stored.digest and stored.size == size \
+                else 'W/"{:x}-{:x}"'.format(size, st.st_mtime_ns)
+            headers = {"Content-Type": mimetypes.guess_type(file_name)[0] or "application/octet-stream",
+                       "ETag": etag,
+                       "Accept-Ranges": "bytes",
+                       # /images/latest changes every day
+                       "Cache-Control": "no-cache" if hsh == "latest" else "public, max-age=86400"}
+            if self._not_modified(etag):
+                self._send_headers(304, headers)
+                return 304
+            try:
+                byte_range = self._range(size, etag)
+            except HttpError:
+                headers["Content-Range"] = "bytes */{}".format(size)
+                self._send_bytes(416, b"", headers, head)
+                return 416
+            status = 200
+            start, end = 0, size
+            if byte_range:
+                status = 206
+                start, end = byte_range
+                headers["Content-Range"] = "bytes {}-{}/{}".format(start, end - 1, size)
+            headers["Content-Length"] = str(end - start)
+            self._send_headers(status, headers)
+            if not head and end > start:
+                # zero copy from the page cache to the socket
+                self.connection.sendfile(file, start, end - start)
+            return status
+
+    def _handle(self, head: bool):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        route = "api" if url.path.startswith("/api/") else "images" if url.path.startswith("/images/") else "other"
+        try:
+            match = WallpaperServer.IMAGE_PATH_PATTERN.match(url.path)
+            if match:
+                status = self._serve_image(match.group(1), match.group(2), query, head)
+            else:
+                body, etag = self.server_app.api(url.path, query)
+                headers = {"Content-Type": "application/json; charset=utf-8", "ETag": etag,
+                           "Cache-Control": "no-cache"}
+                if self._not_modified(etag):
+                    status = 304
+                    self._send_headers(status, headers)
+                else:
+                    status = 200
+                    self._send_bytes(status, body, headers, head)
+        except HttpError as e:
+            status = e.status
+            self._send_error_json(status, str(e), head)
+        except (BrokenPipeError, ConnectionResetError):
+            status = 499
+            self.close_connection = True
+        except Exception as e:
+            logging.exception("[Serve] failed to handle %s, msg: %s", self.path, e)
+            status = 500
+            self._send_error_json(status, "internal error", head)
+        SERVE_REQUESTS.inc(route=route, status=str(status))
+
+    def do_GET(self):
+        self._handle(head=False)
+
+    def do_HEAD(self):
+        self._handle(head=True)
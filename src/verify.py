@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+import hashlib
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from bing_client import BingWallpaperClient, BingWallpaperInfo, WallpaperQuality
+from bing_downloader import BingWallpaperDownloader
+from bing_storage import REBUILT_HSH_PREFIX, BingWallpaperManager, StoredVariant
+from manifest import Manifest, ManifestEntry
+
+
+@dataclass
+class VerifyReport:
+    files: int = 0
+    variants: int = 0
+    ok: int = 0
+    # stored variants without file
+    missing: list[str] = field(default_factory=list)
+    # stored variants whose file has another size or digest
+    corrupt: list[str] = field(default_factory=list)
+    # files without stored variant
+    orphans: list[str] = field(default_factory=list)
+    rebuilt: int = 0
+    repaired: int = 0
+    failed: int = 0
+
+
+class BingWallpaperVerifier(object):
+    """
+    Cross-checks the download tree against the stored variants: re-downloads the missing and corrupt files (or
+    forgets them so the next rounds download them again), and saves the files not in the database, e.g. after the
+    database was lost, as new rows.
+    """
+
+    # 20200229_OHR.WallaceFF_EN-CN6550155171_UHD.jpg, 20200229_OHR.WallaceFF_EN-CN6550155171_UHD_1920x1080.jpg
+    FILE_NAME_PATTERN = re.compile(r"^(\d{8})_(OHR\..+?)(?:_(\d+)x(\d+))?(\.\w+)$")
+    ZONE_PATTERN = re.compile(r"_([A-Za-z]{2}-[A-Za-z]{2})\d*_")
+
+    def __init__(self,
+                 downloader: BingWallpaperDownloader,
+                 wallpaper_mgr: BingWallpaperManager,
+                 download_path: str,
+                 manifest: Manifest,
+                 check_digest: bool = True,
+                 concurrency: int = 4):
+        """
+
+        :param downloader: downloads the missing and corrupt files again
+        :param download_path: the download path of the downloader
+        :param manifest: index of download_path
+        :param check_digest: compare the sha256 of the files with the stored ones, otherwise only the sizes
+        :param concurrency: threads to hash and to download the files
+        """
+        self._downloader = downloader
+        self._wallpaper_mgr = wallpaper_mgr
+        self._download_path = download_path
+        self._manifest = manifest
+        self._check_digest = check_digest
+        self._concurrency = max(1, concurrency)
+
+    def _rel_path(self, path: str) -> str:
+        return os.path.relpath(path, self._download_path).replace(os.sep, "/")
+
+    def _variant_path(self, v: StoredVariant) -> str:
+        if v.path:
+            return v.path.replace(os.sep, "/")
+        return self._rel_path(self._downloader.get_filename(v.date, v.url, WallpaperQuality[v.quality]))
+
+    @staticmethod
+    def _quality_of(width: str, height: str) -> WallpaperQuality:
+        if not width:
+            return BingWallpaperClient.DEFAULT_QUALITY
+        wh = [int(width), int(height)]
+        return next((q for q, v in BingWallpaperClient.WALLPAPER_WH.items() if v == wh), None)
+
+    def check(self, entries: dict[str, ManifestEntry], variants: list[tuple[StoredVariant, str]],
+              report: VerifyReport) -> list[tuple[StoredVariant, str]]:
+        """
+
+        :param variants: the stored variants and their expected paths
+        :return: the missing and corrupt ones
+        """
+        broken = []
+        checked = []
+        for v, path in variants:
+            entry = entries.get(path)
+            if entry is None:
+                report.missing.append(path)
+                broken.append((v, path))
+            elif v.size and entry.size != v.size:
+                report.corrupt.append(path)
+                broken.append((v, path))
+            else:
+                checked.append((v, path, entry))
+
+        if self._check_digest:
+            # hashlib releases the GIL, the files are hashed in parallel
+            with ThreadPoolExecutor(max_workers=self._concurrency, thread_name_prefix="bing-verify") as executor:
+                list(executor.map(self._manifest.digest, [entry for v, _, entry in checked if v.digest]))
+        for v, path, entry in checked:
+            if self._check_digest and v.digest and entry.digest != v.digest:
+                report.corrupt.append(path)
+                broken.append((v, path))
+            else:
+                report.ok += 1
+        return broken
+
+    def repair(self, broken: list[tuple[StoredVariant, str]], report: VerifyReport):
+        def download(item: tuple[StoredVariant, str]):
+            v, path = item
+            wallpaper = BingWallpaperInfo.fromjson(v.detail)
+            return self._downloader.download_one_img(wallpaper, WallpaperQuality[v.quality])
+
+        with ThreadPoolExecutor(max_workers=self._concurrency, thread_name_prefix="bing-verify") as executor:
+            futures = [(item, executor.submit(download, item)) for item in broken]
+            for (v, path), future in futures:
+                try:
+                    file = future.result()
+                    rel_path = self._rel_path(file.path)
+                    self._wallpaper_mgr.save_wallpaper_variant(v.hsh, v.quality, rel_path, file.size, file.digest)
+                    self._manifest.update(rel_path, file.digest)
+                    report.repaired += 1
+                except Exception as e:
+                    # the next rounds download it again if bing still returns it
+                    logging.error("[Verify] failed to download %s again, forget it, msg: %s", path, e)
+                    self._wallpaper_mgr.delete_wallpaper_variant(v.hsh, v.quality)
+                    report.failed += 1
+        if report.failed:
+            # the unchanged responses would be skipped and the forgotten variants never planned again
+            self._downloader.invalidate_meta_cache()
+
+    def rebuild(self, entries: dict[str, ManifestEntry], variants: list[tuple[StoredVariant, str]],
+                report: VerifyReport):
+        """
+        Save the files not in the database, as variants of the stored wallpaper of the same image, or as new rows.
+        """
+        stored_ids = {}
+        for v, _ in variants:
+            match = BingWallpaperDownloader.FILE_NAME_PATTERN.match(v.url or "")
+            if match:
+                stored_ids[(v.date, match.group(1))] = v.hsh
+
+        # (date, image id) -> [(quality, entry)]
+        groups = {}
+        for path in report.orphans:
+            match = BingWallpaperVerifier.FILE_NAME_PATTERN.match(path.rsplit("/", 1)[-1])
+            quality = self._quality_of(match.group(3), match.group(4)) if match else None
+            if not quality:
+                logging.warning("[Verify] unknown file %s, skip", path)
+                continue
+            date, image_id = match.group(1), match.group(2) + match.group(5)
+            groups.setdefault((date, image_id), []).append((quality, entries[path]))
+
+        with self._wallpaper_mgr.batch():
+            for (date, image_id), files in groups.items():
+                for _, entry in files:
+                    self._manifest.digest(entry)
+                hsh = stored_ids.get((date, image_id))
+                if not hsh:
+                    # the real hsh is lost with the database, the date and file name keep the row unique, also for
+                    # an image published again on another date, the next round replaces it by the real one
+                    _, first = min(files, key=lambda item: (item[0] != BingWallpaperClient.DEFAULT_QUALITY,
+                                                            item[0].value))
+                    zone = BingWallpaperVerifier.ZONE_PATTERN.search(image_id)
+                    row_id = hashlib.sha256("{}_{}".format(date, image_id).encode()).hexdigest()
+                    wallpaper = BingWallpaperInfo.fromdict({
+                        "startdate": date,
+                        "url": "{}/th?id={}&rf=LaDigue_UHD.jpg&pid=hp".format(BingWallpaperClient.BING_BASE_URL,
+                                                                          image_id),
+                        "hsh": REBUILT_HSH_PREFIX + row_id[:32],
+                        "zone": zone.group(1) if zone else "",
+                    })
+                    hsh = wallpaper.hsh
+                    self._wallpaper_mgr.save_wallpaper_info(wallpaper, size=first.size, digest=first.digest)
+                for quality, entry in files:
+                    self._wallpaper_mgr.save_wallpaper_variant(hsh, quality.name, entry.path, entry.size, entry.digest)
+                    report.rebuilt += 1
+
+    def run(self, repair: bool = True, rebuild: bool = True) -> VerifyReport:
+        report = VerifyReport()
+        entries = self._manifest.scan()
+        variants = []
+        for v in self._wallpaper_mgr.list_variants():
+            try:
+                variants.append((v, self._variant_path(v)))
+            except Exception as e:
+                logging.warning("[Verify] unknown file of variant, hsh: %s, quality: %s, %s", v.hsh, v.quality, e)
+        report.files = len(entries)
+        report.variants = len(variants)
+
+        broken = self.check(entries, variants, report)
+        referenced = set(path for _, path in variants)
+        report.orphans = [path for path in entries if path not in referenced]
+        # keep the digests even if the repair is interrupted
+        self._manifest.save()
+        logging.info("[Verify] files: %d, variants: %d, ok: %d, missing: %d, corrupt: %d, orphans: %d",
+                     report.files, report.variants, report.ok, len(report.missing), len(report.corrupt),
+                     len(report.orphans))
+
+        if rebuild and report.orphans:
+            self.rebuild(entries, variants, report)
+        if repair and broken:
+            self.repair(broken, report)
+        self._manifest.save()
+        logging.info("[Verify] rebuilt: %d, repaired: %d, failed: %d", report.rebuilt, report.repaired, report.failed)
+        return report
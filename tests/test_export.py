@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+"""
+Incremental export of the stored wallpapers, resumed from the watermark saved by the last export of the same name.
+Run from the repository root: python -m unittest discover tests
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from bing_client import BingWallpaperInfo  # noqa: E402
+from bing_storage import REBUILT_HSH_PREFIX, SqliteBingWallpaperManager  # noqa: E402
+from export import BingWallpaperExporter  # noqa: E402
+
+
+def wallpaper(date: str, image_id: str, hsh: str) -> BingWallpaperInfo:
+    return BingWallpaperInfo.fromdict({
+        "startdate": date,
+        "url": "/th?id=OHR.{}_EN-CN6550155171_UHD.jpg&rf=LaDigue_UHD.jpg&pid=hp".format(image_id),
+        "title": image_id,
+        "copyright": "{} (© Bing)".format(image_id),
+        "hsh": hsh,
+        "zone": "CN",
+    })
+
+
+class IncrementalExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.sqlite_file = os.path.join(self.tmp_dir.name, "bing.db")
+        self.output = os.path.join(self.tmp_dir.name, "export.jsonl")
+        self.wallpaper_mgr = SqliteBingWallpaperManager(self.sqlite_file)
+        self.wallpaper_mgr.init_db()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def export(self) -> list[str]:
+        BingWallpaperExporter(self.wallpaper_mgr).export(self.output, watermark_name="daily")
+        with open(self.output, "r") as file:
+            return [json.loads(line)["hsh"] for line in file]
+
+    def test_changed_in_the_same_second(self):
+        rebuilt = REBUILT_HSH_PREFIX + "0" * 32
+        self.wallpaper_mgr.save_wallpaper_info(wallpaper("20200229", "WallaceFF", rebuilt))
+        self.wallpaper_mgr.save_wallpaper_info(wallpaper("20200301", "HummingbirdMoth", "b" * 32))
+        self.assertEqual(self.export(), [rebuilt, "b" * 32])
+
+        # keeps its lower id, and most likely the _update_time of the watermark
+        self.wallpaper_mgr.replace_wallpaper(rebuilt, wallpaper("20200229", "WallaceFF", "a" * 32))
+        self.assertEqual(self.export(), ["a" * 32])
+        self.assertEqual(self.export(), [])
+
+    def test_variant_changed(self):
+        self.wallpaper_mgr.save_wallpaper_info(wallpaper("20200229", "WallaceFF", "a" * 32), size=1, digest="d1")
+        self.wallpaper_mgr.save_wallpaper_info(wallpaper("20200301", "HummingbirdMoth", "b" * 32))
+        self.assertEqual(self.export(), ["a" * 32, "b" * 32])
+
+        self.wallpaper_mgr.save_wallpaper_variant("a" * 32, "UHD_1609", "202002/20200229_WallaceFF.jpg", 1, "d1")
+        self.assertEqual(self.export(), ["a" * 32])
+        self.wallpaper_mgr.delete_wallpaper_variant("a" * 32, "UHD_1609")
+        self.assertEqual(self.export(), ["a" * 32])
+
+    def test_migrate_saved_watermark(self):
+        # a database of the schema before change_seq, with the watermark of an export saved by that version
+        os.remove(self.sqlite_file)
+        migrations = SqliteBingWallpaperManager.MIGRATIONS
+        conn = sqlite3.connect(self.sqlite_file, isolation_level=None)
+        for migrate in migrations[:-1]:
+            migrate(self.wallpaper_mgr, conn.cursor())
+        conn.execute("PRAGMA user_version = {}".format(len(migrations) - 1))
+        for row_id, (hsh, update_time) in enumerate([("a" * 32, "2024-01-01 00:00:00"),
+                                                     ("b" * 32, "2024-01-01 00:00:00"),
+                                                     ("c" * 32, "2024-01-02 00:00:00")], start=1):
+            conn.execute("INSERT INTO `bing.bing` (`id`, `hsh`, `detail`, `_update_time`) VALUES (?, ?, ?, ?)",
+                         (row_id, hsh, wallpaper("20240101", "Img{}".format(row_id), hsh).tojson(), update_time))
+        conn.execute("INSERT INTO `bing.checkpoint` (`name`, `value`) VALUES ('export:daily', ?)",
+                     (json.dumps({"update_time": "2024-01-01 00:00:00", "id": 1}),))
+        conn.close()
+
+        self.wallpaper_mgr = SqliteBingWallpaperManager(self.sqlite_file)
+        self.wallpaper_mgr.init_db()
+        self.assertEqual(self.wallpaper_mgr.schema_version(), len(migrations))
+        self.assertEqual(self.export(), ["b" * 32, "c" * 32])
+
+
+if __name__ == '__main__':
+    unittest.main()
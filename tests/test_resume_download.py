@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+"""
+Resuming interrupted image downloads against a local http server that cuts the connection in the middle of the
+body. Run from the repository root: python -m unittest discover tests
+"""
+
+import hashlib
+import http.server
+import os
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from bing_client import BingWallpaperInfo  # noqa: E402
+from bing_downloader import BingWallpaperDownloader, PartialFile  # noqa: E402
+from http_session import HttpSessionPool  # noqa: E402
+
+
+class FlakyImageHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        body = server.body
+        if server.drop:
+            # no response at all, the connection is closed
+            self.close_connection = True
+            return
+        range_header = self.headers.get("Range")
+        if range_header and server.reject_range:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */{}".format(len(body)))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        start = 0
+        # If-Range is a strong comparison, a changed image is sent again from the start
+        if range_header and self.headers.get("If-Range") == server.etag:
+            start = int(range_header.split("=", 1)[1].split("-", 1)[0])
+        self.send_response(206 if start else 200)
+        self.send_header("ETag", server.etag)
+        self.send_header("Content-Length", str(len(body) - start))
+        if start:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(body) - 1, len(body)))
+        self.end_headers()
+
+        if server.cut_at is not None and server.cut_at > start:
+            self.wfile.write(body[start:server.cut_at])
+            self.wfile.flush()
+            # only the first response is cut
+            server.cut_at = None
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class ResumeDownloadTest(unittest.TestCase):
+    BODY_SIZE = 256 * 1024
+    # on a chunk boundary, the bytes of an incomplete chunk are lost with the connection and downloaded again
+    CUT_AT = 2 * BingWallpaperDownloader.DOWNLOAD_CHUNK_SIZE
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FlakyImageHandler)
+        self.server.daemon_threads = True
+        self.server.body = os.urandom(ResumeDownloadTest.BODY_SIZE)
+        self.server.etag = '"v1"'
+        self.server.cut_at = ResumeDownloadTest.CUT_AT
+        self.server.reject_range = False
+        self.server.drop = False
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.session = HttpSessionPool(max_retries=0, adaptive_concurrency=False)
+        self.wallpaper = BingWallpaperInfo.fromdict({
+            "startdate": "20200229",
+            "url": "http://127.0.0.1:{}/th?id=OHR.WallaceFF_EN-CN6550155171_UHD.jpg&rf=LaDigue_UHD.jpg".format(
+                self.server.server_address[1]),
+            "hsh": "2ba3ec4b6e4fc2ca2d1a3b17c5a3e6e2",
+        })
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp_dir.cleanup()
+
+    def downloader(self, max_retries: int) -> BingWallpaperDownloader:
+        return BingWallpaperDownloader(download_path=self.tmp_dir.name, max_retries=max_retries, retry_backoff_ms=0,
+                                       session=self.session)
+
+    def partial(self, downloader: BingWallpaperDownloader) -> PartialFile:
+        return PartialFile(downloader.get_filename(self.wallpaper.startdate, self.wallpaper.url))
+
+    def assert_complete(self, downloaded, body: bytes):
+        with open(downloaded.path, "rb") as file:
+            self.assertEqual(file.read(), body)
+        self.assertEqual(downloaded.size, len(body))
+        self.assertEqual(downloaded.digest, hashlib.sha256(body).hexdigest())
+        partial = PartialFile(downloaded.path)
+        self.assertFalse(os.path.exists(partial.part_name))
+        self.assertFalse(os.path.exists(partial.meta_name))
+
+    def test_resume_with_range(self):
+        downloaded = self.downloader(max_retries=1).download_one_img(self.wallpaper)
+
+        self.assert_complete(downloaded, self.server.body)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertNotIn("Range", self.server.requests[0])
+        self.assertEqual(self.server.requests[1].get("Range"), "bytes={}-".format(ResumeDownloadTest.CUT_AT))
+        self.assertEqual(self.server.requests[1].get("If-Range"), '"v1"')
+
+    def test_resume_in_later_round(self):
+        downloader = self.downloader(max_retries=0)
+        with self.assertRaises(Exception):
+            downloader.download_one_img(self.wallpaper)
+        partial = self.partial(downloader)
+        self.assertEqual(partial.load(self.wallpaper.url), (ResumeDownloadTest.CUT_AT, '"v1"'))
+
+        downloaded = downloader.download_one_img(self.wallpaper)
+        self.assert_complete(downloaded, self.server.body)
+        self.assertEqual(self.server.requests[1].get("Range"), "bytes={}-".format(ResumeDownloadTest.CUT_AT))
+
+    def test_restart_when_validator_changed(self):
+        downloader = self.downloader(max_retries=0)
+        with self.assertRaises(Exception):
+            downloader.download_one_img(self.wallpaper)
+        # the image changed since the part was received
+        self.server.body = os.urandom(ResumeDownloadTest.BODY_SIZE + 1000)
+        self.server.etag = '"v2"'
+
+        downloaded = downloader.download_one_img(self.wallpaper)
+        self.assert_complete(downloaded, self.server.body)
+        self.assertEqual(self.server.requests[1].get("If-Range"), '"v1"')
+
+    def test_discard_part_on_416(self):
+        downloader = self.downloader(max_retries=0)
+        with self.assertRaises(Exception):
+            downloader.download_one_img(self.wallpaper)
+        partial = self.partial(downloader)
+        self.assertTrue(os.path.exists(partial.part_name))
+        self.server.reject_range = True
+
+        downloaded = downloader.download_one_img(self.wallpaper)
+        self.assert_complete(downloaded, self.server.body)
+        # the range is rejected, the part discarded and the image downloaded from zero
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertIn("Range", self.server.requests[1])
+        self.assertNotIn("Range", self.server.requests[2])
+
+    def test_no_retry_after_adapter_retries(self):
+        self.server.drop = True
+        session = HttpSessionPool(max_retries=2, retry_backoff_ms=0, adaptive_concurrency=False)
+        self.addCleanup(session.close)
+        downloader = BingWallpaperDownloader(download_path=self.tmp_dir.name, max_retries=2, retry_backoff_ms=0,
+                                             session=session)
+        with self.assertRaises(Exception):
+            downloader.download_one_img(self.wallpaper)
+        # retried by the http adapter only, not once more for each of its attempts
+        self.assertEqual(len(self.server.requests), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
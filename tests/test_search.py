@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+# -*- coding: utf8 -*-
+
+"""
+Searching the stored wallpapers, with full text search and the LIKE fallback of the terms too short for it. Run from
+the repository root: python -m unittest discover tests
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from bing_client import BingWallpaperInfo  # noqa: E402
+from bing_storage import SqliteBingWallpaperManager  # noqa: E402
+
+
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.wallpaper_mgr = SqliteBingWallpaperManager(os.path.join(self.tmp_dir.name, "bing.db"))
+        self.wallpaper_mgr.init_db()
+        self.save("20200229", "LaDigue", "La Digue, Seychelles", "Wallace", "a2ba3ec4b6e4fc2ca2d1a3b17c5a3e6e")
+        self.save("20200301", "HummingbirdMoth", "蜂鸟鹰蛾", "花园里的蜂鸟鹰蛾", "b8a3c5d2e1f0a9b8c7d6e5f4a3b2c1d0")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def save(self, date: str, image_id: str, title: str, copyright: str, hsh: str):
+        self.wallpaper_mgr.save_wallpaper_info(BingWallpaperInfo.fromdict({
+            "startdate": date,
+            "url": "/th?id=OHR.{}_EN-CN6550155171_UHD.jpg&rf=LaDigue_UHD.jpg&pid=hp".format(image_id),
+            "urlbase": "/th?id=OHR.{}_EN-CN6550155171".format(image_id),
+            "copyright": copyright,
+            "copyrightlink": "https://www.bing.com/search?q={}&form=hpcapt".format(image_id),
+            "title": title,
+            "hsh": hsh,
+            "zone": "CN",
+        }))
+
+    def search(self, text: str) -> list[str]:
+        return [hit.wallpaper.startdate for hit in self.wallpaper_mgr.search_wallpapers(text)]
+
+    def test_short_term_in_text(self):
+        self.assertEqual(self.search("La"), ["20200229"])
+        self.assertEqual(self.search("蜂鸟"), ["20200301"])
+
+    def test_short_term_not_in_url(self):
+        # in the url, the urlbase, the copyrightlink, the hsh and the key names of every row, not in their text
+        for text in ("th", "id", "hp", "q", "a2", "EN"):
+            self.assertEqual(self.search(text), [], text)
+
+    def test_long_and_short_terms(self):
+        self.assertEqual(self.search("Seychelles Di"), ["20200229"])
+        self.assertEqual(self.search("Seychelles 蜂鸟"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()